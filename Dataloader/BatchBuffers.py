@@ -0,0 +1,58 @@
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+from torch.utils.data._utils.collate import default_collate
+
+# Batch-level materialisation of tiles with a single copy per tile.
+#
+# The default DataLoader path copies every patch several times: reader output -> RGB conversion -> numpy -> tensor,
+# then default_collate stacks the per-sample tensors into a new batch tensor. Datasets implementing __getitems__
+# can instead allocate the batch once (allocate_batch_buffer: in shared memory inside a worker, so that it reaches
+# the main process without any copy, or in pinned memory in the main process) and write each patch straight into its
+# slot. They return a TileBatch, which collate_tile_batch passes through without stacking.
+
+
+def rgb_array(image):
+    # Uint8 (H, W, 3) array of an RGBA PIL image (e.g. from openslide read_region): a single copy of the RGBA buffer,
+    # alpha dropped through a strided view, instead of image.convert('RGB') (one copy) followed by np.array (another).
+    return np.array(image)[..., :3]
+
+
+def allocate_batch_buffer(shape, dtype=torch.uint8, pin_memory=False):
+    # Inside a DataLoader worker, the buffer is allocated in shared memory, which is how the batch is sent to the main
+    # process anyway (this is what default_collate does for its output). In the main process (num_workers=0), it can
+    # be allocated in pinned memory, so that the DataLoader's pin_memory step is a no-op.
+    if get_worker_info() is not None:
+        return shared_empty(shape, dtype)
+    if pin_memory and torch.cuda.is_available():
+        return torch.empty(shape, dtype=dtype, pin_memory=True)
+    return torch.empty(shape, dtype=dtype)
+
+
+def shared_empty(shape, dtype=torch.uint8):
+    # Uninitialised tensor allocated directly in shared memory (tensor.share_memory_() would allocate, then copy).
+    numel = int(np.prod(shape))
+    template = torch.empty(0, dtype=dtype)
+    if hasattr(template, '_typed_storage'):
+        storage = template._typed_storage()._new_shared(numel, device=template.device)
+    else:  # torch < 2.0
+        storage = template.storage()._new_shared(numel)
+    return template.new(storage).resize_(*shape)
+
+
+class TileBatch(list):
+    # List of per-sample outputs (patches are views into images) that also carries the whole batch tensor, so that
+    # collate_tile_batch can return it as is. With the default collate_fn, it collates like any list of samples.
+    def __init__(self, samples, images, labels=None):
+        super().__init__(samples)
+        self.images = images
+        self.labels = labels
+
+
+def collate_tile_batch(batch):
+    # collate_fn for datasets returning TileBatch from __getitems__; any other batch goes through default_collate.
+    if isinstance(batch, TileBatch):
+        if batch.labels is None:
+            return batch.images
+        return [batch.images, default_collate(batch.labels)]
+    return default_collate(batch)
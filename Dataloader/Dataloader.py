@@ -1,7 +1,6 @@
 from typing import Dict, Any
 from pathlib import Path
 import itertools
-import multiprocessing as mp
 import numpy as np
 import pandas as pd
 import torch
@@ -14,6 +13,19 @@ from lightning.pytorch import LightningDataModule
 import openslide
 import Utils.sampling_schemes as sampling_schemes
 from Utils.OmeroTools import connect, download_image, download_annotation
+from Utils.SlidePool import get_slide_pool, default_wsi_backend
+from Utils.NativeTileReader import NativeTileReader
+from Utils.LoaderTuner import get_loader_settings
+from Utils.TileTable import tile_table_path, write_tile_table, append_tile_columns, compact_tile_dataframe, memory_report
+from Utils.TileQuery import TileQuery
+from Dataloader.Samplers import SlideBlockSampler, SlideSubsetSampler
+from Dataloader.ThreadedLoader import ThreadedLoader
+from Dataloader.SharedTileCache import get_shared_tile_cache
+from Dataloader.RegionReads import plan_multilevel_reads
+from Dataloader.TileStore import TileStoreDataset
+from Dataloader.TileIndex import TileIndex
+from Utils.SlideCatalogue import get_slide_catalogue, catalogue_path
+from Dataloader.BatchBuffers import allocate_batch_buffer, TileBatch, collate_tile_batch
 
 import matplotlib.pyplot as plt
 """
@@ -74,49 +86,219 @@ class DataGenerator(torch.utils.data.Dataset):
         self.tile_dataset     = tile_dataset
         self.vis_list         = config['BASEMODEL']['Vis']
         self.patch_size       = config['BASEMODEL']['Patch_Size']
+        self.read_size        = (self.patch_size[1], self.patch_size[0])  # (height, width): Patch_Size is (width, height)
         self.inference        = config['ADVANCEDMODEL']['Inference']
         self.target           = config['DATA']['Label']
-        self.wsi_reader       = WSIReader(backend="cuCIM")
-        self.wsi_object_dict: Dict = {}
+        self.wsi_backend      = config['ADVANCEDMODEL'].get('WSI_Backend', None) or default_wsi_backend()
+        if self.wsi_backend == 'NativeTiles':  # native SVS/TIFF tiles read directly (see Utils.NativeTileReader)
+            self.wsi_reader   = NativeTileReader(max_cached_tiles=config['ADVANCEDMODEL'].get('Native_Tile_Cache', None))
+        else:
+            self.wsi_reader   = WSIReader(backend=self.wsi_backend)
+        self.batched_reads    = config['ADVANCEDMODEL'].get('Batched_Reads', False)
+        self.read_threads     = config['ADVANCEDMODEL'].get('Read_Threads', 4)
+        self.max_open_slides  = config['ADVANCEDMODEL'].get('Max_Open_Slides', None)
+        self.region_reads     = config['ADVANCEDMODEL'].get('Region_Reads', False)
+        self.max_region_size  = config['ADVANCEDMODEL'].get('Max_Region_Size', 2048)
+        self.uint8_output     = config['ADVANCEDMODEL'].get('Device_Transforms', False)
+        # Decoded patches shared by all workers (see Dataloader.SharedTileCache); Tile_Cache_Size is in GB.
+        cache_size            = config['ADVANCEDMODEL'].get('Tile_Cache_Size', None)
+        self.tile_cache       = get_shared_tile_cache(cache_size * 1024 ** 3, (3, *self.read_size)) if cache_size else None
+        self.index            = TileIndex(tile_dataset, label=None if self.inference else self.target)  # no pandas per item
+        self.pin_batch_buffers = False  # set by DataModule when the DataLoader pins memory in the main process
+
     def __len__(self):
-        return int(self.tile_dataset.shape[0])
+        return len(self.index)
     
     def _get_wsi_object(self, image_path):
-
-        if image_path not in self.wsi_object_dict:
-            self.wsi_object_dict[image_path] = self.wsi_reader.read(image_path)
-        return self.wsi_object_dict[image_path]
+        # Slide handles are kept in a per-process LRU pool shared by every DataGenerator of the worker.
+        pool = get_slide_pool(self.wsi_backend.lower(), opener=self.wsi_reader.read, max_open=self.max_open_slides)
+        return pool.get(image_path)
     
-    def __getitem__(self, id):
-        # load image
-        svs_path = self.tile_dataset['SVS_PATH'].iloc[id]
-        patches = torch.empty((len(self.vis_list), 3, *self.patch_size))
-        wsi_obj = self.wsi_reader.read(svs_path)
-        for level in self.vis_list:
-            
-            downsample = self.wsi_reader.get_downsample_ratio(wsi_obj,level)            
-            half_patch_size_X = self.patch_size[0]*downsample // 2
-            half_patch_size_Y = self.patch_size[1]*downsample // 2
-            x_start = self.tile_dataset["coords_x"].iloc[id] - half_patch_size_X
-            y_start = self.tile_dataset["coords_y"].iloc[id] - half_patch_size_Y
-            patch, meta   = self.wsi_reader.get_data(wsi=wsi_obj, location=[y_start,x_start], size=self.patch_size, level=level)
-
-            patch = np.swapaxes(patch,0,2)
-
-            if self.transform:
-                patch = self.transform(patch)
-            patches[level] = patch
-        
-
+    def _tile_start(self, id, downsample):
+        # Reads are centred on the tile coordinates.
+        half_patch_size_X = self.patch_size[0]*downsample // 2
+        half_patch_size_Y = self.patch_size[1]*downsample // 2
+        x_start = int(self.index.coords_x[id]) - half_patch_size_X
+        y_start = int(self.index.coords_y[id]) - half_patch_size_Y
+        return x_start, y_start
+
+    def _empty_patches(self, *n):
+        # With Device_Transforms, patches are returned as raw uint8 (n_levels, *Patch_Size, 3) arrays and transform is
+        # not used: augmentation and normalisation are applied on the whole batch by the model (see ConvNet).
+        # Whole batches (see __getitems__) are allocated once, in shared or pinned memory (see Dataloader.BatchBuffers).
+        if self.uint8_output:
+            shape, dtype = (*n, len(self.vis_list), *self.patch_size, 3), torch.uint8
+        else:
+            shape, dtype = (*n, len(self.vis_list), 3, *self.patch_size), torch.float32
+        if n:
+            return allocate_batch_buffer(shape, dtype, pin_memory=self.pin_batch_buffers)
+        return torch.empty(shape, dtype=dtype)
+
+    def _write_patch(self, patches, i, patch):
+        # Writes the (C, H, W) region returned by the reader into patches[i]. In uint8 mode this is the only copy of
+        # the patch: the transposition is a strided view copied straight into the destination.
+        patch = np.swapaxes(patch,0,2)
+        if self.uint8_output:
+            np.copyto(patches[i].numpy(), patch)
+            return
+        if self.transform:
+            patch = self.transform(patch)
+        patches[i] = patch
+
+    def _format_output(self, id, patches):
         if self.inference:
             return patches
         else:
-            label = self.tile_dataset[self.target].iloc[id]
+            label = self.index.label(id)
             if self.target_transform:
                 label = self.target_transform(label)
 
             return patches, label
 
+    def _downsample(self, wsi_obj, level):
+        n_levels = self.wsi_reader.get_level_count(wsi_obj)
+        if level < n_levels:
+            return self.wsi_reader.get_downsample_ratio(wsi_obj,level)
+
+        # Level missing from the pyramid: extrapolate with the ratio between the two coarsest levels.
+        last = self.wsi_reader.get_downsample_ratio(wsi_obj, n_levels - 1)
+        ratio = last / self.wsi_reader.get_downsample_ratio(wsi_obj, n_levels - 2) if n_levels > 1 else 2
+        return last * round(ratio) ** (level - n_levels + 1)
+
+    def _get_data(self, wsi_obj, level, location, size):
+        # Returns a (C, H, W) region. Levels missing from the slide are derived from the coarsest existing level by
+        # block averaging.
+        n_levels = self.wsi_reader.get_level_count(wsi_obj)
+        if level < n_levels:
+            patch, meta = self.wsi_reader.get_data(wsi=wsi_obj, location=location, size=size, level=level)
+            return patch
+
+        k = int(round(self._downsample(wsi_obj, level) / self.wsi_reader.get_downsample_ratio(wsi_obj, n_levels - 1)))
+        patch, meta = self.wsi_reader.get_data(wsi=wsi_obj, location=location, size=(size[0]*k, size[1]*k), level=n_levels - 1)
+        c = patch.shape[0]
+        return patch.reshape(c, size[0], k, size[1], k).mean(axis=(2, 4)).astype(patch.dtype)
+
+    def _read_patch(self, svs_path, wsi_obj, level, x_start, y_start):
+        # (C, H, W) patch at (x_start, y_start), from the shared tile cache when enabled.
+        if self.tile_cache is None:
+            return self._get_data(wsi_obj, level, [y_start, x_start], self.read_size)
+        patch = self.tile_cache.get(svs_path, level, x_start, y_start, self.patch_size)
+        if patch is None:
+            patch = self._get_data(wsi_obj, level, [y_start, x_start], self.read_size)
+            self.tile_cache.put(svs_path, level, x_start, y_start, self.patch_size, patch)
+        return patch
+
+    def __getitem__(self, id):
+        # load image
+        svs_path = self.index.svs_path(id)
+        patches = self._empty_patches()
+        wsi_obj = self._get_wsi_object(svs_path)
+        for i, level in enumerate(self.vis_list):
+            
+            downsample = self._downsample(wsi_obj,level)            
+            x_start, y_start = self._tile_start(id, downsample)
+            patch = self._read_patch(svs_path, wsi_obj, level, x_start, y_start)
+            self._write_patch(patches, i, patch)
+
+        return self._format_output(id, patches)
+
+    def __getitems__(self, ids):
+        # Batched read path, used by the DataLoader when a whole batch of indices is fetched at once. Patches are
+        # written straight into one preallocated batch tensor, returned as a TileBatch (see Dataloader.BatchBuffers).
+        ids = np.asarray(ids)
+        patches = self._empty_patches(len(ids))
+        if not self.region_reads and self.batched_reads:
+            # Batched reads: all locations of a slide and level are submitted in one call (see _read_locations).
+            slide_ids = self.index.slide_ids[ids]
+            for slide_id in pd.unique(slide_ids):
+                in_slide = np.flatnonzero(slide_ids == slide_id)
+                svs_path = str(self.index.slide_paths[slide_id])
+                wsi_obj = self._get_wsi_object(svs_path)
+                for i, level in enumerate(self.vis_list):
+                    downsample = self._downsample(wsi_obj, level)
+                    starts = [self._tile_start(id, downsample) for id in ids[in_slide]]
+                    for n, patch in zip(in_slide, self._read_locations(svs_path, wsi_obj, level, starts)):
+                        self._write_patch(patches[n], i, patch)
+            return self._tile_batch(ids, patches)
+
+        if not self.region_reads:
+            for n, id in enumerate(ids):
+                svs_path = self.index.svs_path(id)
+                wsi_obj = self._get_wsi_object(svs_path)
+                for i, level in enumerate(self.vis_list):
+                    downsample = self._downsample(wsi_obj, level)
+                    x_start, y_start = self._tile_start(id, downsample)
+                    self._write_patch(patches[n], i, self._read_patch(svs_path, wsi_obj, level, x_start, y_start))
+            return self._tile_batch(ids, patches)
+
+        # Region reads: the tiles of a batch are grouped by slide and spatial block. For each block and each level of
+        # vis_list, the union of the tiles' (centred) windows is read once, and the patches are cropped from that
+        # shared buffer in memory, so that each source JPEG tile is decoded only once. Low magnification context
+        # windows of neighbouring tiles overlap heavily, which makes multi-zoom batches close to single-zoom cost.
+        slide_ids = self.index.slide_ids[ids]
+        for slide_id in pd.unique(slide_ids):
+            in_slide = np.flatnonzero(slide_ids == slide_id)
+            wsi_obj = self._get_wsi_object(str(self.index.slide_paths[slide_id]))
+            downsamples = [self._downsample(wsi_obj, level) for level in self.vis_list]
+            block_size = (self.max_region_size - max(self.patch_size)) * min(downsamples)
+            plans = plan_multilevel_reads(self.index.coords_x[ids[in_slide]],
+                                          self.index.coords_y[ids[in_slide]],
+                                          (self.patch_size[0], self.patch_size[1]), downsamples,  # as _tile_start
+                                          block_size=max(block_size, 1))
+            for i, (level, downsample, plan) in enumerate(zip(self.vis_list, downsamples, plans)):
+                for members, (x0, y0, x1, y1) in plan:
+                    starts = np.array([self._tile_start(id, downsample) for id in ids[in_slide[members]]])
+                    region_patches = self._read_region_patches(wsi_obj, level, downsample, starts, x0, y0)
+                    for n, patch in zip(in_slide[members], region_patches):
+                        self._write_patch(patches[n], i, patch)
+
+        return self._tile_batch(ids, patches)
+
+    def _tile_batch(self, ids, patches):
+        samples = [self._format_output(id, patches[n]) for n, id in enumerate(ids)]
+        labels = None if self.inference else [sample[1] for sample in samples]
+        return TileBatch(samples, patches, labels)
+
+    def _read_locations(self, svs_path, wsi_obj, level, starts):
+        # Reads one patch per (x_start, y_start) level 0 location of a slide, returned as (C, H, W) arrays in order.
+        # With cuCIM, all locations go through a single read_region call and are decoded by read_threads internal
+        # threads. Other backends, single locations and levels derived from coarser ones (see _get_data) are read
+        # one location at a time. With the shared tile cache, only the locations missing from it are read.
+        if self.wsi_backend != 'cuCIM' or len(starts) < 2 or level >= self.wsi_reader.get_level_count(wsi_obj):
+            return [self._read_patch(svs_path, wsi_obj, level, x_start, y_start) for x_start, y_start in starts]
+        if self.tile_cache is None:
+            return self._read_batch(wsi_obj, level, starts)
+
+        patches = [self.tile_cache.get(svs_path, level, x_start, y_start, self.patch_size) for x_start, y_start in starts]
+        missing = [n for n, patch in enumerate(patches) if patch is None]
+        if missing:
+            for n, patch in zip(missing, self._read_batch(wsi_obj, level, [starts[n] for n in missing])):
+                patches[n] = patch
+                self.tile_cache.put(svs_path, level, *starts[n], self.patch_size, patch)
+        return patches
+
+    def _read_batch(self, wsi_obj, level, starts):
+        # Single cuCIM read_region call for all the locations.
+        regions = wsi_obj.read_region(location=[(int(x_start), int(y_start)) for x_start, y_start in starts],
+                                      size=(self.patch_size[0], self.patch_size[1]), level=level,  # (width, height)
+                                      batch_size=len(starts), num_workers=self.read_threads)
+        patches = []
+        for batch in regions:  # (batch_size, H, W, C) arrays
+            batch = np.asarray(batch)
+            if batch.ndim == 3:
+                batch = batch[np.newaxis]
+            patches.extend(np.moveaxis(patch[..., :3], 2, 0) for patch in batch)  # same layout as get_data
+        return patches
+
+    def _read_region_patches(self, wsi_obj, level, downsample, starts, x0, y0):
+        # Offsets of each patch within the region, in pixels of the current level.
+        dx = np.round((starts[:, 0] - x0) / downsample).astype(int)
+        dy = np.round((starts[:, 1] - y0) / downsample).astype(int)
+        height, width = self.read_size
+        size = (int(dy.max()) + height, int(dx.max()) + width)
+        region = self._get_data(wsi_obj, level, [int(y0), int(x0)], size)
+        return [region[:, dy[n]:dy[n] + height, dx[n]:dx[n] + width] for n in range(len(starts))]
+
 
 
 class DataModule(LightningDataModule):
@@ -124,75 +306,138 @@ class DataModule(LightningDataModule):
         super().__init__()
 
         self.batch_size  = config['BASEMODEL']['Batch_Size']        
-        self.num_workers = int(.8 * mp.Pool()._processes)  # number of workers for dataloader is 80% of maximum workers.
 
         if label_encoder:
             tile_dataset[config['DATA']['Label']] = label_encoder.transform(tile_dataset[config['DATA']['Label']])  # For classif only
         
         ## Sampling
-        if config['DATA']['N_Per_Sample'] is None or config['DATA']['N_Per_Sample'] == float("inf"):
-            tile_dataset_sampled = tile_dataset.groupby('SVS_PATH').sample(frac=1)
-                
+        # With Resample_Tiles, the training slides keep all their tiles and a new subset of N_Per_Sample tiles per
+        # slide is drawn every epoch by SlideSubsetSampler; validation and test tiles are sampled once.
+        self.resample_tiles = config['DATA'].get('Resample_Tiles', False) and not config['DATA'].get('Tile_Store', None)
+        if self.resample_tiles:
+            tile_dataset_train, tile_dataset_val, tile_dataset_test = SplitTiles(config, tile_dataset)
+            tile_dataset_val  = SampleTiles(config, tile_dataset_val)
+            tile_dataset_test = SampleTiles(config, tile_dataset_test)
         else:
-            tile_dataset_sampled = (
-                tile_dataset
-                .groupby('SVS_PATH')
-                .apply(lambda group: group.sample(min(config['DATA']['N_Per_Sample'], len(group)), replace=False))
-                .reset_index(drop=True)
-                )
-
-        # Get unique 'SVS_Path' values and split into train val test sets        
-        unique_svs_paths                    = tile_dataset_sampled['SVS_PATH'].unique()
-        train_val_svs_paths, test_svs_paths = train_test_split(unique_svs_paths,
-                                                               train_size= config['DATA']['Train_Size'] + config['DATA']['Val_Size'],
-                                                               random_state=42)
-        
-        train_svs_paths, val_svs_paths      = train_test_split(train_val_svs_paths,
-                                                               train_size = config['DATA']['Train_Size']/( config['DATA']['Train_Size'] + config['DATA']['Val_Size']),
-                                                               random_state=np.random.randint(0,10000))        
-        
-        # Create train, val and test datasets based on the 'SVS_Path' values
-        tile_dataset_train = tile_dataset_sampled[tile_dataset_sampled['SVS_PATH'].isin(train_svs_paths)]
-        tile_dataset_val = tile_dataset_sampled[tile_dataset_sampled['SVS_PATH'].isin(val_svs_paths)]        
-        tile_dataset_test = tile_dataset_sampled[tile_dataset_sampled['SVS_PATH'].isin(test_svs_paths)]
-
-        self.train_data = DataGenerator(tile_dataset_train, config=config, transform=train_transform, **kwargs)
-        self.val_data   = DataGenerator(tile_dataset_val,   config=config, transform=val_transform, **kwargs)
-        self.test_data  = DataGenerator(tile_dataset_test,  config=config, transform=val_transform, **kwargs)
+            tile_dataset_sampled = SampleTiles(config, tile_dataset)
+
+            # Split into train val test sets over SVS_PATH
+            tile_dataset_train, tile_dataset_val, tile_dataset_test = SplitTiles(config, tile_dataset_sampled)
+
+        # Pre-extracted tiles (see Dataloader.TileStore.build_tile_store) are read without decoding or opening slides.
+        dataset_class = TileStoreDataset if config['DATA'].get('Tile_Store', None) else DataGenerator
+        self.train_data = dataset_class(tile_dataset_train, config=config, transform=train_transform, **kwargs)
+        self.val_data   = dataset_class(tile_dataset_val,   config=config, transform=val_transform, **kwargs)
+        self.test_data  = dataset_class(tile_dataset_test,  config=config, transform=val_transform, **kwargs)
+
+        # Optional slide-locality shuffling: shuffle (slide, block) chunks rather than individual tiles.
+        self.train_sampler = None
+        if self.resample_tiles:
+            self.train_sampler = SlideSubsetSampler(tile_dataset_train,
+                                                    n_per_sample=config['DATA']['N_Per_Sample'],
+                                                    seed=config['ADVANCEDMODEL']['Random_Seed'])
+        elif config['DATA'].get('Block_Size', None):
+            self.train_sampler = SlideBlockSampler(tile_dataset_train,
+                                                   block_size=config['DATA']['Block_Size'],
+                                                   mix_blocks=config['DATA'].get('Block_Mix', 4),
+                                                   seed=config['ADVANCEDMODEL']['Random_Seed'])
+
+        # With Loader_Threads, batches are read by a thread pool of the main process (see Dataloader.ThreadedLoader).
+        self.loader_threads  = config['ADVANCEDMODEL'].get('Loader_Threads', None)
+        self.loader_prefetch = config['ADVANCEDMODEL'].get('Loader_Prefetch', None)
+        self.random_seed     = config['ADVANCEDMODEL']['Random_Seed']
+
+        # num_workers, prefetch_factor, persistent_workers and pin_memory (see Utils.LoaderTuner). Batches are assembled
+        # in place by __getitems__ and passed through by collate_tile_batch (see Dataloader.BatchBuffers).
+        if self.loader_threads:
+            settings = {'num_workers': 0, 'pin_memory': True}
+        elif self.train_sampler is not None:
+            settings = get_loader_settings(config, self.train_data, sampler=self.train_sampler, collate_fn=collate_tile_batch)
+        else:
+            settings = get_loader_settings(config, self.train_data, shuffle=True, collate_fn=collate_tile_batch)
+        self.loader_settings = dict(settings, collate_fn=collate_tile_batch)
+        for dataset in [self.train_data, self.val_data, self.test_data]:
+            dataset.pin_batch_buffers = self.loader_settings['pin_memory'] and self.loader_settings['num_workers'] == 0
      
+    def _dataloader(self, dataset, **kwargs):
+        if self.loader_threads:
+            return ThreadedLoader(dataset, batch_size=self.batch_size, num_threads=self.loader_threads,
+                                  prefetch=self.loader_prefetch, pin_memory=True, seed=self.random_seed, **kwargs)
+        return DataLoader(dataset, batch_size=self.batch_size, **kwargs, **self.loader_settings)
+
     def train_dataloader(self):
-        return DataLoader(self.train_data, batch_size=self.batch_size, num_workers=self.num_workers, pin_memory=False, shuffle=True)    
+        if self.train_sampler is not None:
+            return self._dataloader(self.train_data, sampler=self.train_sampler)
+        return self._dataloader(self.train_data, shuffle=True)
 
     def val_dataloader(self):
-        return DataLoader(self.val_data, batch_size=self.batch_size, num_workers=self.num_workers, pin_memory=False, shuffle=True)    
+        return self._dataloader(self.val_data, shuffle=True)
 
     def test_dataloader(self):
-        return DataLoader(self.test_data, batch_size=self.batch_size, num_workers=self.num_workers, pin_memory=False)
-
-def LoadFileParameter(config: dict, SVS_dataset: pd.DataFrame) -> pd.DataFrame:
-
-    cur_basemodel_str = '_'.join(f"{key}_{config['BASEMODEL'][key]}" for key in ['Patch_Size', 'Vis'])
-    tile_dataframe = []
+        return self._dataloader(self.test_data)
+
+def SampleTiles(config: dict, tile_dataset: pd.DataFrame) -> pd.DataFrame:
+    # Draws N_Per_Sample tiles per SVS_PATH (all tiles, shuffled, if N_Per_Sample is None or inf), grouped by slide.
+    # The draw is the vectorised one of SlideSubsetSampler, seeded from the global numpy state.
+    sampler = SlideSubsetSampler(tile_dataset, config['DATA']['N_Per_Sample'], shuffle=True, seed=np.random.randint(0, 2**31))
+    indices = sampler.indices()
+    slide_codes, _ = pd.factorize(tile_dataset['SVS_PATH'], sort=True)
+    indices = indices[np.argsort(slide_codes[indices], kind='stable')]
+    if config['DATA']['N_Per_Sample'] is None or config['DATA']['N_Per_Sample'] == float("inf"):
+        return tile_dataset.iloc[indices]
+    return tile_dataset.iloc[indices].reset_index(drop=True)
+
+def SplitTiles(config: dict, tile_dataset_sampled: pd.DataFrame):
+    # Get unique 'SVS_Path' values and split into train val test sets
+    unique_svs_paths                    = np.asarray(tile_dataset_sampled['SVS_PATH'].unique())  # SVS_PATH may be categorical
+    train_val_svs_paths, test_svs_paths = train_test_split(unique_svs_paths,
+                                                           train_size= config['DATA']['Train_Size'] + config['DATA']['Val_Size'],
+                                                           random_state=42)
+    
+    train_svs_paths, val_svs_paths      = train_test_split(train_val_svs_paths,
+                                                           train_size = config['DATA']['Train_Size']/( config['DATA']['Train_Size'] + config['DATA']['Val_Size']),
+                                                           random_state=np.random.randint(0,10000))        
     
-    for nb, (index, row) in enumerate(SVS_dataset.iterrows()):
-        key =  next(iter(np.load(row['NPY_PATH'], allow_pickle=True).item()))
-        _, existing_df = np.load(row['NPY_PATH'], allow_pickle=True).item()[key]        ## Temporary because naming in npy arent uniform
-        existing_df.sort_index(inplace=True)    
-        #_, existing_df = np.load(row['NPY_PATH'], allow_pickle=True).item()[cur_basemodel_str]
-        tile_dataframe.append(existing_df)
-    tile_dataset = pd.concat(tile_dataframe, axis=0)
+    # Create train, val and test datasets based on the 'SVS_Path' values
+    tile_dataset_train = tile_dataset_sampled[tile_dataset_sampled['SVS_PATH'].isin(train_svs_paths)]
+    tile_dataset_val = tile_dataset_sampled[tile_dataset_sampled['SVS_PATH'].isin(val_svs_paths)]        
+    tile_dataset_test = tile_dataset_sampled[tile_dataset_sampled['SVS_PATH'].isin(test_svs_paths)]
+    return tile_dataset_train, tile_dataset_val, tile_dataset_test
+
+def LoadFileParameter(config: dict, SVS_dataset: pd.DataFrame, columns=None) -> pd.DataFrame:
+    # Loads the tile table of each slide, with appended result columns. Parquet tile tables (see Utils.TileTable) are
+    # used when they exist, reading only the given columns (all if None); legacy pickled .npy files are used otherwise.
+    # To load only some of the tiles, use Utils.TileQuery directly, which filters each slide as it is read.
+    # Unless DATA.Compact_Tile_Table is false, tables are converted to the compact schema of Utils.TileTable.
+    compact = config['DATA'].get('Compact_Tile_Table', True)
+    tile_dataset = TileQuery(SVS_dataset, columns=columns, compact=compact, label_columns=[config['DATA'].get('Label', None)]).collect()
+    memory_report(tile_dataset)
     return tile_dataset
 
 def SaveFileParameter(config: dict, df: pd.DataFrame, SVS_ID: str) -> str:
+    # Saves as a Parquet tile table if DATA.Tile_Table_Format is "parquet" or if the slide already has one,
+    # to the legacy pickled .npy dict otherwise.
     cur_basemodel_str = '_'.join(f"{key}_{config['BASEMODEL'][key]}" for key in ['Patch_Size', 'Vis'])
     npy_path = Path(config['DATA']['SVS_Folder'], 'patches', f"{SVS_ID}.npy")
     npy_path.parent.mkdir(parents=True, exist_ok=True)
+    if config['DATA'].get('Compact_Tile_Table', True):
+        df = compact_tile_dataframe(df, label_columns=[config['DATA'].get('Label', None)])
+
+    parquet_path = tile_table_path(npy_path)
+    if config['DATA'].get('Tile_Table_Format', 'npy') == 'parquet' or parquet_path.exists():
+        return write_tile_table(parquet_path, config, df, basemodel_str=cur_basemodel_str)
 
     npy_dict = np.load(npy_path, allow_pickle=True).item() if npy_path.exists() else {}
     npy_dict[cur_basemodel_str] = [config, df]
     np.save(npy_path, npy_dict)
     return str(npy_path)
 
+def AppendFileParameter(config: dict, df: pd.DataFrame, SVS_ID: str, name: str = 'columns') -> str:
+    # Appends the columns of df (e.g. predictions, indexed like the tile table) to the tile table of SVS_ID without
+    # rewriting it. Safe to call from several processes at once; LoadFileParameter merges the appended columns.
+    npy_path = Path(config['DATA']['SVS_Folder'], 'patches', f"{SVS_ID}.npy")
+    return append_tile_columns(npy_path, df, name=name)
+
 def QueryImageFromCriteria(config: dict, **kwargs) -> pd.DataFrame:
     print("Querying from Server")
     df = pd.DataFrame()
@@ -269,6 +514,12 @@ def SynchronizeSVS(config: dict, df: pd.DataFrame) -> None:
 
     conn.close()
 
+    # Headers of new or re-downloaded slides are read once here, then looked up by the rest of the pipeline.
+    catalogue = get_slide_catalogue(catalogue_path(config))
+    for index, image in df.iterrows():
+        if os.path.exists(image['SVS_PATH']):
+            catalogue.get(image['SVS_PATH'], slide_id=image['id_external'])
+
 def SynchronizeNPY(config: Dict[str, Any], df: pd.DataFrame) -> None:
     with connect(config['OMERO']['Host'], config['OMERO']['User'], config['OMERO']['Pw']) as conn:
         conn.SERVICE_OPTS.setOmeroGroup('-1')
@@ -4,7 +4,6 @@ import os
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
 import numpy as np
-import openslide
 from torchvision.transforms import functional as F
 import nrrd
 import torch
@@ -14,6 +13,8 @@ from typing import Tuple, Dict, Optional
 from pytorch_lightning import LightningDataModule
 from sklearn.model_selection import train_test_split
 from skimage import morphology as morph
+from Utils.SlidePool import open_slide
+from Dataloader.BatchBuffers import rgb_array
 
 def get_bbox_from_mask(mask):
     pos = np.where(mask==255)
@@ -85,8 +86,8 @@ class MFDataset(Dataset):
             index = self.df['index'][i]
             filename = self.df['SVS_ID'][i]
             top_left = (self.df['coords_x'][i], self.df['coords_y'][i])
-            wsi_object = openslide.open_slide(self.wsi_folder + '{}.svs'.format(filename))
-            img = np.array(wsi_object.read_region(top_left, vis_level, dim).convert("RGB"))
+            wsi_object = open_slide(self.wsi_folder + '{}.svs'.format(filename))
+            img = rgb_array(wsi_object.read_region(top_left, vis_level, dim))
 
             num_objs = 1
             label = self.df['num_objs'][i]
@@ -199,16 +200,16 @@ class MixDataset(Dataset):
 
             SVS_ID = self.df['SVS_ID'][i]
             top_left = (self.df['coords_x'][i], self.df['coords_y'][i])
-            wsi_object = openslide.open_slide(self.wsi_folder + '{}.svs'.format(SVS_ID))
+            wsi_object = open_slide(self.wsi_folder + '{}.svs'.format(SVS_ID))
 
             if self.masked_input:
                 index = self.df['index'][i]
-                data = np.array(wsi_object.read_region(top_left, self.vis_level, (256, 256)).convert("RGB"))
+                data = rgb_array(wsi_object.read_region(top_left, self.vis_level, (256, 256)))
                 mask = np.load(self.mask_folder + '{}_detected_masks.npy'.format(SVS_ID))[index]
             else:
                 x = self.df['cell_x'][i]
                 y = self.df['cell_y'][i]
-                img = np.array(wsi_object.read_region((int(x), int(y)), self.vis_level, self.dim).convert("RGB"))
+                img = rgb_array(wsi_object.read_region((int(x), int(y)), self.vis_level, self.dim))
 
         elif self.data_source == 'nrrd_files':
             custom_field_map = {
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+
+
+def plan_region_reads(x_start, y_start, read_size, max_region_size=2048, max_waste=2.0):
+    # Groups neighbouring tile reads into larger "super-region" reads.
+    #
+    # x_start, y_start: (N,) arrays with the top-left corner of each tile read (level 0 coordinates).
+    # read_size: (w, h) of one tile read, in level 0 pixels (i.e. patch size x downsample).
+    # max_region_size: maximum width/height of a super-region, in level 0 pixels. If None, all tiles are candidates for
+    #                  a single region (used when the caller has already grouped tiles spatially).
+    # max_waste: a group is only read as one region if the region area is at most max_waste times the area actually
+    #            covered by its tiles; sparse groups are split back into single-tile reads.
+    #
+    # Returns a list of (members, (x0, y0, x1, y1)) where members indexes into x_start/y_start and (x0, y0, x1, y1) is
+    # the level 0 bounding box to read. Every tile appears in exactly one entry.
+
+    x_start = np.asarray(x_start, dtype=np.int64)  # areas below overflow int32 (compact tile tables)
+    y_start = np.asarray(y_start, dtype=np.int64)
+    w, h = read_size
+    if max_region_size is None:
+        cell_ids = np.zeros(len(x_start), dtype=int)
+    else:
+        cell_ids = _cell_ids(x_start, y_start,
+                             max(w, max_region_size - w),  # cells are chosen so that a cell plus one tile fits in max_region_size
+                             max(h, max_region_size - h))
+    plan = []
+    for members in _split_by(cell_ids):
+        x0, y0 = x_start[members].min(), y_start[members].min()
+        x1, y1 = x_start[members].max() + w, y_start[members].max() + h
+        if len(members) > 1 and (x1 - x0) * (y1 - y0) <= max_waste * len(members) * w * h:
+            plan.append((members, (x0, y0, x1, y1)))
+        else:
+            plan.extend((members[i:i + 1], (x_start[m], y_start[m], x_start[m] + w, y_start[m] + h))
+                        for i, m in enumerate(members))
+    return plan
+
+
+def plan_multilevel_reads(centre_x, centre_y, patch_size, downsamples, block_size=2048, max_waste=2.0):
+    # Read planner for multi-zoom tiles, where each tile is read at several levels, centred on the same point.
+    #
+    # centre_x, centre_y: (N,) arrays with the centre of each tile (level 0 coordinates).
+    # patch_size: (w, h) of a patch in pixels, identical at all levels.
+    # downsamples: list with the downsample factor of each level to read.
+    # block_size: side of the spatial blocks, in level 0 pixels.
+    #
+    # Tiles are first grouped into spatial blocks. The context windows of neighbouring tiles overlap more and more as
+    # the level gets coarser, so for each block and each level, the union of the context windows is read once and
+    # every tile crops its patch from that shared buffer (unless the union is too sparse, see plan_region_reads).
+    #
+    # Returns a list with one entry per level, each entry being a list of (members, (x0, y0, x1, y1)) as in
+    # plan_region_reads, where members index into centre_x/centre_y and boxes are given as level 0 coordinates.
+
+    centre_x = np.asarray(centre_x, dtype=np.int64)
+    centre_y = np.asarray(centre_y, dtype=np.int64)
+    blocks = _split_by(_cell_ids(centre_x, centre_y, block_size, block_size))
+
+    plans = []
+    for downsample in downsamples:
+        w, h = patch_size[0] * downsample, patch_size[1] * downsample
+        x_start, y_start = centre_x - w // 2, centre_y - h // 2
+        level_plan = []
+        for block in blocks:
+            level_plan.extend((block[members], box) for members, box in
+                              plan_region_reads(x_start[block], y_start[block], (w, h), max_region_size=None,
+                                                max_waste=max_waste))
+        plans.append(level_plan)
+    return plans
+
+
+def _cell_ids(x, y, cell_x, cell_y):
+    return pd.factorize(pd.MultiIndex.from_arrays([np.floor_divide(x, cell_x), np.floor_divide(y, cell_y)]))[0]
+
+
+def _split_by(ids):
+    # Splits range(len(ids)) into groups of equal ids.
+    order = np.argsort(ids, kind='stable')
+    return np.split(order, np.flatnonzero(np.diff(ids[order])) + 1)
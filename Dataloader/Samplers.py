@@ -0,0 +1,205 @@
+import math
+import numpy as np
+import pandas as pd
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+class SlideBlockSampler(Sampler):
+    """
+    Shuffles tiles at the level of (slide, spatial block) chunks instead of individual tiles.
+
+    Tiles are grouped into square blocks of block_size x block_size pixels (level 0 coordinates) within each slide.
+    Every epoch the order of the blocks is shuffled, and the tiles of each block are visited in raster order (rows
+    of increasing y, then increasing x), which is the order in which SVS/TIFF tiles are laid out on disk. Consecutive
+    reads therefore hit the same slide handle, the same OS page cache lines and the same decoded JPEG tiles.
+
+    To keep batches statistically mixed, blocks are drawn mix_blocks at a time and their tiles are interleaved, so
+    a batch contains tiles from several slides/regions rather than a single block.
+
+    The permutation only depends on seed and on the epoch, set with set_epoch() (called automatically by Lightning) or
+    otherwise advanced by each iteration (e.g. under DistributedSamplerWrapper, which does not forward set_epoch).
+    """
+
+    def __init__(self, tile_dataset, block_size=2048, mix_blocks=4, shuffle=True, seed=0):
+        super().__init__()
+        self.block_size = int(block_size)
+        self.mix_blocks = max(1, int(mix_blocks))
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.n_tiles = len(tile_dataset)
+
+        slide_codes, _ = pd.factorize(tile_dataset['SVS_PATH'], sort=False)
+        coords_x = tile_dataset['coords_x'].to_numpy()
+        coords_y = tile_dataset['coords_y'].to_numpy()
+
+        # Sort tiles by (slide, block_y, block_x, y, x): each block becomes a contiguous run of positional indices,
+        # itself in raster order.
+        block_x = coords_x // self.block_size
+        block_y = coords_y // self.block_size
+        self.order = np.lexsort((coords_x, coords_y, block_x, block_y, slide_codes))
+
+        keys = np.stack([slide_codes[self.order], block_y[self.order], block_x[self.order]], axis=1)
+        is_new_block = np.ones(len(keys), dtype=bool)
+        is_new_block[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+        self.block_starts = np.flatnonzero(is_new_block)
+        self.block_ends = np.append(self.block_starts[1:], len(keys))
+
+    def __len__(self):
+        return self.n_tiles
+
+    @property
+    def n_blocks(self):
+        return len(self.block_starts)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        epoch, self.epoch = self.epoch, self.epoch + 1
+        if self.shuffle:
+            rng = np.random.default_rng(self.seed + epoch)
+            block_order = rng.permutation(self.n_blocks)
+        else:
+            block_order = np.arange(self.n_blocks)
+
+        for group_start in range(0, len(block_order), self.mix_blocks):
+            group = block_order[group_start:group_start + self.mix_blocks]
+            runs = [self.order[self.block_starts[b]:self.block_ends[b]] for b in group]
+            yield from _interleave(runs).tolist()
+
+
+class RankShardSampler(Sampler):
+    """
+    Shards a sampler between torch.distributed ranks, like DistributedSampler does for a dataset.
+
+    Every rank iterates the wrapped sampler, which must give the same indices on every rank (the samplers of this
+    module only depend on their seed and epoch), and keeps every num_replicas-th index starting at its rank. Indices
+    are repeated from the start to make the list a multiple of num_replicas, so that every rank runs the same number
+    of batches. set_epoch is forwarded to the wrapped sampler.
+    """
+
+    def __init__(self, sampler, num_replicas=None, rank=None):
+        super().__init__()
+        self.sampler = sampler
+        self.num_replicas = dist.get_world_size() if num_replicas is None else int(num_replicas)
+        self.rank = dist.get_rank() if rank is None else int(rank)
+
+    def __len__(self):
+        return math.ceil(len(self.sampler) / self.num_replicas)
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        indices = list(self.sampler)
+        total = len(self) * self.num_replicas
+        if indices and len(indices) < total:
+            indices += (indices * math.ceil(total / len(indices)))[:total - len(indices)]
+        yield from indices[self.rank:total:self.num_replicas]
+
+
+def _interleave(runs):
+    # Round-robin merge of several index arrays, keeping the order within each array.
+    if len(runs) == 1:
+        return runs[0]
+    lengths = np.array([len(r) for r in runs])
+    rank = np.concatenate([np.arange(n) / n for n in lengths])  # relative position of each tile inside its run
+    return np.concatenate(runs)[np.argsort(rank, kind='stable')]
+
+
+class SlideSubsetSampler(Sampler):
+    """
+    Draws a fresh subset of at most n_per_sample tiles per slide every epoch.
+
+    Sampling N_Per_Sample tiles per slide once (SampleTiles) trains every epoch on the same subset. This sampler
+    instead holds the full tile table of the training slides, as one range of positions per slide, and draws a new
+    stratified subset (min(n_per_sample, tiles of the slide) distinct tiles from each slide) at every epoch, so that
+    training covers more of each slide at the same cost per epoch. The draw is vectorised over slides and only
+    touches the drawn positions (no DataFrame is built or copied).
+
+    The subset and its order only depend on seed and on the epoch, set with set_epoch() (called automatically by
+    Lightning) or otherwise advanced by each iteration (e.g. under DistributedSamplerWrapper, which does not forward
+    set_epoch). n_per_sample None or inf keeps every tile, like SampleTiles.
+    """
+
+    def __init__(self, tile_dataset, n_per_sample, shuffle=True, seed=0):
+        super().__init__()
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+        slide_codes, _ = pd.factorize(tile_dataset['SVS_PATH'], sort=False)
+        # Positions grouped by slide: tile tables usually list the tiles of each slide contiguously already.
+        self.order = None
+        if len(slide_codes) > 1 and np.any(slide_codes[1:] < slide_codes[:-1]):
+            self.order = np.argsort(slide_codes, kind='stable')
+        self.counts = np.bincount(slide_codes).astype(np.int64) if len(slide_codes) else np.zeros(0, dtype=np.int64)
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]]).astype(np.int64)
+
+        if n_per_sample is None or n_per_sample == float('inf'):
+            self.n_draw = self.counts.copy()
+        else:
+            self.n_draw = np.minimum(int(n_per_sample), self.counts)
+
+    def __len__(self):
+        return int(self.n_draw.sum())
+
+    @property
+    def n_slides(self):
+        return len(self.counts)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def indices(self, epoch=None):
+        # Positional indices of the subset of an epoch (by default, the one of the next iteration), in iteration order.
+        epoch = self.epoch if epoch is None else epoch
+        rng = np.random.default_rng(self.seed + epoch)
+
+        # Slides keeping at most half of their tiles draw the tiles to keep, the others draw the tiles to leave out,
+        # so that every draw below has a probability of at least 1/2 of hitting a new tile.
+        sparse = 2 * self.n_draw <= self.counts
+        dense = ~sparse
+        keep = _distinct_positions(rng, self.starts[sparse], self.counts[sparse], self.n_draw[sparse])
+        left_out = _distinct_positions(rng, self.starts[dense], self.counts[dense], self.counts[dense] - self.n_draw[dense])
+        dense_positions = _ranges(self.starts[dense], self.counts[dense])
+        positions = np.concatenate([keep, dense_positions[~np.isin(dense_positions, left_out, assume_unique=True)]])
+
+        if self.shuffle:
+            positions = rng.permutation(positions)
+        else:
+            positions.sort()
+        return positions if self.order is None else self.order[positions]
+
+    def __iter__(self):
+        epoch, self.epoch = self.epoch, self.epoch + 1
+        yield from self.indices(epoch).tolist()
+
+
+def _ranges(starts, lengths):
+    # Concatenation of np.arange(start, start + length) for each range.
+    offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+    return (offsets + np.arange(lengths.sum())).astype(np.int64)
+
+
+def _distinct_positions(rng, starts, counts, k):
+    # Sorted positions of k[i] distinct tiles drawn uniformly from each range [starts[i], starts[i] + counts[i]), with
+    # k <= counts / 2. Draws are repeated for the duplicates only (expected O(log k) rounds).
+    positions = np.zeros(0, dtype=np.int64)
+    missing = np.asarray(k, dtype=np.int64)
+    while missing.any():
+        strata = np.repeat(np.arange(len(missing)), missing)
+        draws = np.sort(starts[strata] + (rng.random(len(strata)) * counts[strata]).astype(np.int64))
+        new = np.ones(len(draws), dtype=bool)
+        new[1:] = draws[1:] != draws[:-1]
+        if len(positions):
+            found = np.minimum(np.searchsorted(positions, draws), len(positions) - 1)
+            new &= positions[found] != draws
+        draws = draws[new]
+        # Merge of two sorted runs (linear with the stable sort).
+        positions = np.sort(np.concatenate([positions, draws]), kind='stable')
+        missing = missing - np.bincount(np.searchsorted(starts, draws, side='right') - 1, minlength=len(k))
+    return positions
@@ -0,0 +1,148 @@
+import hashlib
+import multiprocessing as mp
+import numpy as np
+import torch
+from lightning.pytorch.callbacks import Callback
+from Dataloader.BatchBuffers import shared_empty
+
+# Decoded-tile cache shared by all the DataLoader workers of a run.
+#
+# When several epochs go over the same sampled tiles (N_Per_Sample), every worker process decodes them again, epoch
+# after epoch. SharedTileCache keeps decoded patches in a shared-memory arena allocated once by the main process
+# (before the workers start), so that a patch decoded by any worker is then served to all of them.
+#
+# The arena is a set-associative cache of fixed-size entries (one (C, H, W) uint8 patch each): a key, hashed from
+# (slide, level, x, y, size), maps to one set of `ways` entries, and the least recently used entry of the set is
+# evicted when the set is full (LRU within each set, which approximates a global LRU). Sets are protected by a
+# fixed number of striped process-shared locks. Hits, misses and evictions are counted in shared memory, so that
+# hit rates seen from the main process include every worker (see stats and TileCacheMonitor).
+
+
+class SharedTileCache:
+    def __init__(self, budget_bytes, entry_shape, ways=8, n_locks=64):
+        self.entry_shape = tuple(int(n) for n in entry_shape)
+        entry_bytes      = int(np.prod(self.entry_shape))
+        self.ways        = int(ways)
+        self.n_sets      = max(1, int(budget_bytes) // (entry_bytes * self.ways))
+        self.n_locks     = min(int(n_locks), self.n_sets)
+
+        # Shared tensors (passed to spawned workers by handle). Zero stamps mark empty entries.
+        self._data     = shared_empty((self.n_sets, self.ways, entry_bytes), torch.uint8)
+        self._keys     = shared_empty((self.n_sets, self.ways, 2), torch.int64).zero_()
+        self._stamps   = shared_empty((self.n_sets, self.ways), torch.int64).zero_()
+        self._clocks   = shared_empty((self.n_sets,), torch.int64).zero_()
+        self._counters = shared_empty((self.n_locks, 3), torch.int64).zero_()  # hits, misses, evictions
+        self._locks    = [mp.Lock() for _ in range(self.n_locks)]
+        self._views()
+
+    def _views(self):
+        self.data, self.keys, self.stamps, self.clocks, self.counters = [
+            t.numpy() for t in (self._data, self._keys, self._stamps, self._clocks, self._counters)]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['data', 'keys', 'stamps', 'clocks', 'counters']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._views()
+
+    @property
+    def capacity(self):
+        return self.n_sets * self.ways
+
+    @property
+    def nbytes(self):
+        return self._data.numel()
+
+    def _locate(self, slide, level, x, y, size):
+        digest = hashlib.blake2b('{}|{}|{}|{}|{}|{}'.format(slide, int(level), int(x), int(y), int(size[0]), int(size[1]))
+                                 .encode(), digest_size=16).digest()
+        key = np.frombuffer(digest, dtype=np.int64)
+        s = int(key[0] % self.n_sets)
+        return s, key, self._locks[s % self.n_locks], s % self.n_locks
+
+    def _find(self, s, key):
+        way = np.flatnonzero((self.keys[s, :, 0] == key[0]) & (self.keys[s, :, 1] == key[1]) & (self.stamps[s] > 0))
+        return int(way[0]) if len(way) else None
+
+    def _touch(self, s, way):
+        self.clocks[s] += 1
+        self.stamps[s, way] = self.clocks[s]
+
+    def get(self, slide, level, x, y, size):
+        # Copy of the cached patch, or None.
+        s, key, lock, stripe = self._locate(slide, level, x, y, size)
+        with lock:
+            way = self._find(s, key)
+            if way is None:
+                self.counters[stripe, 1] += 1
+                return None
+            self._touch(s, way)
+            self.counters[stripe, 0] += 1
+            return self.data[s, way].reshape(self.entry_shape).copy()
+
+    def put(self, slide, level, x, y, size, patch):
+        # Stores a copy of patch; patches of another shape or dtype than the entries are not cached.
+        patch = np.asarray(patch)
+        if patch.shape != self.entry_shape or patch.dtype != np.uint8:
+            return False
+        s, key, lock, stripe = self._locate(slide, level, x, y, size)
+        with lock:
+            way = self._find(s, key)
+            if way is None:
+                way = int(np.argmin(self.stamps[s]))  # an empty entry, or the least recently used one
+                if self.stamps[s, way] > 0:
+                    self.counters[stripe, 2] += 1
+            np.copyto(self.data[s, way], patch.reshape(-1))
+            self.keys[s, way] = key
+            self._touch(s, way)
+        return True
+
+    def stats(self):
+        hits, misses, evictions = (int(n) for n in self.counters.sum(axis=0))
+        entries = int(np.count_nonzero(self.stamps))
+        return {'hits': hits, 'misses': misses, 'evictions': evictions,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.,
+                'entries': entries, 'capacity': self.capacity, 'fill': entries / self.capacity,
+                'GB': self.nbytes / 1024 ** 3}
+
+    def reset_stats(self):
+        for stripe, lock in enumerate(self._locks):
+            with lock:
+                self.counters[stripe] = 0
+
+    def __repr__(self):
+        stats = self.stats()
+        return ('SharedTileCache({GB:.2f} GB, {entries}/{capacity} patches): hit rate {hit_rate:.1%} '
+                '({hits} hits, {misses} misses, {evictions} evictions)').format(**stats)
+
+
+# Caches created by this process, one per patch shape, shared by every DataGenerator (train, val, test).
+_caches = {}
+
+
+def get_shared_tile_cache(budget_bytes, entry_shape):
+    # Must first be called in the main process, before the DataLoader workers start.
+    key = tuple(int(n) for n in entry_shape)
+    cache = _caches.get(key)
+    if cache is None:
+        cache = SharedTileCache(budget_bytes, key)
+        _caches[key] = cache
+    return cache
+
+
+class TileCacheMonitor(Callback):
+    # Logs (and prints) the hit rate of the shared tile caches over each training epoch (including its validation
+    # loop); counters are then reset so that each value covers one epoch.
+    def on_train_epoch_end(self, trainer, pl_module):
+        for cache in _caches.values():
+            stats = cache.stats()
+            if stats['hits'] + stats['misses'] == 0:
+                continue
+            print('Epoch {}: {}'.format(trainer.current_epoch, cache))
+            pl_module.log('tile_cache_hit_rate', stats['hit_rate'])
+            pl_module.log('tile_cache_fill', stats['fill'])
+            cache.reset_stats()
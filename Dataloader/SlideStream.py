@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+from Dataloader.Dataloader import DataGenerator
+from Dataloader.BatchBuffers import collate_tile_batch
+from Dataloader.TileIndex import TileIndex
+from Utils.NativeTileReader import read_region_downsampled
+
+# Whole-slide inference without a tile table.
+#
+# SlideTileStream generates the tile grid of one slide lazily, from its dimensions, in raster or Hilbert order,
+# optionally keeping only the tiles whose centre falls on tissue in a coarse mask. Tiles are grouped in batches of
+# batch_size consecutive tiles (in that order), and batches are dealt round-robin to the DataLoader workers of every
+# DDP rank, so that each batch is read by exactly one (rank, worker), always the same one. Batches are read with the
+# DataGenerator read path (region reads, batched reads, tile cache...) and yielded whole, as (images, coords) where
+# coords is the (B, 2) tensor of (coords_x, coords_y) of the tiles: use the stream with DataLoader(batch_size=None).
+#
+# Only one batch of coordinates exists at a time, so memory does not depend on the slide size, and the first batch
+# is read as soon as the slide is opened.
+
+
+def hilbert_d2xy(n, d):
+    # (x, y) cells of the Hilbert curve of side n (a power of 2) at positions d (numpy array).
+    x = np.zeros_like(d)
+    y = np.zeros_like(d)
+    t = d.copy()
+    s = 1
+    while s < n:
+        rx = 1 & (t // 2)
+        ry = 1 & (t ^ rx)
+        rotate = ry == 0
+        flip = rotate & (rx == 1)
+        x[flip] = s - 1 - x[flip]
+        y[flip] = s - 1 - y[flip]
+        x[rotate], y[rotate] = y[rotate], x[rotate]
+        x += s * rx
+        y += s * ry
+        t //= 4
+        s *= 2
+    return x, y
+
+
+def tissue_mask(WSI_object, downsample=32, bg_threshold=245):
+    # Coarse tissue mask of a slide (True where the grey level is below bg_threshold), at the given downsample, read
+    # with read_region_downsampled (pyramid level or JPEG DCT scaling).
+    img = read_region_downsampled(WSI_object, (0, 0), WSI_object.level_dimensions[0], downsample)
+    img_gray = img[:, :, 0] * 0.2989 + img[:, :, 1] * 0.5870 + img[:, :, 2] * 0.1140
+    return img_gray < bg_threshold
+
+
+class SlideTileStream(IterableDataset):
+    def __init__(self, svs_path, config, transform=None, order='raster', mask=None, mask_downsample=None,
+                 batch_size=None, stride=None, block_size=65536):
+        # mask: optional 2D boolean array covering the slide, mask_downsample level 0 pixels per mask pixel.
+        # stride: grid step in level 0 pixels (defaults to Patch_Size, as lims_to_vec).
+        if order not in ('raster', 'hilbert'):
+            raise ValueError('Unknown tile order {}; use "raster" or "hilbert".'.format(order))
+        self.svs_path        = str(svs_path)
+        self.order           = order
+        self.mask            = None if mask is None else np.asarray(mask, dtype=bool)
+        self.mask_downsample = mask_downsample
+        self.batch_size      = batch_size or config['BASEMODEL']['Batch_Size']
+        self.stride          = stride or config['BASEMODEL']['Patch_Size']
+        self.block_size      = block_size  # grid cells generated at a time
+
+        # Patches are read by a DataGenerator whose index is replaced by each batch of coordinates.
+        empty = pd.DataFrame({'coords_x': np.zeros(0, dtype=int), 'coords_y': np.zeros(0, dtype=int), 'SVS_PATH': []})
+        self.reader = DataGenerator(empty, config=config, transform=transform)
+        self.reader.inference = True
+
+    def _shard(self):
+        # (shard, n_shards) of this DataLoader worker on this rank.
+        worker = get_worker_info()
+        worker_id, n_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        rank, world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        return rank * n_workers + worker_id, world_size * n_workers
+
+    def _cells(self, nx, ny):
+        # Grid cells (ix, iy) in the chosen order, block_size at a time.
+        if self.order == 'raster':
+            rows = max(1, self.block_size // nx)
+            for y0 in range(0, ny, rows):
+                iy, ix = np.divmod(np.arange(y0 * nx, min(ny, y0 + rows) * nx), nx)
+                yield ix, iy
+            return
+        n = 1 << int(np.ceil(np.log2(max(nx, ny, 1))))
+        for d0 in range(0, n * n, self.block_size):
+            ix, iy = hilbert_d2xy(n, np.arange(d0, min(n * n, d0 + self.block_size)))
+            inside = (ix < nx) & (iy < ny)
+            yield ix[inside], iy[inside]
+
+    def _keep(self, x, y):
+        # Tiles whose centre falls on the mask (out-of-mask centres are dropped). Tiles are read centred on their
+        # coordinates (see DataGenerator._tile_start), so (x, y) is the centre.
+        if self.mask is None:
+            return np.ones(len(x), dtype=bool)
+        mx = (x // self.mask_downsample).astype(int)
+        my = (y // self.mask_downsample).astype(int)
+        inside = (mx < self.mask.shape[1]) & (my < self.mask.shape[0])
+        keep = np.zeros(len(x), dtype=bool)
+        keep[inside] = self.mask[my[inside], mx[inside]]
+        return keep
+
+    def batches(self, width, height):
+        # Consecutive batches of (coords_x, coords_y) of the whole grid, in order.
+        nx, ny = -(-width // self.stride[0]), -(-height // self.stride[1])
+        pending_x, pending_y = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        for ix, iy in self._cells(nx, ny):
+            x, y = ix * self.stride[0], iy * self.stride[1]
+            keep = self._keep(x, y)
+            pending_x = np.concatenate([pending_x, x[keep]])
+            pending_y = np.concatenate([pending_y, y[keep]])
+            n_full = len(pending_x) // self.batch_size * self.batch_size
+            for start in range(0, n_full, self.batch_size):
+                yield pending_x[start:start + self.batch_size], pending_y[start:start + self.batch_size]
+            pending_x, pending_y = pending_x[n_full:], pending_y[n_full:]
+        if len(pending_x):
+            yield pending_x, pending_y
+
+    def __iter__(self):
+        shard, n_shards = self._shard()
+        wsi_obj = self.reader._get_wsi_object(self.svs_path)
+        height, width = self.reader.wsi_reader.get_size(wsi_obj, 0)
+        for k, (x, y) in enumerate(self.batches(width, height)):
+            if k % n_shards != shard:
+                continue
+            self.reader.index = TileIndex.from_arrays(x, y, self.svs_path)
+            images = collate_tile_batch(self.reader.__getitems__(np.arange(len(x))))
+            yield images, torch.from_numpy(np.stack([x, y], axis=1))
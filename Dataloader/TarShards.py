@@ -0,0 +1,287 @@
+import io
+import json
+import tarfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+from lightning.pytorch import LightningDataModule
+from Utils.LoaderTuner import get_loader_settings
+
+# Tiles are exported to fixed-size tar shards (WebDataset layout): each sample is a group of consecutive members
+# sharing the same key,
+#   {key}.npy    uint8 array (n_levels, *Patch_Size, 3), stored exactly as DataGenerator hands it to its transform,
+#   {key}.cls    label, as JSON (so that integer and float labels keep their type),
+#   {key}.json   the tile table row (coords, ids, paths).
+# Each split directory also contains shards.json (list of shards and number of samples) and index.csv (tile table with
+# the shard/key of each tile). Shards are read strictly sequentially, which suits network storage much better than
+# millions of small random reads.
+
+SHARDS_FILE = 'shards.json'
+INDEX_FILE = 'index.csv'
+
+
+def _encode_npy(array):
+    buf = io.BytesIO()
+    np.save(buf, array, allow_pickle=False)
+    return buf.getvalue()
+
+
+def _add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _json_value(value):
+    # numpy scalars (e.g. from a DataFrame row) are not JSON serialisable.
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _decode_label(data):
+    # Labels are stored as JSON; shards written before that stored them as plain text.
+    text = data.decode()
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def tile_shards_exist(shard_dir):
+    return Path(shard_dir, SHARDS_FILE).exists()
+
+
+def write_tar_shards(tile_dataset, config, shard_dir, shard_size=1000, num_workers=0):
+    # Reads every tile of tile_dataset through DataGenerator and writes them to shard_dir/shard-XXXXXX.tar.
+    # Tiles are written in a random order, so that each shard already mixes slides.
+    from Dataloader.Dataloader import DataGenerator
+    from Dataloader.BatchBuffers import collate_tile_batch
+
+    shard_dir = Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    tile_dataset = tile_dataset.sample(frac=1, random_state=config['ADVANCEDMODEL']['Random_Seed']).reset_index(drop=True)
+    target = config['DATA']['Label']
+
+    extract_config = {'BASEMODEL': dict(config['BASEMODEL']),
+                      'ADVANCEDMODEL': dict(config['ADVANCEDMODEL'], Inference=True, Device_Transforms=True),
+                      'DATA': dict(config['DATA'])}
+    data = DataLoader(DataGenerator(tile_dataset, config=extract_config),
+                      batch_size=config['BASEMODEL']['Batch_Size'],
+                      num_workers=num_workers,
+                      collate_fn=collate_tile_batch,
+                      shuffle=False)
+
+    shards, tar, n = [], None, 0
+    keys, shard_names = [], []
+    for batch in data:  # raw uint8 (B, n_levels, *Patch_Size, 3)
+        for patches in batch.numpy():
+            if n % shard_size == 0:
+                if tar is not None:
+                    tar.close()
+                shards.append({'name': 'shard-{:06d}.tar'.format(len(shards)), 'n_samples': 0})
+                tar = tarfile.open(shard_dir / (shards[-1]['name'] + '.tmp'), 'w')
+
+            row = tile_dataset.iloc[n]
+            key = '{:09d}'.format(n)
+            _add_member(tar, key + '.npy', _encode_npy(patches))
+            _add_member(tar, key + '.cls', json.dumps(_json_value(row[target])).encode())
+            _add_member(tar, key + '.json', row.to_json().encode())
+            shards[-1]['n_samples'] += 1
+            keys.append(key)
+            shard_names.append(shards[-1]['name'])
+            n += 1
+        print('Exported {}/{} tiles'.format(n, len(tile_dataset)), end='\r')
+    if tar is not None:
+        tar.close()
+    print('')
+
+    for shard in shards:  # shards only become visible once complete
+        Path(shard_dir, shard['name'] + '.tmp').replace(shard_dir / shard['name'])
+    tile_dataset['shard'] = shard_names
+    tile_dataset['key'] = keys
+    tile_dataset.to_csv(shard_dir / INDEX_FILE, index=False)
+    with open(shard_dir / SHARDS_FILE, 'w') as f:
+        json.dump({'shards': shards, 'Vis': config['BASEMODEL']['Vis'], 'Patch_Size': config['BASEMODEL']['Patch_Size'],
+                   'Label': target}, f)
+    print('{} tiles exported to {} shards at {}.'.format(n, len(shards), shard_dir))
+    return str(shard_dir)
+
+
+def load_tile_shards_index(shard_dir):
+    return pd.read_csv(Path(shard_dir, INDEX_FILE), dtype={'key': str})
+
+
+class TarShardDataset(IterableDataset):
+    # Streams samples from tar shards (see write_tar_shards), with the same outputs as DataGenerator.
+    #
+    # Shards are split between DDP ranks and DataLoader workers (shard i goes to stream i % (world_size * num_workers)),
+    # the order of each stream's shards is shuffled every epoch, and samples go through a shuffle buffer of
+    # shuffle_buffer samples. Shards are written in random order by write_tar_shards, so every stream sees a mix of
+    # slides. With fewer shards than streams, the streams sharing a shard take every k-th sample of it.
+    #
+    # Every stream yields the same number of samples (that of the smallest stream, from the sample counts of
+    # shards.json), so that all ranks run the same number of batches: DDP would otherwise wait forever in the
+    # collective of the rank with more batches. The samples left over by larger streams change every epoch with the
+    # order of their shards. Use shards of similar size to keep them few.
+
+    def __init__(self, shard_dir, config=None, transform=None, target_transform=None, label_encoder=None,
+                 shuffle_buffer=1000, shuffle=True):
+
+        super().__init__()
+        self.shard_dir        = Path(shard_dir)
+        self.transform        = transform
+        self.target_transform = target_transform
+        self.label_encoder    = label_encoder
+        self.inference        = config['ADVANCEDMODEL']['Inference']
+        self.uint8_output     = config['ADVANCEDMODEL'].get('Device_Transforms', False)
+        self.shuffle          = shuffle
+        self.shuffle_buffer   = shuffle_buffer if shuffle else 1
+        self.seed             = config['ADVANCEDMODEL']['Random_Seed']
+        self.epoch            = 0
+        self._iterations      = 0
+
+        with open(self.shard_dir / SHARDS_FILE) as f:
+            meta = json.load(f)
+        self.shards   = [shard['name'] for shard in meta['shards']]
+        self.shard_samples = [shard['n_samples'] for shard in meta['shards']]
+        self.n_samples = sum(self.shard_samples)
+
+    def _world(self):
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
+
+    def __len__(self):
+        # Number of samples seen by one rank with a single DataLoader worker (used by Lightning for progress bars).
+        _, world_size = self._world()
+        return self._stream_cap(world_size)
+
+    def _stream_assignment(self, stream, n_streams):
+        # (shard indices, stride, offset) of a stream: it keeps sample i of each of its shards if i % stride == offset.
+        n_shards = len(self.shards)
+        if n_shards >= n_streams:
+            return list(range(stream, n_shards, n_streams)), 1, 0
+        shard = stream % n_shards
+        return [shard], len(range(shard, n_streams, n_shards)), stream // n_shards
+
+    def _stream_cap(self, n_streams):
+        # Samples yielded by every stream: the number of samples of the smallest one.
+        counts = []
+        for stream in range(n_streams):
+            shards, stride, offset = self._stream_assignment(stream, n_streams)
+            counts.append(sum(len(range(offset, self.shard_samples[i], stride)) for i in shards))
+        return min(counts) if counts else 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _my_shards(self):
+        rank, world_size = self._world()
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers, epoch_seed = 0, 1, self._iterations
+            self._iterations += 1
+        else:  # the DataLoader draws a new base seed (seed - id) at every epoch
+            worker_id, num_workers, epoch_seed = worker_info.id, worker_info.num_workers, worker_info.seed - worker_info.id
+
+        # Fixed assignment of shards to streams, so that streams are always disjoint; only the order of each
+        # stream's shards and the shuffle buffer change from one epoch to the next.
+        stream, n_streams = rank * num_workers + worker_id, world_size * num_workers
+        shards, stride, offset = self._stream_assignment(stream, n_streams)
+        rng = np.random.default_rng([self.seed, self.epoch, stream, epoch_seed % 2**32])
+        if self.shuffle:
+            shards = [shards[i] for i in rng.permutation(len(shards))]
+        return [self.shards[i] for i in shards], stride, offset, self._stream_cap(n_streams), rng
+
+    def _shard_samples(self, shard):
+        with tarfile.open(self.shard_dir / shard, 'r|') as tar:  # streaming mode: one sequential read
+            key, sample = None, {}
+            for member in tar:
+                cur_key, ext = member.name.split('.', 1)
+                if key is not None and cur_key != key:
+                    yield sample
+                    sample = {}
+                key = cur_key
+                sample[ext] = tar.extractfile(member).read()
+            if sample:
+                yield sample
+
+    def _samples(self, shards, stride=1, offset=0, cap=None):
+        # Samples i % stride == offset of the shards, cap at most.
+        n = 0
+        for shard in shards:
+            for i, sample in enumerate(self._shard_samples(shard)):
+                if cap is not None and n >= cap:
+                    return
+                if i % stride == offset:
+                    yield sample
+                    n += 1
+
+    def _decode(self, sample):
+        tile = np.load(io.BytesIO(sample['npy']), allow_pickle=False)
+        if self.uint8_output:  # augmentation and normalisation are applied on device, see ConvNet
+            patches = torch.from_numpy(tile)
+        else:
+            patches = torch.empty((tile.shape[0], 3, tile.shape[1], tile.shape[2]))
+            for i in range(tile.shape[0]):
+                patch = tile[i]
+                if self.transform:
+                    patch = self.transform(patch)
+                patches[i] = patch
+
+        if self.inference:
+            return patches
+
+        label = _decode_label(sample['cls'])
+        if self.label_encoder is not None:
+            label = self.label_encoder.transform([label])[0]
+        if self.target_transform:
+            label = self.target_transform(label)
+        return patches, label
+
+    def __iter__(self):
+        shards, stride, offset, cap, rng = self._my_shards()
+        buffer = []
+        for sample in self._samples(shards, stride, offset, cap):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = rng.integers(len(buffer))
+            buffer[i], sample = sample, buffer[i]
+            yield self._decode(sample)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self._decode(sample)
+
+
+class ShardDataModule(LightningDataModule):
+    # DataModule streaming the train/val/test splits exported with write_tar_shards under config['DATA']['Tile_Shards'].
+    def __init__(self, config, train_transform=None, val_transform=None, label_encoder=None, num_workers=None,
+                 shuffle_buffer=1000):
+        super().__init__()
+        self.batch_size  = config['BASEMODEL']['Batch_Size']
+        shard_dir = Path(config['DATA']['Tile_Shards'])
+
+        self.train_data = TarShardDataset(shard_dir / 'train', config=config, transform=train_transform,
+                                          label_encoder=label_encoder, shuffle_buffer=shuffle_buffer)
+        self.val_data   = TarShardDataset(shard_dir / 'val', config=config, transform=val_transform,
+                                          label_encoder=label_encoder, shuffle=False)
+        self.test_data  = TarShardDataset(shard_dir / 'test', config=config, transform=val_transform,
+                                          label_encoder=label_encoder, shuffle=False)
+
+        # num_workers=None: tuned or default settings, see Utils.LoaderTuner.
+        if num_workers is None:
+            self.loader_settings = get_loader_settings(config, self.train_data)
+        else:
+            self.loader_settings = {'num_workers': num_workers, 'pin_memory': False}
+
+    def train_dataloader(self):
+        return DataLoader(self.train_data, batch_size=self.batch_size, **self.loader_settings)
+
+    def val_dataloader(self):
+        return DataLoader(self.val_data, batch_size=self.batch_size, **self.loader_settings)
+
+    def test_dataloader(self):
+        return DataLoader(self.test_data, batch_size=self.batch_size, **self.loader_settings)
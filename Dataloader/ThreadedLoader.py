@@ -0,0 +1,136 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import torch.distributed as dist
+from torch.utils.data import BatchSampler, DistributedSampler, RandomSampler, SequentialSampler
+from Dataloader.BatchBuffers import collate_tile_batch
+from Utils.LoaderTuner import available_cpus
+from Dataloader.Samplers import RankShardSampler
+
+# In-process alternative to DataLoader worker processes.
+#
+# openslide, cuCIM and the tifffile/imagecodecs decoders release the GIL while reading and decoding, so tile reads
+# scale with threads as well as with processes. Worker processes, however, each hold a copy of the dataset (tile
+# table, transforms) and their own slide handles and decoded-tile caches. ThreadedLoader runs the batches of a
+# dataset (DataGenerator, TileStoreDataset, or any map-style dataset) on a pool of num_threads threads of the main
+# process, with at most prefetch batches in flight, and yields them in order. All threads use the same process-wide
+# slide pool (see Utils.SlidePool), so each slide is opened once.
+#
+# ThreadedLoader is iterable and has len(), batch_size, dataset, sampler and batch_sampler like a DataLoader, so that
+# it can be returned by a LightningDataModule. Under torch.distributed, tiles are split across ranks with a
+# DistributedSampler, or, when a sampler is given (e.g. SlideBlockSampler), by sharding its indices between ranks
+# (RankShardSampler): Lightning does not replace the sampler of a loader that is not a DataLoader.
+
+
+class ThreadedLoader:
+    def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, drop_last=False, num_threads=None,
+                 prefetch=None, collate_fn=collate_tile_batch, pin_memory=False, seed=0):
+        self.dataset     = dataset
+        self.batch_size  = batch_size
+        self.num_threads = available_cpus() if num_threads is None else int(num_threads)
+        self.prefetch    = 2 * self.num_threads if prefetch is None else max(1, int(prefetch))
+        self.collate_fn  = collate_fn
+        self.pin_memory  = pin_memory and torch.cuda.is_available()
+        self.shuffle     = shuffle
+        self.drop_last   = drop_last
+        self.seed        = seed
+        self._sampler    = sampler
+        self._default_sampler = sampler is None
+        self._rank_sampler = None  # sampler sharded between ranks, under torch.distributed
+
+        # Batches are allocated in the main process: pinned directly when possible (see Dataloader.BatchBuffers).
+        if hasattr(dataset, 'pin_batch_buffers'):
+            dataset.pin_batch_buffers = self.pin_memory
+
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def sampler(self):
+        # The default sampler (or the sharding of a given one) is only built when first needed: the Trainer
+        # initialises torch.distributed after the loader has been created.
+        distributed = dist.is_available() and dist.is_initialized()
+        if not self._default_sampler:
+            if not distributed or dist.get_world_size() == 1:
+                return self._sampler
+            if self._rank_sampler is None:
+                self._rank_sampler = RankShardSampler(self._sampler)
+            return self._rank_sampler
+        if (self._sampler is None or distributed != isinstance(self._sampler, DistributedSampler)):
+            if distributed:
+                self._sampler = DistributedSampler(self.dataset, shuffle=self.shuffle, seed=self.seed, drop_last=self.drop_last)
+            elif self.shuffle:
+                self._sampler = RandomSampler(self.dataset)
+            else:
+                self._sampler = SequentialSampler(self.dataset)
+        return self._sampler
+
+    @property
+    def batch_sampler(self):
+        return BatchSampler(self.sampler, self.batch_size, self.drop_last)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # The thread pool is kept across epochs.
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.num_threads, thread_name_prefix='ThreadedLoader')
+            return self._executor
+
+    def _fetch(self, ids):
+        if hasattr(self.dataset, '__getitems__'):
+            batch = self.dataset.__getitems__(ids)
+        else:
+            batch = [self.dataset[id] for id in ids]
+        batch = self.collate_fn(batch)
+        if self.pin_memory and not getattr(self.dataset, 'pin_batch_buffers', False):
+            batch = _pin(batch)
+        return batch
+
+    def __iter__(self):
+        executor = self._get_executor()
+        batches = iter(self.batch_sampler)
+        pending = deque()
+        try:
+            for ids in batches:
+                pending.append(executor.submit(self._fetch, ids))
+                if len(pending) >= self.prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Iteration stopped early (break, exception): drop the batches that have not started.
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+
+    def __del__(self):
+        executor = getattr(self, '_executor', None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def _pin(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch.pin_memory()
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_pin(b) for b in batch)
+    return batch
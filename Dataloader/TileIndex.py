@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+
+class TileIndex:
+    """
+    Frozen, array-backed view of a tile table, for use in Dataset.__getitem__.
+
+    Indexing a DataFrame per item (tile_dataset['SVS_PATH'].iloc[id]) costs several microseconds of pandas overhead,
+    and object columns hold one Python object per tile: every forked DataLoader worker touching them updates their
+    refcounts, which slowly copies the whole table into each worker (copy-on-write). The index is therefore frozen at
+    construction into contiguous numpy arrays that contain no Python objects:
+        slide_ids    int32 (N,), positions into slide_paths,
+        slide_paths  fixed-width unicode array with one entry per slide,
+        coords_x/y   int32 (N,),
+        labels       (N,) numeric labels, or int32 codes into label_values for text labels.
+    """
+
+    def __init__(self, tile_dataset, label=None):
+        codes, paths = pd.factorize(tile_dataset['SVS_PATH'], sort=False)
+        self.slide_ids   = codes.astype(np.int32)
+        self.slide_paths = np.array([str(p) for p in paths], dtype=str)
+        self.coords_x    = tile_dataset['coords_x'].to_numpy(dtype=np.int32)
+        self.coords_y    = tile_dataset['coords_y'].to_numpy(dtype=np.int32)
+
+        self.labels, self.label_values = None, None
+        if label is not None and label in tile_dataset.columns:
+            labels = tile_dataset[label]
+            if pd.api.types.is_numeric_dtype(labels) and not isinstance(labels.dtype, pd.CategoricalDtype):
+                self.labels = labels.to_numpy()
+            else:
+                codes, values = pd.factorize(labels, sort=False)
+                values = np.asarray(values)
+                if (codes == -1).any():  # missing labels: code -1 would index the last label, give them their own
+                    codes = np.where(codes == -1, len(values), codes)
+                    values = np.append(values.astype(object), np.nan)
+                self.labels       = codes.astype(np.int32)
+                self.label_values = values
+
+    @classmethod
+    def from_arrays(cls, coords_x, coords_y, svs_path):
+        # Unlabelled index of tiles of a single slide, built without a DataFrame (see Dataloader.SlideStream).
+        index = cls.__new__(cls)
+        index.slide_ids   = np.zeros(len(coords_x), dtype=np.int32)
+        index.slide_paths = np.array([str(svs_path)], dtype=str)
+        index.coords_x    = np.asarray(coords_x, dtype=np.int32)
+        index.coords_y    = np.asarray(coords_y, dtype=np.int32)
+        index.labels, index.label_values = None, None
+        return index
+
+    def __len__(self):
+        return len(self.slide_ids)
+
+    def svs_path(self, id):
+        return str(self.slide_paths[self.slide_ids[id]])
+
+    def label(self, id):
+        if self.label_values is not None:
+            return self.label_values[self.labels[id]]
+        return self.labels[id]
@@ -0,0 +1,149 @@
+import json
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+from Dataloader.TileIndex import TileIndex
+from Dataloader.BatchBuffers import allocate_batch_buffer, TileBatch, collate_tile_batch
+
+# A tile store is a directory containing:
+#   tiles.u8    raw uint8 array of shape (N, n_levels, *Patch_Size, 3), one contiguous chunk per tile, read with np.memmap.
+#   index.csv   the tile table (one row per tile, in store order), with a 'store_index' column pointing into tiles.u8.
+#   store.json  array shape/dtype and the BASEMODEL parameters used for the extraction.
+#
+# Patches are stored exactly as DataGenerator hands them to its transform, so a TileStoreDataset with the same
+# transform returns the same tensors as a DataGenerator, without decoding any JPEG or opening any SVS file.
+
+TILES_FILE = 'tiles.u8'
+INDEX_FILE = 'index.csv'
+META_FILE = 'store.json'
+
+
+def tile_store_exists(store_dir):
+    return all(Path(store_dir, f).exists() for f in [TILES_FILE, INDEX_FILE, META_FILE])
+
+
+def build_tile_store(tile_dataset, config, store_dir, num_workers=0):
+    # Extracts every tile of tile_dataset (all levels of config['BASEMODEL']['Vis']) once into store_dir.
+    from Dataloader.Dataloader import DataGenerator
+
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    tile_dataset = tile_dataset.reset_index(drop=True)
+
+    extract_config = {'BASEMODEL': dict(config['BASEMODEL']),
+                      'ADVANCEDMODEL': dict(config['ADVANCEDMODEL'], Inference=True, Device_Transforms=True),
+                      'DATA': dict(config['DATA'])}
+    data = DataLoader(DataGenerator(tile_dataset, config=extract_config),
+                      batch_size=config['BASEMODEL']['Batch_Size'],
+                      num_workers=num_workers,
+                      collate_fn=collate_tile_batch,
+                      shuffle=False)
+
+    patch_size = config['BASEMODEL']['Patch_Size']
+    shape = (len(tile_dataset), len(config['BASEMODEL']['Vis']), patch_size[0], patch_size[1], 3)
+    tiles = np.memmap(store_dir / (TILES_FILE + '.tmp'), dtype=np.uint8, mode='w+', shape=shape)
+
+    n = 0
+    for batch in data:  # raw uint8 (B, n_levels, *Patch_Size, 3)
+        tiles[n:n + len(batch)] = batch.numpy()
+        n += len(batch)
+        print('Extracted {}/{} tiles'.format(n, len(tile_dataset)), end='\r')
+    tiles.flush()
+    del tiles
+    print('')
+
+    tile_dataset['store_index'] = np.arange(len(tile_dataset))
+    tile_dataset.to_csv(store_dir / INDEX_FILE, index=False)
+    with open(store_dir / META_FILE, 'w') as f:
+        json.dump({'shape': list(shape), 'dtype': 'uint8', 'Vis': config['BASEMODEL']['Vis'],
+                   'Patch_Size': patch_size}, f)
+    Path(store_dir, TILES_FILE + '.tmp').replace(store_dir / TILES_FILE)  # the store only becomes visible when complete
+    print('Tile store exported at {}.'.format(store_dir))
+    return str(store_dir)
+
+
+def load_tile_store_index(store_dir):
+    return pd.read_csv(Path(store_dir, INDEX_FILE))
+
+
+class TileStoreDataset(torch.utils.data.Dataset):
+    # Drop-in replacement for DataGenerator reading pre-extracted tiles from a tile store (see build_tile_store).
+    # tile_dataset is a subset of the store index, so it can go through the same sampling/splitting as DataGenerator.
+
+    def __init__(self, tile_dataset, config=None, transform=None, target_transform=None):
+
+        super().__init__()
+        self.transform        = transform
+        self.target_transform = target_transform
+        self.tile_dataset     = tile_dataset
+        self.inference        = config['ADVANCEDMODEL']['Inference']
+        self.uint8_output     = config['ADVANCEDMODEL'].get('Device_Transforms', False)
+        self.target           = config['DATA']['Label']
+        self.store_dir        = Path(config['DATA']['Tile_Store'])
+
+        with open(self.store_dir / META_FILE) as f:
+            self.meta = json.load(f)
+        if self.meta['Vis'] != list(config['BASEMODEL']['Vis']) or self.meta['Patch_Size'] != list(config['BASEMODEL']['Patch_Size']):
+            raise ValueError('Tile store {} was built with Vis={}, Patch_Size={}.'.format(self.store_dir, self.meta['Vis'], self.meta['Patch_Size']))
+        self.store_index = tile_dataset['store_index'].to_numpy()
+        self.index       = TileIndex(tile_dataset, label=None if self.inference else self.target)
+        self._tiles = None
+        self.pin_batch_buffers = False  # set by DataModule when the DataLoader pins memory in the main process
+
+    def __len__(self):
+        return len(self.store_index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tiles'] = None  # never pickle the memmap, each worker opens its own
+        return state
+
+    @property
+    def tiles(self):
+        if self._tiles is None:
+            self._tiles = np.memmap(self.store_dir / TILES_FILE, dtype=np.uint8, mode='r', shape=tuple(self.meta['shape']))
+        return self._tiles
+
+    def _transform_tile(self, tile, patches):
+        for i in range(tile.shape[0]):
+            patch = tile[i]
+            if self.transform:
+                patch = self.transform(patch)
+            patches[i] = patch
+
+    def _format_output(self, id, patches):
+        if self.inference:
+            return patches
+        else:
+            label = self.index.label(id)
+            if self.target_transform:
+                label = self.target_transform(label)
+
+            return patches, label
+
+    def __getitem__(self, id):
+        tile = np.array(self.tiles[self.store_index[id]])  # (n_levels, *Patch_Size, 3): a single copy, no decode
+        if self.uint8_output:  # augmentation and normalisation are applied on device, see ConvNet
+            patches = torch.from_numpy(tile)
+        else:
+            patches = torch.empty((tile.shape[0], 3, tile.shape[1], tile.shape[2]))
+            self._transform_tile(tile, patches)
+        return self._format_output(id, patches)
+
+    def __getitems__(self, ids):
+        # Whole batch written in place into one preallocated tensor (see Dataloader.BatchBuffers): in uint8 mode, each
+        # tile is copied once, from the memmap straight into the batch.
+        n_levels, h, w, c = self.meta['shape'][1:]
+        if self.uint8_output:
+            patches = allocate_batch_buffer((len(ids), n_levels, h, w, c), torch.uint8, pin_memory=self.pin_batch_buffers)
+            out = patches.numpy()
+            for n, id in enumerate(ids):
+                out[n] = self.tiles[self.store_index[id]]
+        else:
+            patches = allocate_batch_buffer((len(ids), n_levels, c, h, w), torch.float32, pin_memory=self.pin_batch_buffers)
+            for n, id in enumerate(ids):
+                self._transform_tile(np.array(self.tiles[self.store_index[id]]), patches[n])
+        samples = [self._format_output(id, patches[n]) for n, id in enumerate(ids)]
+        return TileBatch(samples, patches, None if self.inference else [sample[1] for sample in samples])
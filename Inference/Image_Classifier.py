@@ -4,7 +4,10 @@ from torchvision import transforms
 from QA.Normalization.Colour import ColourNorm
 from Model.ConvNet import ConvNet
 from Utils import MultiGPUTools
-import multiprocessing as mp
+from Utils.LoaderTuner import get_loader_settings
+from Utils.TileQuery import TileQuery
+from Utils.PredictionWriter import PredictionWriter, read_predictions
+from Dataloader.ThreadedLoader import ThreadedLoader
 from pathlib import Path
 from Dataloader.Dataloader import *
 
@@ -24,20 +27,14 @@ print(SVS_dataset)
 
 # Load pre-processed dataset. It should have been pre-processed (tissue type identification) first.
 print('Loading file parameters...', end='')
-tile_dataset = LoadFileParameter(config, SVS_dataset)
-tile_dataset_full = tile_dataset.copy()  # keep the full tile_dataset for final saving, but only process the reduced.
-valid_tumour_tiles_index = tile_dataset_full['prob_tissue_type_Tumour'] > 0.94
-tile_dataset = tile_dataset.loc[valid_tumour_tiles_index]
+# Only tumour tiles are read; results are appended to the tile tables, so other tiles do not need to be loaded.
+tile_dataset = TileQuery(SVS_dataset).where('prob_tissue_type_Tumour', '>', 0.94).collect()
 
 print('Done.')
 
 ########################################################################################################################
 # 3. Model + dataloader
 
-# Pad tile_dataset such that the final batch size can be divided by n_gpus.
-n_pad = MultiGPUTools.pad_size(len(tile_dataset), n_gpus, config['BASEMODEL']['Batch_Size'])
-tile_dataset = MultiGPUTools.pad_dataframe(tile_dataset, n_pad)
-
 pl.seed_everything(config['ADVANCEDMODEL']['Random_Seed'], workers=True)
 
 val_transform = transforms.Compose([
@@ -45,18 +42,40 @@ val_transform = transforms.Compose([
     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
 ])
 
-data = DataLoader(DataGenerator(tile_dataset, transform=val_transform, target=config['DATA']['Label'], inference=True),
-                  batch_size=config['BASEMODEL']['Batch_Size'],
-                  num_workers=int(.8 * mp.Pool()._processes),
-                  persistent_workers=True,
-                  shuffle=False,
-                  pin_memory=True)
+# Each GPU predicts a contiguous range of tiles (no padding); predictions are merged by tile index after prediction.
+# Reader, slide pool, caches and patch settings come from the config, as in training; tiles are read without labels.
+inference_config = dict(config, ADVANCEDMODEL=dict(config['ADVANCEDMODEL'], Inference=True))
+dataset = DataGenerator(tile_dataset, config=inference_config, transform=val_transform)
+indexed_dataset = MultiGPUTools.IndexedDataset(dataset, collate_fn=collate_tile_batch)
+sampler = MultiGPUTools.ContiguousDistributedSampler(dataset)
+if config['ADVANCEDMODEL'].get('Loader_Threads', None):  # batches read by threads of the main process
+    data = ThreadedLoader(indexed_dataset,
+                          batch_size=config['BASEMODEL']['Batch_Size'],
+                          sampler=sampler,
+                          num_threads=config['ADVANCEDMODEL']['Loader_Threads'],
+                          prefetch=config['ADVANCEDMODEL'].get('Loader_Prefetch', None),
+                          collate_fn=indexed_dataset.collate,
+                          pin_memory=True)
+else:
+    data = DataLoader(indexed_dataset,
+                      batch_size=config['BASEMODEL']['Batch_Size'],
+                      sampler=sampler,
+                      collate_fn=indexed_dataset.collate,
+                      **get_loader_settings(config, dataset, shuffle=False))
+
+# Probabilities are written to disk batch by batch, per slide and per GPU, instead of being kept in memory.
+prediction_folder = Path(config['DATA'].get('Prediction_Folder', Path(config['DATA']['SVS_Folder'], 'predictions')))
+prediction_writer = PredictionWriter(prediction_folder,
+                                     slides=tile_dataset.id_external,
+                                     tile_ids=tile_dataset.index,
+                                     prefix='prob_' + config['DATA']['Label'] + '_')
 
 trainer = pl.Trainer(gpus=n_gpus,
                      strategy='ddp',
                      benchmark=False,
+                     replace_sampler_ddp=False,
                      precision=config['BASEMODEL']['Precision'],
-                     callbacks=[pl.callbacks.TQDMProgressBar(refresh_rate=1)])
+                     callbacks=[pl.callbacks.TQDMProgressBar(refresh_rate=1), prediction_writer])
 
 model = ConvNet.load_from_checkpoint(config['CHECKPOINT']['Model_Save_Path'])
 model.eval()
@@ -64,30 +83,22 @@ model.eval()
 ########################################################################################################################
 # 4. Predict
 
-predictions = trainer.predict(model, data)
-ordered_preds = MultiGPUTools.reorder_predictions(predictions)  # reorder if processing was done on multiple GPUs
-predicted_classes_prob = torch.Tensor.cpu(torch.cat(ordered_preds))
-
-# Drop padding
-tile_dataset = tile_dataset.iloc[:-n_pad]
-predicted_classes_prob = predicted_classes_prob[:-n_pad]
+trainer.predict(model, data, return_predictions=False)
 
 ########################################################################################################################
 # 5. Save locally (no upload to OMERO for the sarcoma classification yet)
 
 print('Saving sarcoma classification results locally to npy files...')
 
-mesenchymal_tumour_names = model.LabelEncoder.inverse_transform(np.arange(predicted_classes_prob.shape[1]))
-
-# Append tumour type probabilities to tumour tiles.
-for tumour_no, tumour_name in enumerate(mesenchymal_tumour_names):
-    curkey = 'prob_' + config['DATA']['Label'] + '_' + tumour_name
-    tile_dataset_full[curkey] = np.nan
-    tile_dataset_full.loc[valid_tumour_tiles_index, curkey] = pd.Series(predicted_classes_prob[:, tumour_no], index=tile_dataset.index)
-
-for id_external, df_split in tile_dataset_full.groupby(tile_dataset_full.id_external):
-    npy_path = SaveFileParameter(config, df_split, str(id_external))
-    print('File exported at {}.'.format(npy_path))
+# Tumour type probabilities of tumour tiles (other tiles read as NaN) are merged slide by slide, and only the new
+# columns are written, as separate column files (see AppendFileParameter), by a single rank.
+if trainer.is_global_zero:
+    for id_external in tile_dataset.id_external.unique():
+        results = read_predictions(prediction_folder, id_external)
+        if results is None:
+            continue
+        results_path = AppendFileParameter(config, results, str(id_external), name=config['DATA']['Label'])
+        print('Results exported at {}.'.format(results_path))
 
 print('Done.')
 
@@ -10,6 +10,7 @@ from QA.Normalization.Colour import ColourNorm
 from Model.ConvNet import ConvNet
 from Dataloader.ObjectDetection import *
 from Utils import MultiGPUTools
+from Utils.PredictionWriter import PredictionWriter, read_predictions
 import pandas as pd
 import numpy as np
 
@@ -60,42 +61,37 @@ for count, SVS_ID in enumerate(SVS_IDs):
     print('Processing {}/{}: {}'.format(count, len(SVS_IDs), SVS_ID))
     print(slidedataset)
 
-    n_pad = MultiGPUTools.pad_size(len(slidedataset), n_gpus, config['BASEMODEL']['Batch_Size'])
-    slidedataset = MultiGPUTools.pad_dataframe(slidedataset, n_pad)
-
-    data = DataLoader(MixDataset(slidedataset,
-                                 masked_input=config['DATA']['masked_input'],
-                                 wsi_folder=config['DATA']['SVS_Folder'],
-                                 mask_folder=config['DATA']['Mask_Folder'],
-                                 data_source=config['DATA']['data_source'],
-                                 dim=(64, 64),
-                                 vis_level=0,
-                                 channels=3,
-                                 transform=val_transform,
-                                 inference=True),
+    # Each GPU classifies a contiguous range of cells (no padding); predictions are merged by index afterwards.
+    dataset = MultiGPUTools.IndexedDataset(MixDataset(slidedataset,
+                                                      masked_input=config['DATA']['masked_input'],
+                                                      wsi_folder=config['DATA']['SVS_Folder'],
+                                                      mask_folder=config['DATA']['Mask_Folder'],
+                                                      data_source=config['DATA']['data_source'],
+                                                      dim=(64, 64),
+                                                      vis_level=0,
+                                                      channels=3,
+                                                      transform=val_transform,
+                                                      inference=True))
+    data = DataLoader(dataset,
                       num_workers=config['BASEMODEL']['Num_of_Worker'],
                       persistent_workers=True,
                       batch_size=config['BASEMODEL']['Batch_Size'],
-                      shuffle=False,
+                      sampler=MultiGPUTools.ContiguousDistributedSampler(dataset),
+                      collate_fn=dataset.collate,
                       pin_memory=True,)
 
+    # Probabilities are written to disk batch by batch (see Utils.PredictionWriter) instead of being kept in memory.
+    prediction_folder = config['DATA']['Detection_Path'] + 'predictions'
     trainer = pl.Trainer(accelerator='gpu', devices=[0,1,2,3],
                          strategy='ddp_find_unused_parameters_false',
                          benchmark=True,
+                         replace_sampler_ddp=False,
                          precision=config['BASEMODEL']['Precision'],
-                         callbacks=[pl.callbacks.TQDMProgressBar(refresh_rate=1)])
+                         callbacks=[pl.callbacks.TQDMProgressBar(refresh_rate=1),
+                                    PredictionWriter(prediction_folder, slide_name=SVS_ID)])
 
-    predictions = trainer.predict(model, data)
-    predictions = MultiGPUTools.reorder_predictions(predictions)  # reorder if processing was done on multiple GPUs
-    predicted_classes_prob = torch.Tensor.cpu(torch.cat(predictions))
-
-    slidedataset = slidedataset.iloc[:-n_pad]
-    predicted_classes_prob = predicted_classes_prob[:-n_pad]
-
-    classes = model.LabelEncoder.inverse_transform(np.arange(predicted_classes_prob.shape[1]))
-    for i, class_name in enumerate(classes):
-        slidedataset['prob_' + str(class_name)] = pd.Series(predicted_classes_prob[:, i], index=slidedataset.index)
-        tile_dataset = slidedataset.fillna(0)
+    trainer.predict(model, data, return_predictions=False)
+    slidedataset = slidedataset.join(read_predictions(prediction_folder, SVS_ID))
 
     slidedataset.to_csv(config['DATA']['Detection_Path'] + '{}_classification_coords.csv'.format(SVS_ID),index=False)
     df_list.append(slidedataset)
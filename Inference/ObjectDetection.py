@@ -20,6 +20,7 @@ from Model.MaskRCNN import MaskFRCNN
 
 from Dataloader.Dataloader import *
 from Utils import MultiGPUTools
+from Utils.TileQuery import TileQuery
 import pytorch_lightning as pl
 from Utils.PredsAnalyzeTools import Preds2Results
 
@@ -55,19 +56,10 @@ else:
 
     print('Loading file parameters...', end='')
 
-    error_list = []
-    for count, SVS_ID in enumerate(SVS_dataset['id_internal'].unique()):
-        SVS_dataset_temp = SVS_dataset[SVS_dataset['id_internal']==SVS_ID]
-        try:
-            tile_dataset_temp = LoadFileParameter(config, SVS_dataset_temp)
-        except Exception as e:
-            print(str(e))
-            error_list.append(SVS_ID)
-
-    SVS_dataset = SVS_dataset[~SVS_dataset['id_internal'].isin(error_list)]
-    tile_dataset = LoadFileParameter(config, SVS_dataset)
-
-    tile_dataset = tile_dataset[tile_dataset['prob_tissue_type_Tumour'] > 0.85]  # keep only tumour tiles
+    # keep only tumour tiles, filtered slide by slide as they are read; unreadable slides are skipped.
+    query = TileQuery(SVS_dataset, skip_errors=True).where('prob_tissue_type_Tumour', '>', 0.85)
+    tile_dataset = query.collect()
+    SVS_dataset = SVS_dataset[~SVS_dataset['NPY_PATH'].isin(query.failed)]
     print('Done.')
     print(tile_dataset)
     tile_dataset['num_objs'] = [0] * tile_dataset.shape[0]
@@ -13,6 +13,7 @@ import matplotlib.pyplot as plt
 import io
 from PIL import Image
 from torchvision import models, transforms
+from QA.Normalization.Colour.ColourAugment import ColourAugment
 
 class ConvNet(L.LightningModule):
     def __init__(self, config, label_encoder=None):
@@ -45,6 +46,15 @@ class ConvNet(L.LightningModule):
             self.models.append(backbone)
             self.add_module(f"model_{zoom_level}", self.models[zoom_level])
 
+        # With Device_Transforms, the dataloader returns raw uint8 patches and the augmentations of
+        # Training/Image_Classifier.get_transforms are applied here, on the whole batch (see on_after_batch_transfer).
+        self.device_transforms = self.config['ADVANCEDMODEL'].get('Device_Transforms', False)
+        if self.device_transforms:
+            self.colour_augment = ColourAugment(sigma=self.config['AUGMENTATION']['Colour_Sigma'], mode=self.config['AUGMENTATION']['Colour_Mode'])
+            self.flip_p = 0.4
+            self.norm_mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 1, 3, 1, 1)
+            self.norm_std  = torch.tensor([0.229, 0.224, 0.225]).view(1, 1, 3, 1, 1)
+
         self.classifier = nn.Sequential(
             nn.Linear(out_feats * len(config['BASEMODEL']['Vis']), 512),
             nn.Linear(512, self.config["DATA"]["N_Classes"]),
@@ -60,6 +70,31 @@ class ConvNet(L.LightningModule):
         aggregated_features = torch.cat(aggregated_features, dim=1)
         return self.classifier(aggregated_features)
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if not self.device_transforms:
+            return batch
+        if isinstance(batch, (list, tuple)):
+            return [self.device_transform(batch[0]), *batch[1:]]
+        return self.device_transform(batch)
+
+    def device_transform(self, images):
+        # images: raw uint8 (B, n_levels, H, W, 3) batch. Returns the normalised (B, n_levels, 3, H, W) float batch,
+        # with flips and colour augmentation drawn independently for each patch when training.
+        if images.dtype != torch.uint8:  # already transformed by the dataloader
+            return images
+        images = images.permute(0, 1, 4, 2, 3).float() / 255
+        if self.training:
+            b, n_levels, c, h, w = images.shape
+            images = self.colour_augment.forward_batch(images.reshape(b * n_levels, c, h, w))
+            flip_h = torch.rand(b * n_levels, 1, 1, 1, device=images.device) < self.flip_p
+            flip_v = torch.rand(b * n_levels, 1, 1, 1, device=images.device) < self.flip_p
+            images = torch.where(flip_h, images.flip(-1), images)
+            images = torch.where(flip_v, images.flip(-2), images)
+            images = images.reshape(b, n_levels, c, h, w)
+        mean = self.norm_mean.to(images.device)
+        std = self.norm_std.to(images.device)
+        return (images - mean) / std
+
     def training_step(self, train_batch, batch_idx):
         image_dict, labels = train_batch
         logits = self.forward(image_dict)
@@ -93,6 +128,11 @@ class ConvNet(L.LightningModule):
         return {"loss": loss, "preds": preds, "labels": labels}
     
     def predict_step(self, batch, batch_idx, dataloader_idx=0):
+        if isinstance(batch, (list, tuple)):
+            # (images, coords) batches of a SlideTileStream, or (images, indices) batches of an IndexedDataset (see
+            # Utils.MultiGPUTools): each rank reads its own tiles, so outputs stay local and are merged afterwards.
+            image_dict, ids = batch
+            return softmax(self(image_dict), dim=1), ids
         image_dict = batch
         output     = softmax(self(image_dict), dim=1)
         return self.all_gather(output)
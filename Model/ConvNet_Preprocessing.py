@@ -91,6 +91,11 @@ class ConvNet_Preprocessing(L.LightningModule):
         np.save(self.logger.log_dir+"/ROC.npy",out_dict)
 
     def predict_step(self, batch, batch_idx, dataloader_idx=0):
+        if isinstance(batch, (list, tuple)):
+            # (images, coords) batches of a SlideTileStream, or (images, indices) batches of an IndexedDataset (see
+            # Utils.MultiGPUTools): each rank reads its own tiles, so outputs stay local and are merged afterwards.
+            image, ids = batch
+            return softmax(self(image), dim=1), ids
         image  = batch
         output = softmax(self(image), dim=1)
         return self.all_gather(output)
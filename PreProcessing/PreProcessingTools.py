@@ -6,6 +6,7 @@ import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 from Utils import OmeroTools
+from Utils.TileTable import compact_tile_dataframe
 from PIL import Image
 from tqdm import tqdm
 from pathlib import Path
@@ -384,7 +385,7 @@ class PreProcessor:
             print('--------------------------------------------------------------------------------')
 
         df[['coords_x', 'coords_y']] = df[['coords_x', 'coords_y']].astype('int')
-        return df
+        return compact_tile_dataframe(df)
 
     def getAllTiles(self, dataset):
 
@@ -400,6 +401,6 @@ class PreProcessor:
             df = pd.concat([df, cur_dataset], ignore_index=True)
 
         print('--------------------------------------------------------------------------------')
-        return df
+        return compact_tile_dataframe(df)
 
 
@@ -83,6 +83,30 @@ class ColourAugment(nn.Module):
 
         return rgb_perturbed
 
+    def forward_batch(self, imgs):
+        # Batched version of forward, for augmentation on the training device.
+        # input imgs: float torch tensor (intensity ranging [0, 1]) of size (n, c, h, w), on any device.
+        # output: tensor of the same size and range, with colours perturbed independently for each image.
+        n = imgs.shape[0]
+        hed_from_rgb = self.hed_from_rgb.to(device=imgs.device, dtype=imgs.dtype)
+        rgb_from_hed = self.rgb_from_hed.to(device=imgs.device, dtype=imgs.dtype)
+
+        log_adjust = torch.log(torch.tensor(1E-6, device=imgs.device, dtype=imgs.dtype))
+        stains = torch.einsum('ji,njhw->nihw', hed_from_rgb, torch.log(torch.clamp(imgs, min=1E-6)) / log_adjust)
+        stains = torch.clamp(stains, min=0)
+
+        if self.mode == 'uniform':
+            alpha = (2 * torch.rand((n, 3, 1, 1), device=imgs.device, dtype=imgs.dtype) - 1) * self.sigma + 1
+            beta = (2 * torch.rand((n, 3, 1, 1), device=imgs.device, dtype=imgs.dtype) - 1) * self.sigma
+            stains = alpha * stains + beta
+        elif self.mode == 'normal':
+            alpha = 1 + self.sigma * torch.randn((n, 3, 1, 1), device=imgs.device, dtype=imgs.dtype)
+            beta = self.sigma * torch.randn((n, 3, 1, 1), device=imgs.device, dtype=imgs.dtype)
+            stains = alpha * stains + beta
+
+        log_rgb = -torch.einsum('ji,njhw->nihw', rgb_from_hed, stains * -log_adjust)
+        return torch.clamp(torch.exp(log_rgb), min=0, max=1)
+
     def backward(self, stain):
 
         conv_matrix_backward = torch.transpose(self.rgb_from_hed, 0, 1)
@@ -8,16 +8,23 @@ from lightning.pytorch.loggers import TensorBoardLogger
 from lightning.pytorch.callbacks import ModelCheckpoint, LearningRateMonitor
 import lightning as L
 import toml
+import pandas as pd
 from sklearn import preprocessing
 from lightning.pytorch.strategies import DDPStrategy
 from Dataloader.Dataloader import (
     DataModule,
     QueryImageFromCriteria,
     LoadFileParameter,
+    SampleTiles,
+    SplitTiles,
     SynchronizeSVS,
     SynchronizeNPY
 )
+from Dataloader.TileStore import build_tile_store, load_tile_store_index, tile_store_exists
+from Dataloader.TarShards import ShardDataModule, write_tar_shards, load_tile_shards_index, tile_shards_exist
+from Dataloader.SharedTileCache import TileCacheMonitor
 from Utils import GetInfo
+from Utils.LoaderTuner import default_num_workers
 from Model.ConvNet import ConvNet
 from QA.Normalization.Colour import ColourAugment
 import datetime
@@ -35,6 +42,25 @@ def get_tile_dataset(config):
     tile_dataset['SVS_PATH'] = tile_dataset['SVS_PATH_y']
     return tile_dataset
 
+def get_tile_store(config):
+    # Extract the sampled tiles once into DATA.Tile_Store, then train from the store only (no SVS files needed).
+    store_dir = config['DATA']['Tile_Store']
+    if not tile_store_exists(store_dir):
+        tile_dataset = SampleTiles(config, get_tile_dataset(config))
+        build_tile_store(tile_dataset, config, store_dir, num_workers=default_num_workers())
+    return load_tile_store_index(store_dir)
+
+def get_tile_shards(config):
+    # Export the sampled train/val/test tiles once to tar shards under DATA.Tile_Shards, then stream from the shards.
+    shard_dir = config['DATA']['Tile_Shards']
+    splits = ['train', 'val', 'test']
+    if not all(tile_shards_exist(os.path.join(shard_dir, split)) for split in splits):
+        tile_dataset = SampleTiles(config, get_tile_dataset(config))
+        for split, split_dataset in zip(splits, SplitTiles(config, tile_dataset)):
+            write_tar_shards(split_dataset, config, os.path.join(shard_dir, split),
+                             shard_size=config['DATA'].get('Shard_Size', 1000), num_workers=default_num_workers())
+    return pd.concat([load_tile_shards_index(os.path.join(shard_dir, split)) for split in splits])
+
 def get_logger(config, model_name):
     logger_folder = config['CHECKPOINT']['logger_folder']
     return TensorBoardLogger('lightning_logs', name=model_name, sub_dir=logger_folder)
@@ -47,9 +73,15 @@ def get_callbacks(config):
         save_top_k=1,
         mode=config['CHECKPOINT']['Mode'])
 
-    return [lr_monitor, checkpoint_callback]
+    callbacks = [lr_monitor, checkpoint_callback]
+    if config['ADVANCEDMODEL'].get('Tile_Cache_Size', None):
+        callbacks.append(TileCacheMonitor())  # hit rate of the shared tile cache, per epoch
+    return callbacks
 
 def get_transforms(config):
+    if config['ADVANCEDMODEL'].get('Device_Transforms', False):
+        return None, None  # the dataloader returns uint8 batches, augmented and normalised by ConvNet on device
+
     train_transform = transforms.Compose([
         transforms.ToTensor(),
         ColourAugment.ColourAugment(sigma=config['AUGMENTATION']['Colour_Sigma'], mode=config['AUGMENTATION']['Colour_Mode']),
@@ -72,7 +104,12 @@ def main(config_file):
     config = load_config(config_file)
     print(f"{n_gpus} GPUs are used for training")
 
-    tile_dataset = get_tile_dataset(config)
+    if config['DATA'].get('Tile_Store', None):
+        tile_dataset = get_tile_store(config)
+    elif config['DATA'].get('Tile_Shards', None):
+        tile_dataset = get_tile_shards(config)
+    else:
+        tile_dataset = get_tile_dataset(config)
     config['DATA']['N_Classes'] = len(tile_dataset[config['DATA']['Label']].unique())
     #print(f"There are {config['DATA']['N_Classes']} classes in the training dataset.")
     #print(tile_dataset.value_counts(subset=config['DATA']['Label']))
@@ -100,13 +137,21 @@ def main(config_file):
     model = ConvNet(config, label_encoder=label_encoder)
     #compiled_model = torch.compile(model)
     
-    data = DataModule(
-        tile_dataset,
-        train_transform=train_transform,
-        val_transform=val_transform,
-        config= config,
-        label_encoder=label_encoder
-    )
+    if config['DATA'].get('Tile_Shards', None):
+        data = ShardDataModule(
+            config,
+            train_transform=train_transform,
+            val_transform=val_transform,
+            label_encoder=label_encoder
+        )
+    else:
+        data = DataModule(
+            tile_dataset,
+            train_transform=train_transform,
+            val_transform=val_transform,
+            config= config,
+            label_encoder=label_encoder
+        )
     
     #GetInfo.ShowTrainValTestInfo(data, config)
 
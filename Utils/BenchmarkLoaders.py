@@ -0,0 +1,69 @@
+"""
+Benchmark of DataGenerator throughput and memory with DataLoader worker processes against the in-process
+Dataloader.ThreadedLoader, on random tiles of one slide.
+
+Memory is the unique memory (USS) of the main process and of its DataLoader workers, sampled after every batch; the
+peak is reported, relative to the main process before the loader is created.
+
+Usage:
+    python -m Utils.BenchmarkLoaders <slide.svs> [n_tiles] [n_workers] [batch_size] [backend]
+"""
+import sys
+import time
+import numpy as np
+import openslide
+import pandas as pd
+import psutil
+from torch.utils.data import DataLoader
+from Dataloader.Dataloader import DataGenerator
+from Dataloader.BatchBuffers import collate_tile_batch
+from Dataloader.ThreadedLoader import ThreadedLoader
+from Utils.BenchmarkSlideReads import random_locations
+from Utils.SlidePool import default_wsi_backend
+
+
+def _uss(process):
+    try:
+        return process.memory_full_info().uss
+    except (psutil.AccessDenied, psutil.NoSuchProcess):
+        return 0
+
+
+def total_uss():
+    main = psutil.Process()
+    return _uss(main) + sum(_uss(child) for child in main.children(recursive=True))
+
+
+def run(loader, n_tiles):
+    baseline = total_uss()
+    peak = baseline
+    start = time.perf_counter()
+    for _ in loader:
+        peak = max(peak, total_uss())
+    elapsed = time.perf_counter() - start
+    return n_tiles / elapsed, (peak - baseline) / 1024 ** 2
+
+
+if __name__ == '__main__':
+    path = sys.argv[1]
+    n_tiles    = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    n_workers  = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    batch_size = int(sys.argv[4]) if len(sys.argv) > 4 else 64
+    backend    = sys.argv[5] if len(sys.argv) > 5 else default_wsi_backend()
+
+    locations = random_locations(openslide.OpenSlide(path).level_dimensions[0], n_tiles, 512)
+    tile_dataset = pd.DataFrame({'coords_x': locations[:, 0] + 256, 'coords_y': locations[:, 1] + 256,
+                                 'SVS_PATH': path, 'label': np.zeros(n_tiles, dtype=int)})
+    config = {'BASEMODEL': {'Vis': [0], 'Patch_Size': [256, 256]},
+              'ADVANCEDMODEL': {'Inference': True, 'WSI_Backend': backend, 'Device_Transforms': True},
+              'DATA': {'Label': 'label'}}
+    print('{}: {} tiles, batches of {}, {} backend.'.format(path, n_tiles, batch_size, backend))
+
+    loaders = [('DataLoader, {} workers'.format(n_workers),
+                lambda: DataLoader(DataGenerator(tile_dataset, config), batch_size=batch_size, num_workers=n_workers,
+                                   collate_fn=collate_tile_batch)),
+               ('ThreadedLoader, {} threads'.format(n_workers),
+                lambda: ThreadedLoader(DataGenerator(tile_dataset, config), batch_size=batch_size, num_threads=n_workers))]
+    for name, make_loader in loaders:
+        throughput, memory = run(make_loader(), n_tiles)
+        print('{:>28}: {:8.1f} tiles/s, peak additional USS {:8.1f} MB'.format(name, throughput, memory))
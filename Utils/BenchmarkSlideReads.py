@@ -0,0 +1,74 @@
+"""
+CPU benchmark of tile reads from one slide: openslide (one read_region call per location, as in the openslide
+fallback), cuCIM one location per call (as DataGenerator without Batched_Reads), and cuCIM with all locations of a
+batch submitted in a single read_region call (Batched_Reads), decoded by Read_Threads internal threads.
+
+Locations are drawn at random inside the slide and sorted by slide-locality blocks, as SlideBlockSampler would
+deliver them, then split into batches of batch_size.
+
+Usage:
+    python -m Utils.BenchmarkSlideReads <slide.svs> [n_tiles] [patch_size] [level] [batch_size] [read_threads]
+"""
+import sys
+import time
+import numpy as np
+import openslide
+from Dataloader.BatchBuffers import rgb_array
+
+try:
+    from cucim import CuImage
+except ImportError:
+    CuImage = None
+
+
+def random_locations(dimensions, n_tiles, read_size, block_size=2048, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.integers(0, dimensions[0] - read_size, n_tiles)
+    y = rng.integers(0, dimensions[1] - read_size, n_tiles)
+    order = np.lexsort((x, y, x // block_size, y // block_size))
+    return np.stack([x[order], y[order]], axis=1)
+
+
+def bench_openslide(path, locations, patch_size, level, batch_size):
+    slide = openslide.OpenSlide(path)
+    for x, y in locations:
+        rgb_array(slide.read_region((int(x), int(y)), level, (patch_size, patch_size)))
+
+
+def bench_cucim(path, locations, patch_size, level, batch_size):
+    slide = CuImage(path)
+    for x, y in locations:
+        np.asarray(slide.read_region(location=(int(x), int(y)), size=(patch_size, patch_size), level=level))
+
+
+def bench_cucim_batched(path, locations, patch_size, level, batch_size, read_threads=4):
+    slide = CuImage(path)
+    for start in range(0, len(locations), batch_size):
+        batch = [(int(x), int(y)) for x, y in locations[start:start + batch_size]]
+        for region in slide.read_region(location=batch, size=(patch_size, patch_size), level=level,
+                                        batch_size=len(batch), num_workers=read_threads):
+            np.asarray(region)
+
+
+if __name__ == '__main__':
+    path = sys.argv[1]
+    n_tiles, patch_size, level, batch_size, read_threads = [int(a) for a in sys.argv[2:]] + [1024, 256, 0, 64, 4][len(sys.argv) - 2:]
+
+    slide = openslide.OpenSlide(path)
+    read_size = int(patch_size * slide.level_downsamples[level])
+    locations = random_locations(slide.level_dimensions[0], n_tiles, read_size)
+    print('{}: {} tiles of {}x{} px at level {}, batches of {}.'.format(path, n_tiles, patch_size, patch_size, level, batch_size))
+
+    runs = [('openslide, per location', bench_openslide, {})]
+    if CuImage is not None:
+        runs += [('cuCIM, per location', bench_cucim, {}),
+                 ('cuCIM, batched ({} threads)'.format(read_threads), bench_cucim_batched, {'read_threads': read_threads})]
+    else:
+        print('cuCIM is not installed: only the openslide fallback is measured.')
+
+    for name, bench, kwargs in runs:
+        bench(path, locations[:batch_size], patch_size, level, batch_size, **kwargs)  # warm-up (headers, page cache)
+        start = time.perf_counter()
+        bench(path, locations, patch_size, level, batch_size, **kwargs)
+        elapsed = time.perf_counter() - start
+        print('{:>28}: {:8.1f} tiles/s'.format(name, n_tiles / elapsed))
@@ -0,0 +1,91 @@
+"""
+Benchmark of per-item indexing in tile Datasets: pandas .iloc lookups (as DataGenerator used to do) against the
+array-backed Dataloader.TileIndex.
+
+Reports the per-item lookup overhead, and the unique memory (USS) of DataLoader workers after one epoch over a
+synthetic tile table. No slide is read, so that only the indexing cost is measured.
+
+Usage:
+    python -m Utils.BenchmarkTileIndex [n_tiles] [num_workers]
+"""
+import sys
+import time
+import numpy as np
+import pandas as pd
+import psutil
+import torch
+from torch.utils.data import DataLoader
+from Dataloader.TileIndex import TileIndex
+
+
+def make_tile_table(n_tiles, n_slides=500, seed=0):
+    # Uncompacted tile table, with object columns as produced by the preprocessing.
+    rng = np.random.default_rng(seed)
+    slide = rng.integers(n_slides, size=n_tiles)
+    return pd.DataFrame({'coords_x': rng.integers(100000, size=n_tiles),
+                         'coords_y': rng.integers(100000, size=n_tiles),
+                         'SVS_PATH': pd.Series(['/data/svs/slide_{:05d}.svs'.format(s) for s in slide], dtype=object),
+                         'id_external': pd.Series(['slide_{:05d}'.format(s) for s in slide], dtype=object),
+                         'tissue_type': pd.Series(rng.choice(['Tumour', 'Normal', 'Fat', 'Stroma'], n_tiles), dtype=object),
+                         'prob_tissue_type_Tumour': rng.random(n_tiles)})
+
+
+class PandasIndexDataset(torch.utils.data.Dataset):
+    def __init__(self, tile_dataset, target='tissue_type'):
+        self.tile_dataset = tile_dataset
+        self.target = target
+
+    def __len__(self):
+        return int(self.tile_dataset.shape[0])
+
+    def lookup(self, id):
+        return (self.tile_dataset['SVS_PATH'].iloc[id], self.tile_dataset['coords_x'].iloc[id],
+                self.tile_dataset['coords_y'].iloc[id], self.tile_dataset[self.target].iloc[id])
+
+    def __getitem__(self, id):
+        self.lookup(id)
+        return _worker_uss() if id % 1000 == 0 else 0
+
+
+class ArrayIndexDataset(PandasIndexDataset):
+    def __init__(self, tile_dataset, target='tissue_type'):
+        super().__init__(tile_dataset, target)
+        self.index = TileIndex(tile_dataset, label=target)
+
+    def lookup(self, id):
+        return self.index.svs_path(id), self.index.coords_x[id], self.index.coords_y[id], self.index.label(id)
+
+
+def _worker_uss():
+    try:
+        return psutil.Process().memory_full_info().uss
+    except psutil.AccessDenied:
+        return psutil.Process().memory_info().rss
+
+
+def per_item_us(dataset, n=100000, seed=0):
+    ids = np.random.default_rng(seed).integers(len(dataset), size=n).tolist()
+    start = time.perf_counter()
+    for id in ids:
+        dataset.lookup(id)
+    return 1e6 * (time.perf_counter() - start) / n
+
+
+def worker_uss_mb(dataset, num_workers, batch_size=256):
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=True)
+    peak = 0
+    for batch in loader:
+        peak = max(peak, int(batch.max()))
+    return peak / 1024 ** 2
+
+
+if __name__ == '__main__':
+    n_tiles = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    tile_dataset = make_tile_table(n_tiles)
+    print('Tile table: {} tiles, {:.1f} MB.'.format(n_tiles, tile_dataset.memory_usage(deep=True).sum() / 1024 ** 2))
+
+    for name, dataset_class in [('pandas .iloc', PandasIndexDataset), ('TileIndex', ArrayIndexDataset)]:
+        dataset = dataset_class(tile_dataset)
+        print('{:>12}: {:6.2f} us/item, peak worker USS after one epoch {:7.1f} MB'.format(
+            name, per_item_us(dataset), worker_uss_mb(dataset, num_workers)))
@@ -7,6 +7,8 @@ from matplotlib.patches import Ellipse
 import seaborn
 from scipy import stats
 from Utils.PredsAnalyzeTools import *
+from Utils.NativeTileReader import NativeTileSlide, read_region_downsampled
+from Utils.SlideCatalogue import get_slide_catalogue
 
 
 def plot_bbox(df,HE_Path='/home/dgs2/data/DigitalPathologyAI/'):
@@ -38,9 +40,10 @@ def CreateDensityMap(data, SVS_ID, HE_Path='/home/dgs2/data/DigitalPathologyAI/'
         data_in = data
     else:
         vis_level = 0
-        wsi_object = openslide.open_slide(HE_Path + '{}.svs'.format(SVS_ID))
-        data['x_center'] = ((data.xmin + data.xmax)/2 + data['coords_x']) / wsi_object.level_downsamples[vis_level]
-        data['y_center'] = ((data.ymin + data.ymax)/2 + data['coords_y']) / wsi_object.level_downsamples[vis_level]
+        # Downsamples come from the slide catalogue: the slide is only opened to plot it.
+        wsi_info = get_slide_catalogue(HE_Path + 'slide_catalogue.sqlite').get(HE_Path + '{}.svs'.format(SVS_ID), SVS_ID)
+        data['x_center'] = ((data.xmin + data.xmax)/2 + data['coords_x']) / wsi_info.level_downsamples[vis_level]
+        data['y_center'] = ((data.ymin + data.ymax)/2 + data['coords_y']) / wsi_info.level_downsamples[vis_level]
         x = data.x_center
         y = data.y_center
 
@@ -51,13 +54,13 @@ def CreateDensityMap(data, SVS_ID, HE_Path='/home/dgs2/data/DigitalPathologyAI/'
 
         r = 3750
         region_size = (2 * r, 2 * r)
-        center = (xy_max[0] * wsi_object.level_downsamples[vis_level], xy_max[1] * wsi_object.level_downsamples[vis_level])
+        center = (xy_max[0] * wsi_info.level_downsamples[vis_level], xy_max[1] * wsi_info.level_downsamples[vis_level])
         coord_x = int(center[0] - r)
         coord_y = int(center[1] - r)
         coord = (coord_x, coord_y)
 
-        data['x_center_in'] = x * wsi_object.level_downsamples[vis_level] - coord_x
-        data['y_center_in'] = y * wsi_object.level_downsamples[vis_level] - coord_y
+        data['x_center_in'] = x * wsi_info.level_downsamples[vis_level] - coord_x
+        data['y_center_in'] = y * wsi_info.level_downsamples[vis_level] - coord_y
         data_in = data[data.x_center_in > 0]
         data_in = data_in[data_in.y_center_in > 0]
         data_in = data_in[data_in.x_center_in < region_size[0]]
@@ -66,6 +69,7 @@ def CreateDensityMap(data, SVS_ID, HE_Path='/home/dgs2/data/DigitalPathologyAI/'
         data_in = data_in[data_in['distance^2'] < r ** 2].reset_index(drop=True)
 
         if if_plot:
+            wsi_object = openslide.open_slide(HE_Path + '{}.svs'.format(SVS_ID))
             img = np.array(wsi_object.read_region((0, 0), vis_level, wsi_object.level_dimensions[vis_level]).convert("RGB"))
             fig, ax = plt.subplots(figsize=(9, 9))
             ax.scatter(x, y, marker=".", color='red', s=1)
@@ -85,7 +89,7 @@ def CreateDensityMap(data, SVS_ID, HE_Path='/home/dgs2/data/DigitalPathologyAI/'
             plt.axvline(xy_max[0], c='r', lw=1)
             plt.axhline(xy_max[1], c='r', lw=1)
             plt.text(xy_max[0], xy_max[1],
-                     f" x={xy_max[0] * wsi_object.level_downsamples[vis_level]:.2f}\n y={xy_max[1] * wsi_object.level_downsamples[vis_level]:.2f}",
+                     f" x={xy_max[0] * wsi_info.level_downsamples[vis_level]:.2f}\n y={xy_max[1] * wsi_info.level_downsamples[vis_level]:.2f}",
                      color='black', ha='left', va='bottom', fontsize=14)
             plt.axis('off')
             plt.title('{} Kernel density estimation map'.format(SVS_ID))
@@ -94,13 +98,15 @@ def CreateDensityMap(data, SVS_ID, HE_Path='/home/dgs2/data/DigitalPathologyAI/'
 
     return coord, data_in
 
-def Plot10HPFs(SVS_ID,coord,data_in,r = 3750, HE_Path='/home/dgs2/data/DigitalPathologyAI/'):
-    vis_level = 0
-    wsi_object = openslide.open_slide(HE_Path + '{}.svs'.format(SVS_ID))
+def Plot10HPFs(SVS_ID,coord,data_in,r = 3750, HE_Path='/home/dgs2/data/DigitalPathologyAI/', downsample=4):
+    # The 10 HPFs region is only displayed: it is read downsample times smaller (pyramid level or JPEG DCT scaling,
+    # see Utils.NativeTileReader.read_region_downsampled) and drawn in level 0 coordinates.
+    wsi_object = NativeTileSlide(HE_Path + '{}.svs'.format(SVS_ID))
     region_size = (2 * r, 2 * r)
-    hpf_10 = np.array(wsi_object.read_region(coord, vis_level, region_size).convert("RGB"))
+    hpf_10 = read_region_downsampled(wsi_object, coord, region_size, downsample)
+    wsi_object.close()
     fig, ax = plt.subplots(figsize=(8, 8))
-    plt.imshow(hpf_10)
+    plt.imshow(hpf_10, extent=(0, region_size[0], region_size[1], 0))
     draw_circle = plt.Circle((r, r), r, color='red', fill=False)
     ax.set_aspect(1)
     ax.add_artist(draw_circle)
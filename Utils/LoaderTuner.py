@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import socket
+import time
+from datetime import datetime
+from pathlib import Path
+import psutil
+import torch
+from torch.utils.data import DataLoader
+
+# Chooses DataLoader settings (num_workers, prefetch_factor, persistent_workers, pin_memory) by timing a short warm-up
+# on the actual dataset and host, and caches the choice per host/config in a json file so that later runs start
+# immediately. Enabled with ADVANCEDMODEL.Tune_Loader; otherwise default_loader_settings() is used.
+
+DEFAULT_CACHE_FILE = Path.home() / '.cache' / 'DigitalPathologyAI' / 'loader_tuning.json'
+
+# Config entries that change the cost of loading a batch; any change invalidates the cached settings.
+_KEY_ENTRIES = {'BASEMODEL': ['Patch_Size', 'Vis', 'Batch_Size'],
+                'ADVANCEDMODEL': ['Region_Reads', 'Max_Region_Size', 'Device_Transforms', 'Max_Open_Slides',
+                                  'WSI_Backend', 'Batched_Reads', 'Read_Threads', 'Native_Tile_Cache',
+                                  'Tile_Cache_Size'],
+                'DATA': ['Tile_Store', 'Tile_Shards', 'Block_Size', 'Block_Mix', 'Resample_Tiles']}
+
+
+def available_cpus():
+    # CPUs this process may run on (respects taskset/cgroup affinity, unlike os.cpu_count()).
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS/Windows
+        return os.cpu_count() or 1
+
+
+def default_num_workers():
+    # 80% of the available CPUs, without forking a multiprocessing.Pool just to count them.
+    return max(1, int(.8 * available_cpus()))
+
+
+def default_loader_settings():
+    return {'num_workers': default_num_workers(), 'pin_memory': False}
+
+
+def get_loader_settings(config, dataset, **loader_kwargs):
+    # DataLoader keyword arguments for dataset: tuned (or read from the cache) if ADVANCEDMODEL.Tune_Loader is set,
+    # default_loader_settings() otherwise. loader_kwargs (shuffle, sampler, collate_fn...) are used for the warm-up.
+    if not config['ADVANCEDMODEL'].get('Tune_Loader', False):
+        return default_loader_settings()
+    ram_budget = config['ADVANCEDMODEL'].get('Loader_RAM_Budget', None)
+    return tune_dataloader(dataset, config['BASEMODEL']['Batch_Size'], config=config,
+                           cache_file=config['ADVANCEDMODEL'].get('Loader_Tuning_Cache', None),
+                           ram_budget=None if ram_budget is None else ram_budget * 1024 ** 3,
+                           **loader_kwargs)
+
+
+def tune_dataloader(dataset, batch_size, config=None, cache_file=None, ram_budget=None, n_batches=20, max_workers=None,
+                    **loader_kwargs):
+    # Searches DataLoader settings maximising throughput (tiles/s) for dataset, within ram_budget bytes of additional
+    # memory (main process + workers). Defaults to half of the memory available when tuning starts.
+    #
+    # The search is coordinate-wise, to keep the warm-up short: num_workers is doubled until throughput stops
+    # improving (or memory exceeds the budget), then prefetch_factor and pin_memory are tried on the best worker count.
+    # persistent_workers is enabled when the workers of the train and val loaders can be kept alive together within
+    # the budget, which saves the worker start-up time measured during the warm-up at every epoch.
+    #
+    # Returns a dict of DataLoader keyword arguments.
+
+    cache_file = Path(cache_file) if cache_file else DEFAULT_CACHE_FILE
+    key = _cache_key(dataset, batch_size, config)
+    cache = _read_cache(cache_file)
+    if key in cache:
+        print('Using cached DataLoader settings {} (tuned on {}).'.format(cache[key]['settings'], cache[key]['date']))
+        return cache[key]['settings']
+
+    if ram_budget is None:
+        ram_budget = .5 * psutil.virtual_memory().available
+    max_workers = available_cpus() if max_workers is None else max_workers
+    pin_options = [False, True] if torch.cuda.is_available() else [False]
+
+    def run(settings):
+        result = _benchmark(dataset, batch_size, settings, n_batches, loader_kwargs)
+        print('DataLoader warm-up {}: {:.1f} tiles/s, {:.2f} GB, start-up {:.1f}s'.format(
+            settings, result['throughput'], result['memory'] / 1024 ** 3, result['startup']))
+        return result
+
+    best_settings = {'num_workers': 0, 'pin_memory': False}
+    best = run(best_settings)
+    num_workers = 2
+    while num_workers <= max_workers:
+        settings = {'num_workers': num_workers, 'prefetch_factor': 2, 'pin_memory': False}
+        result = run(settings)
+        if result['memory'] > ram_budget or result['throughput'] < 1.05 * best['throughput']:
+            break
+        best_settings, best = settings, result
+        num_workers *= 2
+
+    candidates = []
+    if best_settings['num_workers'] > 0:
+        candidates += [dict(best_settings, prefetch_factor=prefetch_factor) for prefetch_factor in [4, 8]]
+    candidates += [dict(best_settings, pin_memory=pin_memory) for pin_memory in pin_options[1:]]
+    for settings in candidates:
+        result = run(settings)
+        if result['memory'] <= ram_budget and result['throughput'] > 1.05 * best['throughput']:
+            best_settings, best = settings, result
+
+    if best_settings['num_workers'] > 0:
+        best_settings['persistent_workers'] = bool(2 * best['memory'] <= ram_budget)
+
+    cache = _read_cache(cache_file)  # re-read, another process may have written in the meantime
+    cache[key] = {'host': socket.gethostname(), 'date': datetime.now().isoformat(timespec='seconds'),
+                  'settings': best_settings, 'throughput': best['throughput'], 'memory': best['memory']}
+    _write_cache(cache_file, cache)
+    print('Selected DataLoader settings {} ({:.1f} tiles/s).'.format(best_settings, best['throughput']))
+    return best_settings
+
+
+def _benchmark(dataset, batch_size, settings, n_batches, loader_kwargs):
+    process = psutil.Process()
+    baseline = _memory(process)
+    start = time.perf_counter()
+    loader = iter(DataLoader(dataset, batch_size=batch_size, **settings, **loader_kwargs))
+    next(loader)  # worker start-up + first batch
+    first = time.perf_counter()
+    n, peak = 0, 0  # n: batches produced after the first one
+    while n < n_batches:
+        try:
+            next(loader)
+        except StopIteration:
+            break
+        n += 1
+        peak = max(peak, _memory(process))
+    end = time.perf_counter()
+    del loader  # shuts the workers down
+    return {'startup': first - start,
+            'throughput': n * batch_size / max(end - first, 1e-9),
+            'memory': max(0, peak - baseline)}
+
+
+def _memory(process):
+    # Memory of the main process and its workers. Forked workers share most of their pages with the main process,
+    # so their unique set size is used when it can be read.
+    total = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            try:
+                total += child.memory_full_info().uss
+            except psutil.AccessDenied:
+                total += child.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+
+def _cache_key(dataset, batch_size, config):
+    entries = {'host': socket.gethostname(), 'cpus': available_cpus(), 'gpus': torch.cuda.device_count(),
+               'dataset': type(dataset).__name__, 'batch_size': batch_size}
+    if config is not None:
+        for section, keys in _KEY_ENTRIES.items():
+            entries.update({section + '.' + k: config.get(section, {}).get(k, None) for k in keys})
+    return hashlib.sha1(json.dumps(entries, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _read_cache(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_cache(cache_file, cache):
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache_file.with_suffix('.{}.tmp'.format(os.getpid()))
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2)
+    tmp.replace(cache_file)
@@ -1,52 +1,86 @@
-import numpy as np
-import pandas as pd
 import torch
+import torch.distributed as dist
+from torch.utils.data import Dataset, Sampler
+from torch.utils.data._utils.collate import default_collate
 
+# Multi-GPU inference without padding.
+#
+# Each rank predicts a contiguous range of the dataset (ContiguousDistributedSampler): ranges differ by at most one
+# tile, and no tile is duplicated to even them out. Batches carry the dataset indices of their tiles (IndexedDataset),
+# predict_step returns (outputs, indices) without all_gather, and every rank writes its outputs with their indices
+# (Utils.PredictionWriter), merged by index once prediction is over (read_predictions), so that batches of different
+# sizes on different ranks are not a problem.
+#
+# Usage: pl.Trainer(..., replace_sampler_ddp=False, callbacks=[PredictionWriter(...)]) (use_distributed_sampler=False
+# in Lightning 2), a DataLoader (or ThreadedLoader) of IndexedDataset(dataset) with
+# sampler=ContiguousDistributedSampler(dataset) and collate_fn=IndexedDataset.collate, then
+# trainer.predict(model, data, return_predictions=False).
 
-def pad_size(n_examples, n_gpus, batch_size):
-    # Returns the number of tiles that must be appended to a dataset of length n_examples
-    # to be compatible with all_gather for multi-GPU inference.
 
-    # When processing on multiple GPUs, the effective batch_size becomes n_gpus * batch_size:
-    effective_batch_size = n_gpus * batch_size
+def _distributed():
+    return dist.is_available() and dist.is_initialized()
 
-    # Calculate the number of effective batches that can be done with the current dataset:
-    neb = np.floor(n_examples / effective_batch_size).astype(int)
 
-    # Get the corresponding number of examples:
-    n_full_examples = neb * effective_batch_size
+class ContiguousDistributedSampler(Sampler):
+    # Indices [rank * N // W, (rank + 1) * N // W) of a dataset of length N, for rank rank of W. The rank and world
+    # size are looked up when iterating (unless given), as the Trainer initialises torch.distributed after the
+    # DataLoader has been created.
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        self.dataset      = dataset
+        self.num_replicas = num_replicas
+        self.rank         = rank
 
-    # Calculate the number of remaining examples that would be left out:
-    n_left_out = n_examples - n_full_examples.astype(int)
+    def _range(self):
+        num_replicas, rank = self.num_replicas, self.rank
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if _distributed() else 1
+        if rank is None:
+            rank = dist.get_rank() if _distributed() else 0
+        n = len(self.dataset)
+        return rank * n // num_replicas, (rank + 1) * n // num_replicas
 
-    # The number to use for padding is equal to the difference between n_left_out and batch_size*n_gpus.
-    pad = batch_size * n_gpus - n_left_out
-    return pad.astype(int)
+    def __iter__(self):
+        start, stop = self._range()
+        return iter(range(start, stop))
 
+    def __len__(self):
+        start, stop = self._range()
+        return stop - start
 
-def pad_dataframe(df, n_pad):
-    if n_pad:
-        df_pad = pd.concat([df.iloc[[-1]]] * n_pad)
-        return pd.concat([df, df_pad], ignore_index=True)
-    else:
-        return df
+    def set_epoch(self, epoch):
+        pass  # the order does not depend on the epoch
 
 
-def reorder_predictions(predictions):
-    # Reorder predictions of a classification model with n_classes classes after multi-GPU processing.
+class IndexedBatch:
+    # Batch read with __getitems__ (e.g. a TileBatch, kept as is for its collate_fn), with the dataset indices of its
+    # samples.
+    def __init__(self, batch, ids):
+        self.batch = batch
+        self.ids   = ids
 
-    # The output from trainer.predict(), predictions is a list of N elements,
-    # where N is ~ len(dataset)/(batch_size*n_gpus).
-    # With n_gpus=1, each element of the list is a (batch_size, n_classes) tensor.
-    # With n_gpus>1, each element of the list is a (n_gpus, batch_size, n_classes) tensor.
 
-    # In the latter case, each tensor must be reshaped to a shape of (batch_size*n_gpus, C). This is done in the
-    # correct order with the line below.
+class IndexedDataset(Dataset):
+    # Wraps a dataset so that its samples come with their index: items are (sample, index), and batches read with
+    # __getitems__ (e.g. by DataGenerator) are IndexedBatch. Use the collate method as collate_fn: it collates the
+    # samples with the collate_fn of the wrapped dataset and returns [samples, (B,) int64 tensor of indices].
+    def __init__(self, dataset, collate_fn=default_collate):
+        self.dataset    = dataset
+        self.collate_fn = collate_fn
 
-    # Lazily infer the number of GPUs
-    if len(predictions[0].size()) > 2:
-        n_gpus, batch_size, n_classes = predictions[0].size()
-        return [torch.reshape(pred.transpose(0, 1), (n_gpus * batch_size, n_classes)) for pred in predictions]
-    else:
-        return predictions
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, id):
+        return self.dataset[id], id
+
+    def __getitems__(self, ids):
+        if hasattr(self.dataset, '__getitems__'):
+            return IndexedBatch(self.dataset.__getitems__(ids), ids)
+        return IndexedBatch([self.dataset[id] for id in ids], ids)
+
+    def collate(self, batch):
+        if isinstance(batch, IndexedBatch):
+            return [self.collate_fn(batch.batch), torch.as_tensor(batch.ids, dtype=torch.int64)]
+        samples, ids = zip(*batch)
+        return [self.collate_fn(list(samples)), torch.as_tensor(ids, dtype=torch.int64)]
 
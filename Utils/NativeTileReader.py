@@ -0,0 +1,264 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import tifffile
+from PIL import Image
+
+# Direct access to the native tiles of tiled pyramidal TIFF/SVS files.
+#
+# openslide composites every requested region from the compressed tiles of the slide, behind a global lock per slide
+# handle, and decodes the same JPEG tiles again for every overlapping request. NativeTileSlide instead reads the tile
+# offsets of each pyramid level once with tifffile, then fetches the compressed bytes of the tiles covering a region
+# (os.pread, no shared file position and no lock) and decodes them with tifffile's codecs. Decoded tiles are kept in a
+# small per-process LRU (TileCache), so that overlapping or neighbouring patches decode each native tile only once.
+#
+# JPEG tiles can also be decoded at 1/2, 1/4 or 1/8 of their size with libjpeg DCT scaling (PIL draft mode), which
+# skips most of the inverse DCT work. read_region_downsampled uses it for thumbnail-style reads: for a requested
+# downsample, it picks the pyramid level and DCT scale that decode the fewest pixels (see NativeTileSlide.plan_read).
+#
+# NativeTileSlide exposes the subset of the openslide.OpenSlide interface used by the preprocessing (level_count,
+# level_dimensions, level_downsamples, read_region), and NativeTileReader the subset of the MONAI WSIReader interface
+# used by DataGenerator (WSI_Backend = 'NativeTiles').
+
+
+# DCT scales supported by libjpeg.
+JPEG_SCALES = (1, 2, 4, 8)
+
+
+class TileCache:
+    # Bounded LRU of decoded tiles, keyed by (path, level, tile index, scale). Thread-safe; decoding happens outside the lock.
+    def __init__(self, max_tiles=256):
+        self.max_tiles = int(max_tiles)
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, key, decode):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+            self.misses += 1
+
+        tile = decode()
+
+        if self.max_tiles > 0:
+            with self._lock:
+                self._tiles[key] = tile
+                self._tiles.move_to_end(key)
+                while len(self._tiles) > self.max_tiles:
+                    self._tiles.popitem(last=False)
+        return tile
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.hits, self.misses = 0, 0
+
+
+# One cache per process, shared by every slide opened in that process.
+_tile_cache = TileCache()
+
+
+def get_tile_cache(max_tiles=None):
+    # Returns the process-wide decoded-tile cache, resizing it if max_tiles is given.
+    if max_tiles is not None:
+        _tile_cache.max_tiles = int(max_tiles)
+    return _tile_cache
+
+
+def _reset_after_fork():
+    # Decoded tiles inherited through fork() would be duplicated (copy-on-write) in every worker: start empty.
+    global _tile_cache
+    _tile_cache = TileCache(_tile_cache.max_tiles)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class _Level:
+    # Tile layout of one pyramid level (a tiled TIFF page).
+    def __init__(self, page):
+        if not page.is_tiled:
+            raise ValueError('Page {} of {} is not tiled.'.format(page.index, page.parent.filename))
+        self.page        = page
+        self.width       = page.imagewidth
+        self.height      = page.imagelength
+        self.tile_width  = page.tilewidth
+        self.tile_height = page.tilelength
+        self.n_tiles_x   = -(-self.width // self.tile_width)
+        self.n_tiles_y   = -(-self.height // self.tile_height)
+        self.offsets     = np.asarray(page.dataoffsets, dtype=np.int64)
+        self.bytecounts  = np.asarray(page.databytecounts, dtype=np.int64)
+        self.jpegtables  = page.jpegtables
+        self.jpeg        = page.compression == 7
+        self.rgb         = page.photometric == 2  # JPEG tiles stored in RGB rather than YCbCr (e.g. Aperio)
+
+    def scales(self):
+        return JPEG_SCALES if self.jpeg else (1,)
+
+
+def _decode_jpeg_draft(data, jpegtables, scale, rgb):
+    # Decodes a JPEG tile at 1/scale of its size with libjpeg DCT scaling. Abbreviated tile streams (SVS) are merged
+    # with the JPEGTables of their page into a complete stream first.
+    if jpegtables is not None:
+        data = bytes(jpegtables[:-2]) + bytes(data[2:])  # tables without EOI, tile without SOI
+    image = Image.open(io.BytesIO(data))
+    image.draft('RGB', (image.width // scale, image.height // scale))
+    if rgb:  # components are not YCbCr: disable libjpeg's colour conversion
+        tile = image.tile[0]
+        image.tile = [tuple(tile[:3]) + ((tile[3][0], 'RGB'),)]
+    return np.asarray(image.convert('RGB'))
+
+
+class NativeTileSlide:
+    """
+    Tiled pyramidal TIFF/SVS slide read tile by tile, with an openslide-like interface.
+
+    Levels are those of the first series of the file (the pyramid; label, macro and thumbnail images are ignored).
+    Coordinates follow openslide: read_region takes the (x, y) top-left corner at level 0, a level and a (width, height)
+    size at that level. Parts of the region outside the image are returned as black (0), like openslide's transparent
+    background once converted to RGB.
+    """
+
+    def __init__(self, path, max_cached_tiles=None):
+        self.path = str(path)
+        with tifffile.TiffFile(self.path) as tif:
+            self.levels = [_Level(level.pages[0]) for level in tif.series[0].levels]
+        self._fd = os.open(self.path, os.O_RDONLY)
+        get_tile_cache(max_cached_tiles)
+
+        self.level_count       = len(self.levels)
+        self.level_dimensions  = tuple((level.width, level.height) for level in self.levels)
+        self.level_downsamples = tuple((self.levels[0].width / level.width + self.levels[0].height / level.height) / 2
+                                       for level in self.levels)
+        self.dimensions        = self.level_dimensions[0]
+        self.tile_size         = (self.levels[0].tile_width, self.levels[0].tile_height)
+
+    def __repr__(self):
+        return 'NativeTileSlide({!r})'.format(self.path)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def get_best_level_for_downsample(self, downsample):
+        candidates = [level for level, d in enumerate(self.level_downsamples) if d <= downsample]
+        return max(candidates) if candidates else 0
+
+    def _tile(self, level, tx, ty, scale=1):
+        # Decoded (tile_height, tile_width, samples) tile (divided by scale), through the process-wide cache.
+        lvl = self.levels[level]
+        index = ty * lvl.n_tiles_x + tx
+
+        def decode():
+            data = os.pread(self._fd, int(lvl.bytecounts[index]), int(lvl.offsets[index]))
+            if scale > 1:
+                return _decode_jpeg_draft(data, lvl.jpegtables, scale, lvl.rgb)
+            segment, _, _ = lvl.page.decode(data, index, jpegtables=lvl.jpegtables)
+            return segment.reshape(lvl.tile_height, lvl.tile_width, -1)
+
+        # The cache is looked up at call time, as it is replaced after a fork.
+        return get_tile_cache().get((self.path, level, index, scale), decode)
+
+    def plan_read(self, downsample):
+        # (level, scale) decoding the fewest pixels for a read at the given downsample (relative to level 0): the
+        # coarsest combination of pyramid level and JPEG DCT scale that is not coarser than requested. At equal
+        # resolution, the pyramid level is preferred to DCT scaling of a finer level (less data to read and decode).
+        candidates = [(d * scale, -scale, level) for level, (d, lvl) in enumerate(zip(self.level_downsamples, self.levels))
+                      for scale in lvl.scales() if d * scale <= downsample * (1 + 1e-3)]
+        if not candidates:
+            return 0, 1
+        _, scale, level = max(candidates)
+        return level, -scale
+
+    def read_region_array(self, location, level, size, scale=1):
+        # Uint8 (height, width, 3) array of the region, assembled from the native tiles overlapping it. With scale > 1,
+        # (JPEG tiles only) tiles are decoded at 1/scale of their size and size is given in those reduced pixels.
+        lvl = self.levels[level]
+        downsample = self.level_downsamples[level] * scale
+        x0 = int(round(location[0] / downsample))
+        y0 = int(round(location[1] / downsample))
+        width, height = int(size[0]), int(size[1])
+        tile_width, tile_height = -(-lvl.tile_width // scale), -(-lvl.tile_height // scale)
+        region = np.zeros((height, width, 3), dtype=np.uint8)
+
+        # Part of the region inside the image, in (scaled) level coordinates.
+        x_lo, x_hi = max(x0, 0), min(x0 + width, -(-lvl.width // scale))
+        y_lo, y_hi = max(y0, 0), min(y0 + height, -(-lvl.height // scale))
+        if x_lo >= x_hi or y_lo >= y_hi:
+            return region
+
+        for ty in range(y_lo // tile_height, (y_hi - 1) // tile_height + 1):
+            for tx in range(x_lo // tile_width, (x_hi - 1) // tile_width + 1):
+                tile = self._tile(level, tx, ty, scale)
+                # Intersection of the tile with the region.
+                tile_x, tile_y = tx * tile_width, ty * tile_height
+                ix0, ix1 = max(x_lo, tile_x), min(x_hi, tile_x + tile_width)
+                iy0, iy1 = max(y_lo, tile_y), min(y_hi, tile_y + tile_height)
+                region[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = tile[iy0 - tile_y:iy1 - tile_y, ix0 - tile_x:ix1 - tile_x, :3]
+        return region
+
+    def read_region(self, location, level, size):
+        # Same call as openslide.OpenSlide.read_region; returns an RGB (not RGBA) PIL image.
+        return Image.fromarray(self.read_region_array(location, level, size))
+
+
+def read_region_downsampled(slide, location, size, downsample, out_size=None):
+    # Uint8 (round(height / downsample), round(width / downsample), 3) array of the (width, height) level 0 region at
+    # location, for thumbnail-style reads, or of out_size = (width, height) if given. slide is a NativeTileSlide (level
+    # and JPEG DCT scale chosen by plan_read) or an openslide.OpenSlide (best pyramid level). The read is resized to the
+    # exact output size when the chosen resolution does not match the requested downsample.
+    if out_size is None:
+        out_size = (max(1, int(round(size[0] / downsample))), max(1, int(round(size[1] / downsample))))
+    out_size = (int(out_size[0]), int(out_size[1]))
+    if isinstance(slide, NativeTileSlide):
+        level, scale = slide.plan_read(downsample)
+    else:
+        level, scale = slide.get_best_level_for_downsample(downsample), 1
+    read_downsample = slide.level_downsamples[level] * scale
+    read_size = (max(1, int(round(size[0] / read_downsample))), max(1, int(round(size[1] / read_downsample))))
+
+    if isinstance(slide, NativeTileSlide):
+        region = slide.read_region_array(location, level, read_size, scale=scale)
+    else:
+        region = np.array(slide.read_region(tuple(int(v) for v in location), level, read_size).convert('RGB'))
+    if read_size != out_size:
+        region = np.asarray(Image.fromarray(region).resize(out_size, Image.BILINEAR))
+    return region
+
+
+class NativeTileReader:
+    # Subset of the MONAI WSIReader interface used by DataGenerator, backed by NativeTileSlide.
+    def __init__(self, max_cached_tiles=None):
+        self.max_cached_tiles = max_cached_tiles
+
+    def read(self, path):
+        return NativeTileSlide(path, max_cached_tiles=self.max_cached_tiles)
+
+    def get_level_count(self, wsi):
+        return wsi.level_count
+
+    def get_downsample_ratio(self, wsi, level):
+        return wsi.level_downsamples[level]
+
+    def get_size(self, wsi, level=0):
+        # (height, width) of a level, as in WSIReader.
+        return wsi.level_dimensions[level][1], wsi.level_dimensions[level][0]
+
+    def get_data(self, wsi, location, size, level=0):
+        # location is (y, x) at level 0 and size is (height, width) at level, as in WSIReader. Returns a (C, H, W)
+        # uint8 array and an (empty) metadata dict.
+        patch = wsi.read_region_array((location[1], location[0]), level, (size[1], size[0]))
+        return np.moveaxis(patch, 2, 0), {}
+
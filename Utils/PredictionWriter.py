@@ -0,0 +1,139 @@
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
+from lightning.pytorch.callbacks import BasePredictionWriter
+
+# Streaming output of trainer.predict.
+#
+# trainer.predict keeps the output of every batch until the end of the loop (and all_gather in predict_step copies
+# the outputs of every rank to every rank), so memory grows with the number of tiles. PredictionWriter instead
+# writes the probabilities of each batch to disk as they come, with trainer.predict(..., return_predictions=False):
+# every rank appends its rows to its own Parquet file per slide, <output_dir>/<slide>/part-<rank>.parquet, buffering at
+# most rows_per_group rows (one row group) per slide. Files are written under a temporary name and renamed when
+# prediction ends, and the parts of the predicted slides (only: output_dir may be shared by concurrent jobs on other
+# slides) are removed when prediction starts. read_predictions then merges the parts of a slide by tile index.
+#
+# predict_step outputs can be
+#   (probs, indices)  indices (B,) of the tiles in the dataset (IndexedDataset, see Utils.MultiGPUTools),
+#   (probs, coords)   coords (B, 2) of the tiles (SlideTileStream), stored as coords_x/coords_y,
+#   probs             tiles indexed by the batch indices tracked by Lightning.
+# Dataset indices are mapped to slides and to tile ids (e.g. the index of the tile table) by the slides and tile_ids
+# arrays, if given. Columns are named prefix + class name, class names coming from the LabelEncoder of the model.
+
+
+class PredictionWriter(BasePredictionWriter):
+    def __init__(self, output_dir, slides=None, tile_ids=None, slide_name='predictions', prefix='prob_',
+                 rows_per_group=8192):
+        # slides: slide name of each dataset index (None: every tile goes to slide_name).
+        # tile_ids: tile id of each dataset index, e.g. tile_dataset.index (None: the dataset index itself).
+        super().__init__(write_interval='batch')
+        self.output_dir     = Path(output_dir)
+        self.slides         = None if slides is None else np.asarray(slides).astype(str)
+        self.tile_ids       = None if tile_ids is None else np.asarray(tile_ids)
+        self.slide_name     = str(slide_name)
+        self.prefix         = prefix
+        self.rows_per_group = int(rows_per_group)
+        self.columns        = None
+        self._writers       = {}  # slide: (ParquetWriter, temporary path, final path)
+        self._buffers       = {}  # slide: list of pandas DataFrames not yet written
+
+    def _part_path(self, slide, rank):
+        return self.output_dir / slide / 'part-{}.parquet'.format(rank)
+
+    def on_predict_start(self, trainer, pl_module):
+        # The parts of this call's slides left by a previous call are removed first. Other slides are left alone, as
+        # other jobs may be writing them.
+        if trainer.global_rank == 0:
+            slides = [self.slide_name] if self.slides is None else np.unique(self.slides)
+            for slide in slides:
+                for path in (self.output_dir / slide).glob('part-*.parquet'):
+                    path.unlink()
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            trainer.strategy.barrier('PredictionWriter.start')
+        self._writers, self._buffers, self.columns = {}, {}, None
+
+    def _column_names(self, pl_module, n_classes):
+        if self.columns is None:
+            if hasattr(pl_module, 'LabelEncoder'):
+                names = pl_module.LabelEncoder.inverse_transform(np.arange(n_classes))
+            else:
+                names = np.arange(n_classes)
+            self.columns = [self.prefix + str(name) for name in names]
+        return self.columns
+
+    def write_on_batch_end(self, trainer, pl_module, prediction, batch_indices, batch, batch_idx, dataloader_idx):
+        coords = None
+        if isinstance(prediction, (list, tuple)):
+            probs, ids = prediction
+            ids = ids.detach().cpu().numpy()
+            if ids.ndim == 2:
+                coords, ids = ids, None
+        else:
+            probs, ids = prediction, np.asarray(batch_indices)
+        probs = probs.detach().float().cpu().numpy()
+
+        rows = pd.DataFrame(probs, columns=self._column_names(pl_module, probs.shape[1]))
+        if coords is not None:
+            rows.insert(0, 'coords_x', coords[:, 0])
+            rows.insert(1, 'coords_y', coords[:, 1])
+        if ids is not None:
+            rows.insert(0, 'tile_id', ids if self.tile_ids is None else self.tile_ids[ids])
+
+        if self.slides is None or ids is None:
+            self._append(self.slide_name, rows, trainer.global_rank)
+        else:
+            slides = self.slides[ids]
+            for slide in np.unique(slides):
+                self._append(slide, rows[slides == slide], trainer.global_rank)
+
+    def _append(self, slide, rows, rank):
+        buffer = self._buffers.setdefault(slide, [])
+        buffer.append(rows)
+        if sum(len(part) for part in buffer) >= self.rows_per_group:
+            self._flush(slide, rank)
+
+    def _flush(self, slide, rank):
+        buffer = self._buffers.pop(slide, [])
+        if not buffer:
+            return
+        table = pa.Table.from_pandas(pd.concat(buffer, ignore_index=True), preserve_index=False)
+        if slide not in self._writers:
+            path = self._part_path(slide, rank)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name('.' + path.name + '.tmp')  # hidden until complete
+            self._writers[slide] = (pq.ParquetWriter(tmp_path, table.schema), tmp_path, path)
+        self._writers[slide][0].write_table(table)
+
+    def on_predict_end(self, trainer, pl_module):
+        for slide in list(self._buffers):
+            self._flush(slide, trainer.global_rank)
+        for writer, tmp_path, path in self._writers.values():
+            writer.close()
+            os.replace(tmp_path, path)
+        self._writers = {}
+        # Every part must be complete before any rank reads them.
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            trainer.strategy.barrier('PredictionWriter.end')
+
+
+def prediction_slides(output_dir):
+    # Names of the slides with predictions in output_dir.
+    output_dir = Path(output_dir)
+    return sorted(path.name for path in output_dir.iterdir() if any(path.glob('part-*.parquet'))) if output_dir.exists() else []
+
+
+def read_predictions(output_dir, slide):
+    # Predictions of one slide (all ranks), indexed by tile_id if the tiles had ids, else in prediction order. None if
+    # there are none.
+    parts = sorted(Path(output_dir, str(slide)).glob('part-*.parquet'), key=lambda path: int(path.stem.split('-')[1]))
+    if not parts:
+        return None
+    df = pd.concat([pq.read_table(path).to_pandas() for path in parts], ignore_index=True)
+    if 'tile_id' in df.columns:
+        df = df.set_index('tile_id').sort_index()
+        df.index.name = None
+    return df
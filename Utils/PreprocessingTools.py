@@ -6,6 +6,10 @@ import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 from Utils import OmeroTools
+from Utils.TileTable import compact_tile_dataframe
+from Utils.NativeTileReader import NativeTileSlide, read_region_downsampled
+from Utils.SlideCatalogue import get_slide_catalogue, catalogue_path
+from Utils.ThumbnailCache import get_thumbnail_cache
 from PIL import Image
 from pathlib import Path
 from Visualization.WSI_Viewer import generate_overlay
@@ -89,6 +93,24 @@ def patch_background_fraction(shared, edge):
     
     return background_fraction
 
+def background_fractions(WSI_object, level, patch_size, bg_threshold, img=None):
+    # Same as patch_background_fraction over all the edges of lims_to_vec(0, width, 0, height, patch_size) at level
+    # (in the same order), but computed from a single read of the whole slide at that level's resolution instead of
+    # one read per patch. With a NativeTileSlide, the read decodes the fewest pixels possible (pyramid level or JPEG
+    # DCT scaling, see Utils.NativeTileReader.read_region_downsampled). img is an optional image of the whole slide at
+    # level (e.g. from Utils.ThumbnailCache), in which case WSI_object only provides the level dimensions.
+    w, h = WSI_object.level_dimensions[level]
+    if img is None:
+        img = read_region_downsampled(WSI_object, (0, 0), WSI_object.level_dimensions[0],
+                                      WSI_object.level_downsamples[level], out_size=(w, h))
+    img_gray = img[:, :, 0] * 0.2989 + img[:, :, 1] * 0.5870 + img[:, :, 2] * 0.1140
+
+    # Patches overlapping the right/bottom border are padded with black (not background), like openslide does.
+    nx, ny = -(-w // patch_size[0]), -(-h // patch_size[1])
+    is_background = np.zeros((ny * patch_size[1], nx * patch_size[0]), dtype=bool)
+    is_background[:h, :w] = img_gray > bg_threshold
+    return is_background.reshape(ny, patch_size[1], nx, patch_size[0]).mean(axis=(1, 3)).ravel()
+
 def compare_membership(shared, edge):
     # shared is a tuple: (array of coords in maximum resolution, patch size in maximum resolution)
     
@@ -133,6 +155,11 @@ class Preprocessor:
     def __init__(self, config):
         self.config = config
         self.patch_size = config['BASEMODEL']['Patch_Size']        
+        self.native_tiles = config.get('ADVANCEDMODEL', {}).get('WSI_Backend', None) == 'NativeTiles'
+        # Slide dimensions are looked up in the local slide catalogue (see Utils.SlideCatalogue).
+        self.catalogue = get_slide_catalogue(catalogue_path(config))
+        # Low-resolution images of whole slides come from the shared thumbnail cache (see Utils.ThumbnailCache).
+        self.thumbnails = get_thumbnail_cache(config, opener=self.open_slide)
 
         # Create some paths that are always the same defined with respect to the data folder.
         self.patches_folder = os.path.join(self.config['DATA']['SVS_Folder'], 'patches')
@@ -150,13 +177,26 @@ class Preprocessor:
 
         # Maps a contour name from Omero to a list of contour specified in config file
 
+    def open_slide(self, path):
+        # Slides are read through their native tiles when WSI_Backend is NativeTiles (see Utils.NativeTileReader).
+        if self.native_tiles:
+            return NativeTileSlide(path)
+        return openslide.open_slide(path)
+
+    def slide_info(self, path):
+        # Header metadata of a slide (level dimensions, downsamples, MPP...) without opening it.
+        return self.catalogue.get(path)
+
     def Create_Contours_Overlay_QA(self, df_export):
 
         ## Convert label to numerical value
         le = preprocessing.LabelEncoder()
         numerical_labels      = le.fit_transform(df_export['tissue_type'])
-        WSI_object           = openslide.open_slide(df_export['SVS_PATH'].iloc[0])
-        vis_level_view       = len(WSI_object.level_dimensions) - 1  # always the lowest res vis level
+        slide_info           = self.slide_info(df_export['SVS_PATH'].iloc[0])
+        vis_level_view       = len(slide_info.level_dimensions) - 1  # always the lowest res vis level
+        canvas               = self.thumbnails.read(df_export['SVS_PATH'].iloc[0],
+                                                    slide_info.level_downsamples[vis_level_view],
+                                                    out_size=slide_info.level_dimensions[vis_level_view])
         N_classes            = len(np.unique(numerical_labels))
 
         if N_classes <= 10: cmap = plt.get_cmap('Set1', lut=N_classes)           
@@ -166,8 +206,9 @@ class Preprocessor:
         cmap.N = N_classes
         cmap.colors = cmap.colors[0:N_classes]
 
-        heatmap, overlay = generate_overlay(WSI_object, numerical_labels + 1, np.array(df_export[["coords_x", "coords_y"]]),
-                                            vis_level=vis_level_view, patch_size=self.patch_size, cmap=cmap, alpha=0.4)
+        heatmap, overlay = generate_overlay(slide_info, numerical_labels + 1, np.array(df_export[["coords_x", "coords_y"]]),
+                                            vis_level=vis_level_view, patch_size=self.patch_size, cmap=cmap, alpha=0.4,
+                                            canvas=canvas)
                                         
         # Draw the contours for each label
         heatmap = np.array(heatmap)
@@ -259,39 +300,35 @@ class Preprocessor:
             #self.Create_Contours_Overlay_QA(group) For QA
             
         print(df_final.shape)
-        return df
+        return compact_tile_dataframe(df)
 
     def getAllTiles(self, dataset, background_fraction_threshold=0):
 
         df = pd.DataFrame()
         for idx, row in dataset.iterrows():
-            WSI_object = openslide.open_slide(row['SVS_PATH'])
-            print(WSI_object)
+            slide_info = self.slide_info(row['SVS_PATH'])
+            print(slide_info)
             # lowest zoom level edges (assuming processing is done with visibility 0)
-            edges_to_test = lims_to_vec(xmin=0, xmax=WSI_object.level_dimensions[0][0], ymin=0,
-                                        ymax=WSI_object.level_dimensions[0][1],
+            edges_to_test = lims_to_vec(xmin=0, xmax=slide_info.level_dimensions[0][0], ymin=0,
+                                        ymax=slide_info.level_dimensions[0][1],
                                         patch_size=self.patch_size)
 
             # remove background in //
             # This is done on the highest zoom level images to accelerate the process.
-            downsample_factor    = int(WSI_object.level_downsamples[-1]) # Factor to match high zoom patches coords to low zoom
+            downsample_factor    = int(slide_info.level_downsamples[-1]) # Factor to match high zoom patches coords to low zoom
             high_zoom_patch_size = tuple(np.array(np.array(self.patch_size) / downsample_factor).astype(int))  # Size of patches in high zoom
-            high_zoom_vis        = WSI_object.level_count - 1  # visiblity of highest zoom level
+            high_zoom_vis        = slide_info.level_count - 1  # visiblity of highest zoom level
 
             # Compute tile locations for the highest zoom level images
-            high_zoom_edges_to_test = lims_to_vec(xmin=0, xmax=WSI_object.level_dimensions[-1][0], ymin=0,
-                                                  ymax=WSI_object.level_dimensions[-1][1],
+            high_zoom_edges_to_test = lims_to_vec(xmin=0, xmax=slide_info.level_dimensions[-1][0], ymin=0,
+                                                  ymax=slide_info.level_dimensions[-1][1],
                                                   patch_size=high_zoom_patch_size)
             
             # background threshold is hard coded to 245 (/255) to be highly specific (only remove bg that we are certain)
-            shared = (WSI_object, high_zoom_patch_size, high_zoom_vis, 245)
-            with WorkerPool(n_jobs=60, start_method='fork') as pool:
-                pool.set_shared_objects(shared)
-                results = pool.map(patch_background_fraction,
-                                   list(downsample_factor * high_zoom_edges_to_test),  
-                                   progress_bar=False)
-                # (!) Need to multiply high_zoom_edges_to_test by downsample_factor because openslide uses the lowest zoom coordinates for locations.
-                
+            img = self.thumbnails.read(row['SVS_PATH'], slide_info.level_downsamples[high_zoom_vis],
+                                       out_size=slide_info.level_dimensions[high_zoom_vis])
+            results = background_fractions(slide_info, high_zoom_vis, high_zoom_patch_size, 245, img=img)
+
             # Extract the non-background edges and scale them to match the lowest zoom level.
             estimated_low_zoom_non_background_edges = downsample_factor * high_zoom_edges_to_test[np.array(results) < background_fraction_threshold, :]
 
@@ -312,4 +349,4 @@ class Preprocessor:
             df = pd.concat([df, cur_dataset], ignore_index=True)
 
         print('--------------------------------------------------------------------------------')
-        return df
+        return compact_tile_dataframe(df)
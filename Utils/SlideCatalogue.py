@@ -0,0 +1,242 @@
+"""
+Local catalogue of whole-slide image metadata.
+
+Preprocessing, inference and reports often open slides only to read their header: level dimensions, downsamples,
+MPP... Parsing an SVS header is expensive (all the tile offsets of every level are read), so SlideCatalogue stores
+this metadata in a local SQLite database, keyed by slide id (id_external, i.e. the file name without extension by
+default), and fills it once per slide.
+
+Entries are validated against the file on each get(): when its size and modification time are unchanged, the stored
+metadata is returned without opening the slide. Otherwise a content hash (of the size and of the first and last MiB
+of the file; hashing multi-GB slides entirely would cost as much as reading them) is compared with the stored one:
+an identical file (e.g. downloaded again) only has its mtime refreshed, anything else is read again. lookup() returns
+the stored metadata without touching the file at all.
+
+The database can be used concurrently by several processes (DataLoader workers, DDP ranks): it is opened in WAL
+mode, with one connection per process.
+
+Usage, to fill the catalogue of a folder of slides and print it:
+    python -m Utils.SlideCatalogue <catalogue.sqlite> <slides or folders>
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+import openslide
+
+HASH_SAMPLE = 1 << 20  # bytes hashed at each end of the file
+
+SLIDE_SUFFIXES = ('.svs', '.tif', '.tiff', '.ndpi', '.mrxs', '.scn')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS slides (
+    slide_id          TEXT PRIMARY KEY,
+    path              TEXT NOT NULL,
+    size              INTEGER NOT NULL,
+    mtime_ns          INTEGER NOT NULL,
+    hash              TEXT NOT NULL,
+    vendor            TEXT,
+    mpp_x             REAL,
+    mpp_y             REAL,
+    objective_power   REAL,
+    tile_width        INTEGER,
+    tile_height       INTEGER,
+    level_dimensions  TEXT NOT NULL,
+    level_downsamples TEXT NOT NULL,
+    updated           REAL NOT NULL
+)
+"""
+
+_COLUMNS = ['slide_id', 'path', 'size', 'mtime_ns', 'hash', 'vendor', 'mpp_x', 'mpp_y', 'objective_power',
+            'tile_width', 'tile_height', 'level_dimensions', 'level_downsamples', 'updated']
+
+
+def content_hash(path, size=None):
+    # Hash of the size and of the first and last HASH_SAMPLE bytes of the file.
+    size = os.path.getsize(path) if size is None else size
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, 'rb') as f:
+        digest.update(f.read(HASH_SAMPLE))
+        if size > HASH_SAMPLE:
+            f.seek(max(HASH_SAMPLE, size - HASH_SAMPLE))
+            digest.update(f.read(HASH_SAMPLE))
+    return digest.hexdigest()
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SlideInfo:
+    # Header metadata of a slide, with the openslide.OpenSlide attributes used for geometry (level_count,
+    # level_dimensions, level_downsamples, dimensions, get_best_level_for_downsample), so that it can replace an open
+    # slide wherever no pixels are read.
+    def __init__(self, slide_id, path, size, mtime_ns, hash, vendor, mpp_x, mpp_y, objective_power, tile_width,
+                 tile_height, level_dimensions, level_downsamples, updated):
+        self.slide_id          = slide_id
+        self.path              = path
+        self.size              = size
+        self.mtime_ns          = mtime_ns
+        self.hash              = hash
+        self.vendor            = vendor
+        self.mpp               = (mpp_x, mpp_y)
+        self.objective_power   = objective_power
+        self.tile_size         = (tile_width, tile_height) if tile_width and tile_height else None
+        self.level_dimensions  = tuple(tuple(d) for d in json.loads(level_dimensions))
+        self.level_downsamples = tuple(json.loads(level_downsamples))
+        self.updated           = updated
+
+    @property
+    def level_count(self):
+        return len(self.level_dimensions)
+
+    @property
+    def dimensions(self):
+        return self.level_dimensions[0]
+
+    def get_best_level_for_downsample(self, downsample):
+        candidates = [level for level, d in enumerate(self.level_downsamples) if d <= downsample]
+        return max(candidates) if candidates else 0
+
+    def __repr__(self):
+        return 'SlideInfo({!r}: {} levels, {}x{}, mpp {}, {})'.format(self.slide_id, self.level_count,
+                                                                   *self.dimensions, self.mpp, self.vendor)
+
+
+def read_header(path):
+    # Metadata columns of a slide, read with openslide.
+    slide = openslide.OpenSlide(str(path))
+    try:
+        properties = slide.properties
+        return {'vendor':            properties.get(openslide.PROPERTY_NAME_VENDOR),
+                'mpp_x':             _float(properties.get(openslide.PROPERTY_NAME_MPP_X)),
+                'mpp_y':             _float(properties.get(openslide.PROPERTY_NAME_MPP_Y)),
+                'objective_power':   _float(properties.get(openslide.PROPERTY_NAME_OBJECTIVE_POWER)),
+                'tile_width':        _int(properties.get('openslide.level[0].tile-width')),
+                'tile_height':       _int(properties.get('openslide.level[0].tile-height')),
+                'level_dimensions':  json.dumps([list(d) for d in slide.level_dimensions]),
+                'level_downsamples': json.dumps(list(slide.level_downsamples))}
+    finally:
+        slide.close()
+
+
+class SlideCatalogue:
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {'db_path': self.db_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['db_path'])
+
+    def _connection(self):
+        # One connection per process: connections inherited through fork() are not used.
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(_SCHEMA)
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def lookup(self, slide_id):
+        # Stored SlideInfo of slide_id (None if not catalogued), without checking the file.
+        with self._lock:
+            row = self._connection().execute('SELECT {} FROM slides WHERE slide_id = ?'.format(', '.join(_COLUMNS)),
+                                             (str(slide_id),)).fetchone()
+        return None if row is None else SlideInfo(*row)
+
+    def get(self, path, slide_id=None):
+        # SlideInfo of the slide at path, read from its header only if it is not catalogued or if the file changed.
+        path = str(path)
+        slide_id = Path(path).stem if slide_id is None else str(slide_id)
+        stat = os.stat(path)
+        info = self.lookup(slide_id)
+        if info is not None and info.path == path and info.size == stat.st_size and info.mtime_ns == stat.st_mtime_ns:
+            return info
+
+        digest = content_hash(path, stat.st_size)
+        if info is not None and info.size == stat.st_size and info.hash == digest:
+            # Same content (e.g. copied or downloaded again): only the file attributes changed.
+            with self._lock:
+                conn = self._connection()
+                conn.execute('UPDATE slides SET path = ?, mtime_ns = ?, updated = ? WHERE slide_id = ?',
+                             (path, stat.st_mtime_ns, time.time(), slide_id))
+                conn.commit()
+            return self.lookup(slide_id)
+
+        row = dict(read_header(path), slide_id=slide_id, path=path, size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                   hash=digest, updated=time.time())
+        with self._lock:
+            conn = self._connection()
+            conn.execute('INSERT OR REPLACE INTO slides ({}) VALUES ({})'.format(', '.join(_COLUMNS),
+                                                                               ', '.join('?' * len(_COLUMNS))),
+                         [row[column] for column in _COLUMNS])
+            conn.commit()
+        return SlideInfo(*[row[column] for column in _COLUMNS])
+
+    def update(self, paths, slide_ids=None):
+        # Catalogues (or validates) several slides; returns their SlideInfo.
+        paths = [str(path) for path in paths]
+        slide_ids = [None] * len(paths) if slide_ids is None else list(slide_ids)
+        return [self.get(path, slide_id) for path, slide_id in zip(paths, slide_ids)]
+
+    def invalidate(self, slide_id):
+        with self._lock:
+            conn = self._connection()
+            conn.execute('DELETE FROM slides WHERE slide_id = ?', (str(slide_id),))
+            conn.commit()
+
+    def slide_ids(self):
+        with self._lock:
+            return [row[0] for row in self._connection().execute('SELECT slide_id FROM slides ORDER BY slide_id')]
+
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute('SELECT COUNT(*) FROM slides').fetchone()[0]
+
+
+def catalogue_path(config):
+    # DATA.Slide_Catalogue, or slide_catalogue.sqlite in the SVS folder.
+    return config['DATA'].get('Slide_Catalogue', None) or os.path.join(config['DATA']['SVS_Folder'], 'slide_catalogue.sqlite')
+
+
+# Catalogues opened by this process, by database path.
+_catalogues = {}
+
+
+def get_slide_catalogue(db_path):
+    db_path = str(db_path)
+    if db_path not in _catalogues:
+        _catalogues[db_path] = SlideCatalogue(db_path)
+    return _catalogues[db_path]
+
+
+if __name__ == '__main__':
+    catalogue = get_slide_catalogue(sys.argv[1])
+    paths = []
+    for arg in sys.argv[2:]:
+        arg = Path(arg)
+        paths += sorted(p for p in arg.iterdir() if p.suffix.lower() in SLIDE_SUFFIXES) if arg.is_dir() else [arg]
+    for path in paths:
+        print(catalogue.get(path))
+    print('{} slides in {}.'.format(len(catalogue), catalogue.db_path))
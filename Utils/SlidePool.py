@@ -0,0 +1,146 @@
+import os
+import threading
+from collections import OrderedDict
+import openslide
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def default_max_open():
+    # Number of slide handles a single process may keep open. Each handle holds one or more file descriptors, and a
+    # DataLoader runs one pool per worker, so stay well below the soft RLIMIT_NOFILE of the process.
+    if resource is None:
+        return 64
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return 64
+    return int(max(4, min(64, soft // 8)))
+
+
+class SlidePool:
+    """
+    Bounded LRU pool of open whole-slide image handles.
+
+    Opening a slide (and parsing its SVS/TIFF header) is expensive, so datasets should ask the pool for a handle
+    instead of re-opening the file for every tile. At most max_open handles are kept; the least recently used one is
+    closed when the limit is reached.
+
+    The pool is process-local: handles inherited through fork() are dropped (never used, never closed) the first
+    time the pool is accessed in the child, and the pool pickles without its handles, so it is also safe to send
+    to workers started with spawn.
+    """
+
+    def __init__(self, opener=openslide.open_slide, max_open=None):
+        self.opener = opener
+        self.max_open = default_max_open() if max_open is None else int(max_open)
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __contains__(self, path):
+        return str(path) in self._handles
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_handles'] = OrderedDict()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        # After a fork the handles belong to the parent: forget them and start from an empty pool.
+        if self._pid != os.getpid():
+            self._handles = OrderedDict()
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    def get(self, path):
+        self._check_pid()
+        key = str(path)
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None:
+                self._handles.move_to_end(key)
+                return handle
+
+        handle = self.opener(key)  # open outside the lock, as parsing the header can be slow
+
+        with self._lock:
+            if key in self._handles:  # another thread opened it in the meantime
+                _close(handle)
+                self._handles.move_to_end(key)
+                return self._handles[key]
+            self._handles[key] = handle
+            while len(self._handles) > self.max_open:
+                _, evicted = self._handles.popitem(last=False)
+                _close(evicted)
+        return handle
+
+    def close(self, path):
+        self._check_pid()
+        with self._lock:
+            handle = self._handles.pop(str(path), None)
+        if handle is not None:
+            _close(handle)
+
+    def close_all(self):
+        self._check_pid()
+        with self._lock:
+            handles = list(self._handles.values())
+            self._handles.clear()
+        for handle in handles:
+            _close(handle)
+
+
+def _close(handle):
+    close = getattr(handle, 'close', None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            pass
+
+
+def default_wsi_backend():
+    # MONAI WSIReader backend used by DataGenerator: cuCIM when installed, OpenSlide otherwise.
+    try:
+        import cucim  # noqa: F401
+        return 'cuCIM'
+    except ImportError:
+        return 'OpenSlide'
+
+
+# One pool per backend and per process, shared by every Dataset living in that process.
+_pools = {}
+
+
+def get_slide_pool(backend='openslide', opener=None, max_open=None):
+    # Returns the process-wide pool for a backend, creating it with the given opener on first use.
+    pool = _pools.get(backend)
+    if pool is None:
+        pool = SlidePool(opener=openslide.open_slide if opener is None else opener, max_open=max_open)
+        _pools[backend] = pool
+    return pool
+
+
+def open_slide(path):
+    # Drop-in replacement for openslide.open_slide that reuses handles from the process-wide pool.
+    return get_slide_pool('openslide').get(path)
+
+
+def _reset_after_fork():
+    _pools.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,153 @@
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import openslide
+from PIL import Image, PngImagePlugin
+from Utils.NativeTileReader import read_region_downsampled
+from Utils.SlideCatalogue import get_slide_catalogue, catalogue_path
+
+# Low-resolution copies of whole slides, shared by the pipeline.
+#
+# Background detection (Preprocessor.getAllTiles), QA overlays (Create_Contours_Overlay_QA, generate_overlay,
+# visHeatmap) and registration each need a low-resolution image of the whole slide, and each used to read its own.
+# ThumbnailCache keeps, for each slide, thumbnails at a few fixed resolutions (in microns per pixel, so that slides
+# scanned at 20x and 40x get comparable thumbnails), stored as lossless PNG files in a thumbnail folder, with their
+# scale factors (level 0 pixels per thumbnail pixel) and the content hash of the slide in the PNG metadata. A
+# thumbnail is generated on first access (with read_region_downsampled, i.e. from the best pyramid level or with
+# JPEG DCT scaling), and generated again if the slide changed (see Utils.SlideCatalogue).
+#
+# read() returns the whole slide at any downsample coarser than or equal to a cached thumbnail by resizing the finest
+# thumbnail that is fine enough, so that consumers at different pyramid levels share the same file. Finer reads are
+# read from the slide directly (and not cached).
+
+SCALE_KEY = 'DigitalPathologyAI.scale'
+HASH_KEY = 'DigitalPathologyAI.hash'
+DEFAULT_MPP = 0.25  # assumed for slides without MPP metadata (40x)
+
+
+class ThumbnailCache:
+    def __init__(self, folder, mpps=(4.0,), catalogue=None, opener=openslide.open_slide, max_in_memory=4):
+        # mpps: resolutions of the thumbnails kept for each slide, in microns per pixel.
+        # catalogue: Utils.SlideCatalogue.SlideCatalogue used for slide metadata (one in folder by default).
+        # opener: returns a new handle for a slide path, closed after each read (not a pooled handle).
+        self.folder        = Path(folder)
+        self.mpps          = sorted(float(mpp) for mpp in mpps)
+        if catalogue is None:
+            catalogue = get_slide_catalogue(self.folder / 'slide_catalogue.sqlite')
+        self.catalogue     = catalogue
+        self.opener        = opener
+        self.max_in_memory = int(max_in_memory)
+        self._images       = OrderedDict()  # (path, mpp): (hash, (image, scale)), last thumbnails used in this process
+        self._lock         = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = OrderedDict()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _path(self, slide_id, mpp):
+        return self.folder / '{}_mpp{:g}.png'.format(slide_id, mpp)
+
+    def _downsample(self, info, mpp):
+        # Level 0 pixels per thumbnail pixel at mpp.
+        slide_mpp = info.mpp[0] or DEFAULT_MPP
+        return max(1., mpp / slide_mpp)
+
+    def _load(self, png_path, digest):
+        # (image, scale) of a stored thumbnail, or None if missing or made from another version of the slide.
+        if not png_path.exists():
+            return None
+        with Image.open(png_path) as image:
+            if image.text.get(HASH_KEY) != digest:
+                return None
+            scale = tuple(float(s) for s in image.text[SCALE_KEY].split(','))
+            return np.asarray(image.convert('RGB')), scale
+
+    def _read_slide(self, path, dimensions, downsample, out_size):
+        # Whole slide read directly, closing the handle (and its file descriptors) right away.
+        slide = self.opener(path)
+        try:
+            return read_region_downsampled(slide, (0, 0), dimensions, downsample, out_size=out_size)
+        finally:
+            slide.close()
+
+    def _generate(self, path, info, mpp, png_path):
+        downsample = self._downsample(info, mpp)
+        width, height = info.dimensions
+        out_size = (max(1, int(round(width / downsample))), max(1, int(round(height / downsample))))
+        image = self._read_slide(path, (width, height), downsample, out_size)
+        scale = (width / out_size[0], height / out_size[1])
+
+        metadata = PngImagePlugin.PngInfo()
+        metadata.add_text(SCALE_KEY, '{!r},{!r}'.format(*scale))
+        metadata.add_text(HASH_KEY, info.hash)
+        png_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = png_path.with_name('.{}.{}.tmp'.format(png_path.name, os.getpid()))  # hidden until complete
+        Image.fromarray(image).save(tmp_path, format='PNG', pnginfo=metadata)
+        os.replace(tmp_path, png_path)
+        return image, scale
+
+    def thumbnail(self, path, mpp=None, slide_id=None):
+        # (uint8 (H, W, 3) image, (x, y) level 0 pixels per image pixel) of the slide at mpp (the finest cached
+        # resolution by default), generated if needed.
+        path = str(path)
+        mpp = self.mpps[0] if mpp is None else float(mpp)
+        info = self.catalogue.get(path, slide_id)
+        key = (path, mpp)
+        with self._lock:
+            cached = self._images.get(key)
+            if cached is not None and cached[0] == info.hash:
+                self._images.move_to_end(key)
+                return cached[1]
+
+        png_path = self._path(info.slide_id, mpp)
+        thumbnail = self._load(png_path, info.hash)
+        if thumbnail is None:
+            thumbnail = self._generate(path, info, mpp, png_path)
+
+        with self._lock:
+            self._images[key] = (info.hash, thumbnail)
+            self._images.move_to_end(key)
+            while len(self._images) > self.max_in_memory:
+                self._images.popitem(last=False)
+        return thumbnail
+
+    def read(self, path, downsample, out_size=None, slide_id=None):
+        # Uint8 (H, W, 3) image of the whole slide at downsample (or of out_size = (width, height) if given), like
+        # read_region_downsampled(slide, (0, 0), dimensions, downsample, out_size), from the finest cached thumbnail
+        # that is not coarser than requested.
+        path = str(path)
+        info = self.catalogue.get(path, slide_id)
+        width, height = info.dimensions
+        if out_size is None:
+            out_size = (max(1, int(round(width / downsample))), max(1, int(round(height / downsample))))
+        out_size = (int(out_size[0]), int(out_size[1]))
+
+        fine_enough = [mpp for mpp in self.mpps if self._downsample(info, mpp) <= downsample * (1 + 1e-3)]
+        if not fine_enough:
+            return self._read_slide(path, (width, height), downsample, out_size)
+        image, _ = self.thumbnail(path, max(fine_enough), slide_id)
+        if (image.shape[1], image.shape[0]) != out_size:
+            image = np.asarray(Image.fromarray(image).resize(out_size, Image.BILINEAR))
+        return image
+
+
+# Thumbnail caches opened by this process, by folder.
+_caches = {}
+
+
+def get_thumbnail_cache(config, opener=openslide.open_slide):
+    # ThumbnailCache of DATA.Thumbnail_Folder (<SVS_Folder>/thumbnails by default) at the resolutions of
+    # DATA.Thumbnail_MPP, using the slide catalogue of the config.
+    folder = config['DATA'].get('Thumbnail_Folder', None) or os.path.join(config['DATA']['SVS_Folder'], 'thumbnails')
+    if folder not in _caches:
+        _caches[folder] = ThumbnailCache(folder, mpps=config['DATA'].get('Thumbnail_MPP', [4.0]),
+                                         catalogue=get_slide_catalogue(catalogue_path(config)), opener=opener)
+    return _caches[folder]
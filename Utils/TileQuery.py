@@ -0,0 +1,154 @@
+"""
+Cohort-level queries over the per-slide tile tables (see Utils.TileTable).
+
+    tumour_tiles = TileQuery(SVS_dataset).select('coords_x', 'coords_y', 'SVS_PATH', 'id_external')
+                                         .where('prob_tissue_type_Tumour', '>', 0.94)
+                                         .collect()
+
+Queries are lazy: nothing is read until collect() or iter_slides(). Slides are then read by a pool of threads, only
+the selected and filtered columns are read, and predicates on the Parquet base tables are pushed down to the reader
+(row groups whose statistics cannot match are skipped, non-matching rows are never converted to pandas). Predicates on
+appended result columns (which override base columns of the same name), or on legacy .npy tables, are applied per
+slide right after reading it, so the memory used is bounded by the matching rows plus a few slides in flight, never by
+the whole cohort. With compact=True (default), each slide is converted to the compact tile table schema (see
+Utils.TileTable.compact_tile_dataframe) as it is read.
+"""
+import operator
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from Utils.TileTable import tile_table_path, tile_table_columns, read_tile_columns, compact_tile_dataframe, concat_tile_dataframes, \
+    _column_files
+
+_OPERATORS = {'==': operator.eq, '=': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le,
+              '>': operator.gt, '>=': operator.ge}
+
+
+class TileQuery:
+    # SVS_dataset: DataFrame with a NPY_PATH column (as returned by QueryImageFromCriteria), or a list of NPY paths.
+    # Tile tables are located from NPY_PATH: the Parquet table next to it if it exists, the .npy file otherwise.
+
+    def __init__(self, SVS_dataset, columns=None, filters=None, num_threads=8, skip_errors=False, compact=True,
+                 label_columns=()):
+        if isinstance(SVS_dataset, pd.DataFrame):
+            self.npy_paths = list(SVS_dataset['NPY_PATH'])
+        else:
+            self.npy_paths = [str(p) for p in SVS_dataset]
+        self.columns     = None if columns is None else list(columns)
+        self.filters     = list(filters) if filters else []
+        self.num_threads = num_threads
+        self.skip_errors = skip_errors
+        self.compact     = compact
+        self.label_columns = list(label_columns)
+        self.failed      = []  # NPY paths that could not be read, when skip_errors
+
+        for column, op, value in self.filters:
+            if op not in _OPERATORS and op not in ('in', 'not in'):
+                raise ValueError('Unsupported operator {} in filter on {}.'.format(op, column))
+
+    def _replace(self, **kwargs):
+        args = dict(SVS_dataset=self.npy_paths, columns=self.columns, filters=self.filters,
+                    num_threads=self.num_threads, skip_errors=self.skip_errors, compact=self.compact,
+                    label_columns=self.label_columns)
+        args.update(kwargs)
+        return TileQuery(**args)
+
+    def select(self, *columns):
+        # Only these columns are returned (the index is always kept).
+        return self._replace(columns=columns)
+
+    def where(self, column, op, value):
+        # Keeps tiles for which `column op value` holds; op is one of == != < <= > >= in, not in.
+        # Successive where() calls are combined with a logical and.
+        return self._replace(filters=self.filters + [(column, op, value)])
+
+    def read_slide(self, npy_path):
+        # Matching rows of a single slide, sorted by tile index.
+        read_columns = None
+        if self.columns is not None:
+            read_columns = list(dict.fromkeys(self.columns + [f[0] for f in self.filters]))
+
+        # Appended result columns override the base table: their predicates are applied after the merge only.
+        column_files = _column_files(npy_path)
+        appended_columns = {name for path in column_files for name in tile_table_columns(path)}
+
+        parquet_path = tile_table_path(npy_path)
+        if parquet_path.exists():
+            base_columns = tile_table_columns(parquet_path)
+            pushed = [f for f in self.filters if f[0] in base_columns and f[0] not in appended_columns]
+            df = pq.read_table(parquet_path,
+                               columns=None if read_columns is None else [c for c in read_columns if c in base_columns],
+                               filters=[_arrow_filter(f) for f in pushed] or None,
+                               use_pandas_metadata=True).to_pandas()
+        else:
+            npy_dict = np.load(npy_path, allow_pickle=True).item()
+            _, df = next(iter(npy_dict.values()))
+            base_columns = list(df.columns)
+            pushed = []
+            if read_columns is not None:
+                df = df[[c for c in read_columns if c in base_columns]]
+
+        # Appended result columns (see Utils.TileTable.append_tile_columns), then the remaining predicates.
+        appended = read_tile_columns(npy_path, columns=read_columns, column_files=column_files)
+        if appended is not None:
+            df = df.drop(columns=[c for c in appended.columns if c in df.columns]).join(appended, how='left')
+        for f in self.filters:
+            if f not in pushed:
+                df = df[_mask(df, *f)]
+
+        if self.columns is not None:
+            df = df[[c for c in self.columns if c in df.columns]]
+        if self.compact:
+            df = compact_tile_dataframe(df, label_columns=self.label_columns)
+        return df.sort_index()
+
+    def _safe_read(self, npy_path):
+        try:
+            return self.read_slide(npy_path)
+        except Exception as e:
+            if not self.skip_errors:
+                raise
+            print('Could not read tile table of {}: {}'.format(npy_path, e))
+            self.failed.append(npy_path)
+            return None
+
+    def iter_slides(self):
+        # Yields (npy_path, matching rows) slide by slide, in order, with at most 2 * num_threads slides in flight.
+        window = 2 * max(1, self.num_threads)
+        with ThreadPoolExecutor(max_workers=max(1, self.num_threads)) as pool:
+            futures = [pool.submit(self._safe_read, p) for p in self.npy_paths[:window]]
+            for n, npy_path in enumerate(self.npy_paths):
+                df = futures[n].result()
+                futures[n] = None
+                if n + window < len(self.npy_paths):
+                    futures.append(pool.submit(self._safe_read, self.npy_paths[n + window]))
+                if df is not None:
+                    yield npy_path, df
+
+    def collect(self):
+        # All matching rows, as a single DataFrame.
+        dfs = [df for _, df in self.iter_slides()]
+        if not dfs:
+            return pd.DataFrame(columns=self.columns)
+        return concat_tile_dataframes(dfs) if self.compact else pd.concat(dfs, axis=0)
+
+    def count(self):
+        return sum(len(df) for _, df in self.iter_slides())
+
+
+def _arrow_filter(f):
+    column, op, value = f
+    if op in ('in', 'not in'):
+        value = list(value)
+    return column, '==' if op == '=' else op, value
+
+
+def _mask(df, column, op, value):
+    if column not in df.columns:  # e.g. results not computed for this slide: missing values never match
+        return np.zeros(len(df), dtype=bool)
+    if op == 'in':
+        return df[column].isin(list(value))
+    if op == 'not in':
+        return ~df[column].isin(list(value))
+    return _OPERATORS[op](df[column], value).fillna(False).astype(bool)
@@ -0,0 +1,221 @@
+"""
+Columnar per-slide tile tables.
+
+Each slide's tile table (the DataFrame historically pickled as [config, df] inside patches/{SVS_ID}.npy) is stored as
+a Parquet file, patches/{SVS_ID}.parquet, with the config stored as json in the file metadata. Tables are read
+without unpickling anything, and only the requested columns are read from disk.
+
+Results computed later (e.g. prob_<label>_<class> predictions) are appended as column files in
+patches/{SVS_ID}.columns/, one Parquet file per write holding the tile index and the new columns only. Files are
+committed atomically (written to a temporary name, then renamed) under unique names, so writes cost O(new data) and
+any number of processes can append concurrently. Readers merge them onto the base table (merge-on-read), the most
+recent file winning for columns written more than once; compact_tile_table folds them into the base table.
+
+In memory, tile tables are compacted by compact_tile_dataframe (applied on load and on save): int32 coordinates,
+categorical paths/ids/labels and float16 probabilities, which makes multi-million-tile cohort tables several times
+smaller (and cheaper to copy into DataLoader workers). Parquet files store float16 columns as float32.
+
+Usage, to convert existing .npy files:
+    python Utils/TileTable.py <patches folder or .npy files>
+"""
+import json
+import os
+import socket
+import sys
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+TILE_TABLE_SUFFIX = '.parquet'
+
+# In-memory schema, see compact_tile_dataframe.
+COORD_COLUMNS = ['coords_x', 'coords_y']
+CATEGORY_COLUMNS = ['SVS_PATH', 'NPY_PATH', 'SVS_ID', 'id_external', 'id_internal']
+PROB_PREFIX = 'prob_'
+CONFIG_KEY = b'DigitalPathologyAI.config'
+BASEMODEL_KEY = b'DigitalPathologyAI.basemodel'
+
+
+def compact_tile_dataframe(df, label_columns=(), prob_dtype=np.float16, max_category_fraction=0.5):
+    # Returns df with the compact tile table schema:
+    #   coords_x/coords_y                         int32 (if their range allows it),
+    #   SVS_PATH, id_external, ... label_columns  categorical,
+    #   prob_* float columns                      prob_dtype (float16: ~3 significant digits, plenty for probabilities),
+    #   other text columns                        categorical, if they have few distinct values.
+    # Columns are converted one at a time on a shallow copy, so the peak memory is the table plus one column.
+    df = df.copy(deep=False)
+    category_columns = set(CATEGORY_COLUMNS) | {c for c in label_columns if c}
+    for column in df.columns:
+        values = df[column]
+        if column in COORD_COLUMNS and pd.api.types.is_numeric_dtype(values) and values.dtype != np.int32:
+            if len(values) == 0 or (values.notna().all() and values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+                df[column] = values.astype(np.int32)
+        elif str(column).startswith(PROB_PREFIX) and pd.api.types.is_float_dtype(values):
+            df[column] = values.astype(prob_dtype)
+        elif pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                continue
+            if column in category_columns or values.nunique() <= max_category_fraction * len(values):
+                df[column] = values.astype('category')
+    return df
+
+
+def concat_tile_dataframes(dfs):
+    # pd.concat for compacted tile tables: categorical columns keep their dtype (pd.concat falls back to object when
+    # the categories of the inputs differ, e.g. one SVS_PATH per slide).
+    dfs = list(dfs)
+    if len(dfs) > 1:
+        for column in dfs[0].columns:
+            if all(column in df.columns and isinstance(df[column].dtype, pd.CategoricalDtype) for df in dfs):
+                categories = pd.api.types.union_categoricals([df[column] for df in dfs]).categories
+                for df in dfs:
+                    df[column] = df[column].cat.set_categories(categories)
+    return pd.concat(dfs, axis=0)
+
+
+def memory_report(df, name='Tile table'):
+    # Prints and returns the memory used by df (deep, i.e. including strings), with the largest columns.
+    usage = df.memory_usage(deep=True)
+    total = int(usage.sum())
+    largest = ', '.join('{} {:.1f} MB'.format(c, usage[c] / 1024 ** 2) for c in usage.drop('Index').nlargest(5).index)
+    print('{}: {} tiles, {:.1f} MB ({}).'.format(name, len(df), total / 1024 ** 2, largest))
+    return total
+
+
+def _to_arrow(df):
+    # Arrow's Parquet writer does not support float16: store float16 columns as float32.
+    half_columns = [c for c in df.columns if df[c].dtype == np.float16]
+    if half_columns:
+        df = df.astype({c: np.float32 for c in half_columns})
+    return pa.Table.from_pandas(df, preserve_index=True)
+
+
+def tile_table_path(npy_path):
+    # Parquet tile table stored next to (and instead of) a patches/{SVS_ID}.npy file.
+    return Path(npy_path).with_suffix(TILE_TABLE_SUFFIX)
+
+
+def write_tile_table(path, config, df, basemodel_str=None):
+    # Writes df (index included) to path, with config as json metadata. The file is written to a temporary file and
+    # renamed, so that readers never see a partial table.
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    table = _to_arrow(df)
+    metadata = dict(table.schema.metadata or {})
+    metadata[CONFIG_KEY] = json.dumps(config, default=str).encode()
+    if basemodel_str is not None:
+        metadata[BASEMODEL_KEY] = basemodel_str.encode()
+    table = table.replace_schema_metadata(metadata)
+
+    tmp_path = path.with_name(path.name + '.{}.tmp'.format(os.getpid()))
+    pq.write_table(table, tmp_path)
+    tmp_path.replace(path)
+    return str(path)
+
+
+def read_tile_table(path, columns=None):
+    # Returns (config, df). With columns, only these columns (and the index) are read.
+    table = pq.read_table(path, columns=columns, use_pandas_metadata=True)
+    return read_tile_table_config(path), table.to_pandas()
+
+
+def read_tile_table_config(path):
+    # Reads the config stored with a tile table, from the file footer only.
+    metadata = pq.read_schema(path).metadata or {}
+    return json.loads(metadata[CONFIG_KEY]) if CONFIG_KEY in metadata else {}
+
+
+def tile_table_columns(path):
+    return [name for name in pq.read_schema(path).names if not name.startswith('__index_level_')]
+
+
+def tile_columns_dir(npy_path):
+    return Path(npy_path).with_suffix('.columns')
+
+
+def append_tile_columns(npy_path, df, name='columns'):
+    # Appends the columns of df (indexed by tile id, i.e. the index of the base table) for the slide of npy_path.
+    # File names start with a nanosecond timestamp, which sets the merge order, followed by host and pid to keep
+    # concurrent writers apart.
+    columns_dir = tile_columns_dir(npy_path)
+    columns_dir.mkdir(parents=True, exist_ok=True)
+    path = columns_dir / '{:020d}-{}-{}-{}{}'.format(time.time_ns(), socket.gethostname(), os.getpid(), name,
+                                                     TILE_TABLE_SUFFIX)
+    tmp_path = path.with_name('.' + path.name + '.tmp')  # hidden until committed
+    pq.write_table(_to_arrow(df), tmp_path)
+    tmp_path.replace(path)
+    return str(path)
+
+
+def _column_files(npy_path):
+    columns_dir = tile_columns_dir(npy_path)
+    return sorted(columns_dir.glob('[0-9]*' + TILE_TABLE_SUFFIX)) if columns_dir.exists() else []
+
+
+def read_tile_columns(npy_path, columns=None, column_files=None):
+    # Merged view of all columns appended for the slide of npy_path (None if there are none). With columns, only
+    # these columns are read.
+    merged = None
+    for path in _column_files(npy_path) if column_files is None else column_files:
+        names = tile_table_columns(path)
+        if columns is not None:
+            names = [name for name in names if name in columns]
+            if not names:
+                continue
+        part = pq.read_table(path, columns=names, use_pandas_metadata=True).to_pandas()
+        merged = part if merged is None else part.combine_first(merged)  # later files win
+    return merged
+
+
+def merge_tile_columns(df, npy_path, columns=None):
+    # Joins the appended columns of the slide of npy_path onto its base table df.
+    appended = read_tile_columns(npy_path, columns=columns)
+    if appended is None:
+        return df
+    df = df.drop(columns=[c for c in appended.columns if c in df.columns])
+    return df.join(appended, how='left')
+
+
+def compact_tile_table(npy_path, config=None):
+    # Folds the appended column files into the Parquet base table of the slide of npy_path (converting a legacy .npy
+    # base table if needed). Only the files present when compaction starts are removed, so concurrent appends are kept.
+    column_files = _column_files(npy_path)
+    parquet_path = tile_table_path(npy_path)
+    if parquet_path.exists():
+        base_config, df = read_tile_table(parquet_path)
+    else:
+        npy_dict = np.load(npy_path, allow_pickle=True).item()
+        base_config, df = next(iter(npy_dict.values()))
+    appended = read_tile_columns(npy_path, column_files=column_files)
+    if appended is not None:
+        df = df.drop(columns=[c for c in appended.columns if c in df.columns]).join(appended, how='left')
+    write_tile_table(parquet_path, base_config if config is None else config, df)
+    for path in column_files:
+        path.unlink()
+    return str(parquet_path)
+
+
+def convert_npy_to_tile_table(npy_path, key=None, overwrite=False):
+    # Converts a legacy patches/{SVS_ID}.npy file ({basemodel_str: [config, df]}) to a Parquet tile table.
+    # key selects the basemodel_str to convert (default: the first one, as in LoadFileParameter).
+    parquet_path = tile_table_path(npy_path)
+    if parquet_path.exists() and not overwrite:
+        return str(parquet_path)
+    npy_dict = np.load(npy_path, allow_pickle=True).item()
+    key = next(iter(npy_dict)) if key is None else key
+    config, df = npy_dict[key]
+    return write_tile_table(parquet_path, config, df, basemodel_str=key)
+
+
+if __name__ == '__main__':
+    npy_files = []
+    for arg in sys.argv[1:]:
+        npy_files += sorted(Path(arg).glob('*.npy')) if Path(arg).is_dir() else [Path(arg)]
+    for npy_file in npy_files:
+        try:
+            print('{} -> {}'.format(npy_file, convert_npy_to_tile_table(npy_file)))
+        except Exception as e:
+            print('Could not convert {}: {}'.format(npy_file, e))
@@ -2,6 +2,7 @@ import numpy as np
 from PIL import Image
 from matplotlib import pyplot as plt
 import cv2
+from Utils.NativeTileReader import read_region_downsampled
 
 
 def get_downsample(WSI_object, vis_level):
@@ -12,7 +13,9 @@ def get_downsample(WSI_object, vis_level):
     return estimated_downsample
 
 
-def block_blending(img, WSI_object, vis_level, top_left, bot_right, alpha=0.5, block_size=1024):
+def block_blending(img, WSI_object, vis_level, top_left, bot_right, alpha=0.5, block_size=1024, canvas=None):
+    # canvas: optional (h, w, 3) image of the slide at vis_level, already read by the caller. If given, blend blocks
+    # are cut from it instead of being read again from WSI_object.
     downsample = get_downsample(WSI_object, vis_level)
     w = img.shape[1]
     h = img.shape[0]
@@ -40,17 +43,20 @@ def block_blending(img, WSI_object, vis_level, top_left, bot_right, alpha=0.5, b
             blend_block_size = (x_end_img - x_start_img, y_end_img - y_start_img)
 
             # 4. read actual wsi block as canvas block
-            pt = (x_start, y_start)
-            canvas = np.array(WSI_object.read_region(pt, vis_level, blend_block_size).convert("RGB"))
+            if canvas is None:
+                pt = (x_start, y_start)
+                canvas_block = np.array(WSI_object.read_region(pt, vis_level, blend_block_size).convert("RGB"))
+            else:
+                canvas_block = canvas[y_start_img:y_end_img, x_start_img:x_end_img].copy()
 
             # 5. blend color block and canvas block
-            img[y_start_img:y_end_img, x_start_img:x_end_img] = cv2.addWeighted(blend_block, alpha, canvas,
-                                                                                1 - alpha, 0, canvas)
+            img[y_start_img:y_end_img, x_start_img:x_end_img] = cv2.addWeighted(blend_block, alpha, canvas_block,
+                                                                                1 - alpha, 0, canvas_block)
     return img
 
 
 def generate_overlay(WSI_object=None, labels=None, coords=None, vis_level=2,
-                     patch_size=[256, 256], cmap=None, alpha=0.4):
+                     patch_size=[256, 256], cmap=None, alpha=0.4, canvas=None):
     # INPUT:
     # WSI_object: an instance of the class openslide, ex: WSI_object = openslide.open_slide(svs_filename).
     # labels: a (Ncoords, ) numpy array providing the label of each coordinate at coords
@@ -58,6 +64,8 @@ def generate_overlay(WSI_object=None, labels=None, coords=None, vis_level=2,
     # vis_level: visibility level to generate the overlay. See openslide for more info.
     # patch_size: list providing the original patch size
     # cmap: either a string pointing to a pyplot colormap name, or a matplotlib.colors.ListedColormap object.
+    # canvas: optional (h, w, 3) image of the whole slide at vis_level (e.g. from Utils.ThumbnailCache). If given, no
+    # pixels are read from WSI_object, which then only needs level_dimensions and level_downsamples.
 
     if isinstance(cmap, str):
         cmap = plt.get_cmap(cmap)
@@ -93,8 +101,12 @@ def generate_overlay(WSI_object=None, labels=None, coords=None, vis_level=2,
     overlay[~zero_mask] = overlay[~zero_mask] / counter[~zero_mask]
     del counter
 
-    # downsample original image and use as canvas
-    img = np.array(WSI_object.read_region(top_left, vis_level, (w, h)).convert("RGB"))
+    # downsample original image and use as canvas. With a NativeTileSlide, the pyramid level or JPEG DCT scale that
+    # decodes the fewest pixels is used (see Utils.NativeTileReader.read_region_downsampled).
+    if canvas is None:
+        canvas = read_region_downsampled(WSI_object, top_left, bot_right, WSI_object.level_downsamples[vis_level],
+                                         out_size=(w, h))
+    img = canvas.copy()
 
     twenty_percent_mark = max(1, int(len(scaled_coords) * 0.2))
 
@@ -114,7 +126,8 @@ def generate_overlay(WSI_object=None, labels=None, coords=None, vis_level=2,
 
     # Block blending
     if alpha < 1.0:
-        img = block_blending(img, WSI_object, vis_level, top_left, bot_right, alpha=alpha, block_size=1024)
+        img = block_blending(img, WSI_object, vis_level, top_left, bot_right, alpha=alpha, block_size=1024,
+                             canvas=canvas)
 
     heatmap = Image.fromarray(img)
 
@@ -29,7 +29,10 @@ def to_percentiles(scores):
     scores = rankdata(scores, 'average')/len(scores) * 100
     return scores
 
-def block_blending(wsi_object, img, vis_level, top_left, bot_right, alpha=0.5, blank_canvas=False, block_size=1024):
+def block_blending(wsi_object, img, vis_level, top_left, bot_right, alpha=0.5, blank_canvas=False, block_size=1024,
+                   canvas=None):
+    # canvas: optional image of the region at vis_level, already read by the caller: blocks are cut from it instead of
+    # being read again from wsi_object.
     print('\ncomputing blend')
     level_downsamples = _assertLevelDownsamples(wsi_object)
     downsample = level_downsamples[vis_level]
@@ -60,17 +63,20 @@ def block_blending(wsi_object, img, vis_level, top_left, bot_right, alpha=0.5, b
             blend_block = img[y_start_img:y_end_img, x_start_img:x_end_img]
             blend_block_size = (x_end_img - x_start_img, y_end_img - y_start_img)
 
-            if not blank_canvas:
+            if not blank_canvas and canvas is not None:
+                # 4. cut canvas block from the region read by the caller
+                canvas_block = canvas[y_start_img:y_end_img, x_start_img:x_end_img].copy()
+            elif not blank_canvas:
                 # 4. read actual wsi block as canvas block
                 pt = (x_start, y_start)
-                canvas = np.array(wsi_object.read_region(pt, vis_level, blend_block_size).convert("RGB"))
+                canvas_block = np.array(wsi_object.read_region(pt, vis_level, blend_block_size).convert("RGB"))
             else:
                 # 4. OR create blank canvas block
-                canvas = np.array(Image.new(size=blend_block_size, mode="RGB", color=(255, 255, 255)))
+                canvas_block = np.array(Image.new(size=blend_block_size, mode="RGB", color=(255, 255, 255)))
 
             # 5. blend color block and canvas block
-            img[y_start_img:y_end_img, x_start_img:x_end_img] = cv2.addWeighted(blend_block, alpha, canvas,
-                                                                                1 - alpha, 0, canvas)
+            img[y_start_img:y_end_img, x_start_img:x_end_img] = cv2.addWeighted(blend_block, alpha, canvas_block,
+                                                                                1 - alpha, 0, canvas_block)
     return img
 
 def visHeatmap(wsi_object, scores, coords, vis_level=-1,
@@ -83,7 +89,8 @@ def visHeatmap(wsi_object, scores, coords, vis_level=-1,
                binarize=False, thresh=0.5,
                max_size=None,
                custom_downsample=1,
-               cmap='coolwarm'):
+               cmap='coolwarm',
+               canvas=None):
     """
     Args:
         scores (numpy array of float): Attention scores
@@ -102,6 +109,8 @@ def visHeatmap(wsi_object, scores, coords, vis_level=-1,
         max_size (int): Maximum canvas size (clip if goes over)
         custom_downsample (int): additionally downscale the heatmap by specified factor
         cmap (str): name of matplotlib colormap to use
+        canvas (numpy array of uint8): optional (H, W, 3) image of the whole slide at vis_level (e.g. from
+            Utils.ThumbnailCache), used as canvas instead of reading the slide
     """
 
     if vis_level < 0:
@@ -190,7 +199,12 @@ def visHeatmap(wsi_object, scores, coords, vis_level=-1,
     if blur:
         overlay = cv2.GaussianBlur(overlay, tuple((patch_size * (1 - overlap)).astype(int) * 2 + 1), 0)
 
-    if not blank_canvas:
+    if not blank_canvas and canvas is not None:
+        # crop the region from the whole slide image given by the caller
+        x0, y0 = int(top_left[0] * scale[0]), int(top_left[1] * scale[1])
+        canvas = canvas[y0:y0 + h, x0:x0 + w]
+        img = np.array(canvas)
+    elif not blank_canvas:
         # downsample original image and use as canvas
         img = np.array(wsi_object.read_region(top_left, vis_level, region_size).convert("RGB"))
     else:
@@ -239,7 +253,7 @@ def visHeatmap(wsi_object, scores, coords, vis_level=-1,
         img = block_blending(wsi_object,
                              img, vis_level, top_left, bot_right,
                              alpha=alpha, blank_canvas=blank_canvas,
-                             block_size=1024)
+                             block_size=1024, canvas=canvas)
 
     img = Image.fromarray(img)
     w, h = img.size